@@ -0,0 +1,91 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['SUBTRACTOR_PARAMETERS', 'FrameDifferenceSubtractor',
+           'create_background_subtractor']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import cv2
+import watchmanconfig
+
+# The tuning parameters each background subtractor accepts.  These are the keyword argument
+#   names of the OpenCV factory functions.
+SUBTRACTOR_PARAMETERS = {
+    'mog': ('history', 'nmixtures', 'backgroundRatio', 'noiseSigma'),
+    'mog2': ('history', 'varThreshold', 'detectShadows'),
+    'knn': ('history', 'dist2Threshold', 'detectShadows'),
+    'cnt': ('minPixelStability', 'useHistory', 'maxPixelStability', 'isParallel'),
+    'difference': ('threshold',),
+}
+
+
+class FrameDifferenceSubtractor():
+    """The cheapest possible background subtractor.  The background is simply the previous
+    frame.  Pixels that changed by more than a threshold are foreground.  Has the same
+    apply() interface as the OpenCV background subtractors.
+    """
+
+    def __init__(self, threshold=25):
+        """threshold: How much a pixel has to change, from 0 to 255, to be foreground."""
+        self.threshold = threshold
+        self.previous_image = None
+
+    def apply(self, image, learningRate=-1):  # pylint: disable=invalid-name
+        """Returns a mask where changed pixels are 255 and unchanged pixels are 0.
+
+        image: The image to compare against the previous image.
+        learningRate: Ignored.  The previous frame always replaces the background.
+        """
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        previous_image = self.previous_image
+        self.previous_image = image
+        if previous_image is None:
+            previous_image = image
+
+        difference_image = cv2.absdiff(image, previous_image)
+        return_value, mask = cv2.threshold(
+            difference_image, self.threshold, 255, cv2.THRESH_BINARY)
+        return mask
+
+
+def create_background_subtractor(subtractor_name, parameters):
+    """Creates a background subtractor.
+
+    subtractor_name: One of the keys of SUBTRACTOR_PARAMETERS.
+    parameters: A dictionary of tuning parameters passed to the subtractor.  Unspecified
+      parameters use the OpenCV defaults.
+    Returns the background subtractor.
+    """
+    invalid_parameters = set(parameters) - set(SUBTRACTOR_PARAMETERS[subtractor_name])
+    if invalid_parameters:
+        raise watchmanconfig.ConfigurationException(
+            'The %s background subtractor does not accept: %s. Valid parameters are: %s.' % (
+                subtractor_name, ', '.join(sorted(invalid_parameters)),
+                ', '.join(SUBTRACTOR_PARAMETERS[subtractor_name])))
+
+    if subtractor_name == 'mog':
+        subtractor = cv2.bgsegm.createBackgroundSubtractorMOG(**parameters)
+    elif subtractor_name == 'mog2':
+        subtractor = cv2.createBackgroundSubtractorMOG2(**parameters)
+    elif subtractor_name == 'knn':
+        subtractor = cv2.createBackgroundSubtractorKNN(**parameters)
+    elif subtractor_name == 'cnt':
+        subtractor = cv2.bgsegm.createBackgroundSubtractorCNT(**parameters)
+    else:
+        subtractor = FrameDifferenceSubtractor(**parameters)
+
+    return subtractor
@@ -0,0 +1,174 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['CameraSupervisor']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import glob
+import logging
+import os
+import subprocess
+import time
+import traceback
+import mediaworker
+
+# The minimum number of seconds between starts of a camera's subprocess.  Keeps a subprocess
+#   that immediately exits (e.g. because the device is not readable yet) from being restarted
+#   in a tight loop.
+MINIMUM_RESTART_DELAY = 1
+
+
+class CameraSupervisor():
+    """Runs the watchman subprocess for one camera while the camera's video device exists.
+    The subprocess is killed when the device disappears and restarted when it comes back or
+    when the subprocess exits on its own.  Each camera is supervised independently.  If the
+    camera has a media worker process, it is started, killed, and restarted along with the
+    subprocess.
+    """
+
+    def __init__(self, camera_name, device_pathname, subprocess_pathname, cpu_affinity,
+                 media_worker_pathname=None, media_worker_cpu_affinity=None):
+        """camera_name: The camera's name from the configuration file.
+        device_pathname: The camera's video device file.
+        subprocess_pathname: The watchman subprocess program.
+        cpu_affinity: The set of CPUs the subprocess may run on or None for any CPU.
+        media_worker_pathname: The media worker program, or None if the camera does not use
+          a media worker process.
+        media_worker_cpu_affinity: The set of CPUs the media worker may run on or None for
+          any CPU.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.camera_name = camera_name
+        self.device_pathname = device_pathname
+        self.subprocess_pathname = subprocess_pathname
+        self.cpu_affinity = cpu_affinity
+        self.media_worker_pathname = media_worker_pathname
+        self.media_worker_cpu_affinity = media_worker_cpu_affinity
+        self.subprocess = None
+        self.media_worker = None
+        self.last_start_time = None
+        # Reported as metrics.
+        self.start_count = 0
+        self.exit_count = 0
+
+    def poll(self):
+        """Starts the subprocess if the device exists and it is not running.  Kills the
+        subprocess if the device no longer exists or the subprocess or its media worker has
+        exited.
+
+        Returns the number of seconds until poll() needs to be called again regardless of
+          device changes or child exits, or None if it only needs to be called after one.
+        """
+        device_exists = bool(glob.glob(self.device_pathname))
+
+        if self.subprocess is not None and (
+                not device_exists or self.subprocess.poll() is not None or (
+                    self.media_worker is not None and self.media_worker.poll() is not None)):
+            if device_exists:
+                self.exit_count += 1
+                if self.subprocess.returncode is not None:
+                    self.logger.warning(
+                        'Watchman subprocess for camera %s exited with code %d.',
+                        self.camera_name, self.subprocess.returncode)
+                else:
+                    self.logger.warning('Media worker for camera %s exited with code %d.',
+                                        self.camera_name, self.media_worker.returncode)
+            else:
+                self.logger.info('Detected removal of video device %s.',
+                                 self.device_pathname)
+            # Kill the subprocess so it can be restarted.
+            self.kill()
+
+        if self.subprocess is None and device_exists:
+            if self.last_start_time is not None:
+                seconds_since_start = time.monotonic() - self.last_start_time
+                if seconds_since_start < MINIMUM_RESTART_DELAY:
+                    return MINIMUM_RESTART_DELAY - seconds_since_start
+
+            # Startup the subprocess to that takes photos.
+            self.logger.info('Detected video device %s. Starting watchman subprocess for '
+                             'camera %s.', self.device_pathname, self.camera_name)
+            self.last_start_time = time.monotonic()
+            self.start_count += 1
+            if self.media_worker_pathname is None:
+                self.subprocess = subprocess.Popen(
+                    [self.subprocess_pathname, '--camera', self.camera_name],
+                    preexec_fn=self._set_cpu_affinity)
+            else:
+                self._start_with_media_worker()
+
+        return None
+
+    def kill(self):
+        """Kills the subprocess and its media worker if they are running.  Errors are logged
+        and ignored.
+        """
+        if self.media_worker is not None:
+            try:
+                self.logger.info('Killing media worker for camera %s.', self.camera_name)
+                self.media_worker.kill()
+                self.media_worker.wait()
+            except OSError as os_error:
+                self.logger.error('Error killing media worker. %s: %s',
+                                  type(os_error).__name__, str(os_error))
+                self.logger.error('%s', traceback.format_exc())
+                self.logger.error('Ignoring.')  # The media worker might no longer exist.
+            self.media_worker = None
+
+        if self.subprocess is not None:
+            try:
+                self.logger.info('Killing watchman subprocess for camera %s.',
+                                 self.camera_name)
+                # TODO: Send a signal to watchman to flush its current e-mail buffer, give it
+                #   a second then do a kill or kill -9. (issue 4)
+                self.subprocess.kill()
+                self.subprocess.wait()
+            except OSError as os_error:
+                self.logger.error('Error killing watchman subprocess. %s: %s',
+                                  type(os_error).__name__, str(os_error))
+                self.logger.error('%s', traceback.format_exc())
+                self.logger.error('Ignoring.')  # The subprocess might no longer exist.
+            self.subprocess = None
+
+    def _start_with_media_worker(self):
+        """Starts the media worker and then the subprocess, connected by a socket."""
+        self.media_worker, worker_socket = mediaworker.start_media_worker(
+            self.media_worker_pathname, ['--camera', self.camera_name],
+            preexec_fn=self._set_media_worker_cpu_affinity)
+        try:
+            self.subprocess = subprocess.Popen(
+                [self.subprocess_pathname, '--camera', self.camera_name,
+                 '--media-worker-fd', str(worker_socket.fileno())],
+                pass_fds=(worker_socket.fileno(),), preexec_fn=self._set_cpu_affinity)
+        except Exception:
+            self.kill()
+            raise
+        finally:
+            worker_socket.close()
+
+    def _set_cpu_affinity(self):
+        """Restricts the subprocess to the configured CPUs.  Runs in the child process
+        before the subprocess program starts.
+        """
+        if self.cpu_affinity is not None:
+            os.sched_setaffinity(0, self.cpu_affinity)
+
+    def _set_media_worker_cpu_affinity(self):
+        """Restricts the media worker to its configured CPUs.  Runs in the child process
+        before the media worker program starts.
+        """
+        if self.media_worker_cpu_affinity is not None:
+            os.sched_setaffinity(0, self.media_worker_cpu_affinity)
@@ -0,0 +1,161 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['ClipWriter']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import logging
+import queue
+import threading
+import time
+import cv2
+import imagewriter
+import mjpegcapture
+import pretrigger
+
+# Kinds of work queued for the writer thread.
+START_CLIP = 'start_clip'
+ADD_FRAME = 'add_frame'
+END_CLIP = 'end_clip'
+
+
+class ClipWriter():
+    """Encodes the frames of each motion event into a single video file in a background
+    thread.  One video file is much denser and is written sequentially, unlike one JPEG per
+    frame.
+    """
+
+    def __init__(self, fps, fourcc, rotation_angle, queue_size, full_policy, stage_timer):
+        """Starts the writer thread.
+
+        fps: The frame rate of the video files.
+        fourcc: The four character code of the video codec.  (e.g. 'MJPG')
+        rotation_angle: How far to rotate frames clockwise.  0, 90, 180, or 270.
+        queue_size: The maximum number of frames waiting to be encoded.
+        full_policy: imagewriter.WAIT_WHEN_FULL to make add_frame() wait for space in the
+          queue or imagewriter.DROP_WHEN_FULL to discard the frame.
+        stage_timer: The StageTimer that encode times are recorded in.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.rotation_angle = rotation_angle
+        self.full_policy = full_policy
+        self.stage_timer = stage_timer
+        self.dropped_frame_count = 0
+
+        # Only used by the writer thread.
+        self.clip_pathname = None
+        self.video_writer = None
+        self.clip_frame_count = 0
+
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._write_clips, name='clip-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def start_clip(self, pathname):
+        """Starts a new video file.  Any clip in progress is finished first.
+
+        pathname: Where the video file is written.
+        """
+        self.write_queue.put((START_CLIP, pathname))
+
+    def add_frame(self, image):
+        """Queues a frame to be added to the current clip.  Returns immediately unless the
+        queue is full and the full policy is to wait.
+
+        image: The unrotated frame as a decoded image or a mjpegcapture.MjpegImage.  The
+          image must not be modified afterward.
+        """
+        if self.full_policy == imagewriter.DROP_WHEN_FULL:
+            try:
+                self.write_queue.put_nowait((ADD_FRAME, image))
+            except queue.Full:
+                self.dropped_frame_count += 1
+                self.logger.warning('Clip write queue is full. Dropping a frame.')
+        else:
+            self.write_queue.put((ADD_FRAME, image))
+
+    def end_clip(self):
+        """Finishes the current video file."""
+        self.write_queue.put((END_CLIP,))
+
+    def close(self):
+        """Writes every queued frame, finishes the current clip, and stops the writer
+        thread.
+        """
+        self.write_queue.put(None)
+        self.thread.join()
+
+    def _write_clips(self):
+        """The body of the writer thread.  Writes clips until a None is dequeued."""
+        while True:
+            queued_item = self.write_queue.get()
+            if queued_item is None:
+                break
+            if queued_item[0] == START_CLIP:
+                self._end_clip()
+                self.clip_pathname = queued_item[1]
+            elif queued_item[0] == ADD_FRAME:
+                start_time = time.perf_counter()
+                self._add_frame(queued_item[1])
+                self.stage_timer.record('clip_writer.write',
+                                        time.perf_counter() - start_time)
+            else:
+                self._end_clip()
+        self._end_clip()
+
+    def _add_frame(self, image):
+        """Rotates and encodes a frame.  The video file is opened with the first frame
+        because the frame size must be known.
+        """
+        if self.clip_pathname is None:
+            return  # Opening the clip failed.
+
+        try:
+            if isinstance(image, mjpegcapture.MjpegImage):
+                image = image.decode()
+            if self.rotation_angle:
+                image = cv2.rotate(image, pretrigger.ROTATE_CODES[self.rotation_angle])
+
+            if self.video_writer is None:
+                height, width = image.shape[:2]
+                self.video_writer = cv2.VideoWriter(
+                    self.clip_pathname, self.fourcc, self.fps, (width, height))
+                if not self.video_writer.isOpened():
+                    self.logger.error('Could not open clip %s for writing.',
+                                      self.clip_pathname)
+                    self.video_writer = None
+                    self.clip_pathname = None
+                    return
+                self.logger.info('Recording clip %s.', self.clip_pathname)
+
+            self.video_writer.write(image)
+            self.clip_frame_count += 1
+        except Exception as exception:  # pylint: disable=broad-except
+            self.logger.error('Failed to write a frame to clip %s. %s: %s',
+                              self.clip_pathname, type(exception).__name__, str(exception))
+
+    def _end_clip(self):
+        """Closes the current video file, if any."""
+        if self.video_writer is not None:
+            self.video_writer.release()
+            self.logger.info('Finished clip %s with %d frames.', self.clip_pathname,
+                             self.clip_frame_count)
+        self.video_writer = None
+        self.clip_pathname = None
+        self.clip_frame_count = 0
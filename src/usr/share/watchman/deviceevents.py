@@ -0,0 +1,194 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['DeviceEventMonitor', 'IN_CLOSE_WRITE', 'IN_CREATE', 'IN_IGNORED', 'IN_ISDIR',
+           'IN_MOVED_TO', 'IN_Q_OVERFLOW', 'add_inotify_watch', 'create_inotify_fd',
+           'read_inotify_events']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import signal
+import struct
+import time
+
+# inotify event flags from <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+DEVICE_EVENT_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# struct inotify_event without the trailing name.
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 65536
+# How often devices are checked if inotify is not available.
+FALLBACK_POLL_INTERVAL = .1
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def create_inotify_fd():
+    """Creates a non-blocking inotify file descriptor.  inotify is used through ctypes
+    because the Python standard library does not wrap it.
+    """
+    inotify_fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if inotify_fd < 0:
+        error_number = ctypes.get_errno()
+        raise OSError(error_number, os.strerror(error_number))
+    return inotify_fd
+
+
+def add_inotify_watch(inotify_fd, directory, mask):
+    """Watches a directory for events.
+
+    inotify_fd: The file descriptor returned by create_inotify_fd().
+    directory: The directory to watch.
+    mask: The IN_* event flags to watch for.
+    Returns the watch descriptor.
+    """
+    watch_descriptor = _libc.inotify_add_watch(inotify_fd, os.fsencode(directory), mask)
+    if watch_descriptor < 0:
+        error_number = ctypes.get_errno()
+        raise OSError(error_number, os.strerror(error_number), directory)
+    return watch_descriptor
+
+
+def read_inotify_events(inotify_fd):
+    """Reads every pending event from a non-blocking inotify file descriptor.
+
+    Returns a list of (watch descriptor, mask, filename bytes) tuples.
+    """
+    events = []
+    while True:
+        try:
+            data = os.read(inotify_fd, READ_SIZE)
+        except OSError as os_error:
+            if os_error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return events
+            raise
+
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, mask, cookie, name_length = \
+                INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            events.append((watch_descriptor, mask, name))
+
+
+class DeviceEventMonitor():
+    """Sleeps until a device file appears, disappears, or changes permissions, or until a
+    child process exits.  Device changes are detected with inotify and child exits with
+    SIGCHLD, so nothing needs to be polled.  Must be created in the main thread.
+    """
+
+    def __init__(self, device_directory, device_name_prefix):
+        """Starts watching for events.
+
+        device_directory: The directory containing the device files.  Usually /dev.
+        device_name_prefix: Only files starting with this prefix are of interest.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.device_name_prefix = device_name_prefix.encode()
+
+        # SIGCHLD interrupts the wait through the wakeup file descriptor.  A Python level
+        #   handler is required for the wakeup file descriptor to be written.
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        os.set_blocking(self.wakeup_read_fd, False)
+        os.set_blocking(self.wakeup_write_fd, False)
+        signal.set_wakeup_fd(self.wakeup_write_fd)
+        signal.signal(signal.SIGCHLD, self._ignore_signal)
+
+        self.inotify_fd = None
+        inotify_fd = None
+        try:
+            inotify_fd = create_inotify_fd()
+            add_inotify_watch(inotify_fd, device_directory, DEVICE_EVENT_MASK)
+            self.inotify_fd = inotify_fd
+        except OSError as os_error:
+            if inotify_fd is not None:
+                os.close(inotify_fd)
+            self.logger.warning(
+                'Could not watch %s with inotify. Checking for devices every %.1f seconds '
+                'instead. %s: %s', device_directory, FALLBACK_POLL_INTERVAL,
+                type(os_error).__name__, str(os_error))
+
+    def wait(self, timeout):
+        """Sleeps until there might be a device change or an exited child process.
+
+        timeout: The maximum number of seconds to sleep or None to sleep indefinitely.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        file_descriptors = [self.wakeup_read_fd]
+        if self.inotify_fd is None:
+            if timeout is None or timeout > FALLBACK_POLL_INTERVAL:
+                deadline = time.monotonic() + FALLBACK_POLL_INTERVAL
+        else:
+            file_descriptors.append(self.inotify_fd)
+
+        while True:
+            remaining_seconds = None
+            if deadline is not None:
+                remaining_seconds = max(deadline - time.monotonic(), 0)
+
+            readable_fds, _, _ = select.select(file_descriptors, [], [], remaining_seconds)
+            if not readable_fds:
+                return
+
+            woken = False
+            if self.wakeup_read_fd in readable_fds:
+                self._drain(self.wakeup_read_fd)
+                woken = True
+            if self.inotify_fd in readable_fds and self._read_device_events():
+                woken = True
+            if woken:
+                return
+
+    def _read_device_events(self):
+        """Reads every pending inotify event.  Returns True if any of them was for a device
+        of interest.
+        """
+        relevant = False
+        for watch_descriptor, mask, name in read_inotify_events(self.inotify_fd):
+            # If events were lost, assume one of them was relevant.
+            if mask & IN_Q_OVERFLOW or name.startswith(self.device_name_prefix):
+                relevant = True
+        return relevant
+
+    def _drain(self, file_descriptor):
+        """Discards everything that can be read from a non-blocking file descriptor."""
+        try:
+            while os.read(file_descriptor, READ_SIZE):
+                pass
+        except OSError as os_error:
+            if os_error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _ignore_signal(self, signal_number, stack_frame):
+        """Does nothing.  The signal only needs to wake up wait()."""
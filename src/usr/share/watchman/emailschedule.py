@@ -0,0 +1,109 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['EmailSchedule', 'EmailStage', 'SEND_EMAIL', 'STORE_IMAGE']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import collections
+import heapq
+import framecapture
+
+# Kinds of scheduled events.
+STORE_IMAGE = 'store_image'
+SEND_EMAIL = 'send_email'
+
+# One e-mail of a motion event.  Times are in seconds from the start of the stage, which is
+#   when motion started for the first e-mail and when the previous e-mail was sent for the
+#   others.  message is the text the e-mail starts with.
+EmailStage = collections.namedtuple(
+    'EmailStage', ['image_save_times', 'delay', 'message'])
+
+
+class EmailSchedule():
+    """Keeps the times images are stored for and e-mails are sent during a motion event in a
+    min-heap, so each frame only has to compare its time to the earliest deadline.  The
+    deadlines of the fixed stages are calculated once when motion starts.  The repeating
+    stage is scheduled again each time its e-mail is sent.
+    """
+
+    def __init__(self, stages, repeating_stage):
+        """stages: The EmailStage of each e-mail sent once per motion event, in order.
+        repeating_stage: The EmailStage repeated after the last of stages until motion
+          stops.
+        """
+        self.stages = stages
+        self.repeating_stage = repeating_stage
+        # (deadline_ns, sequence_number, event_kind, stage) tuples.  The sequence number
+        #   keeps events with the same deadline in the order they were scheduled.
+        self.events = []
+        self.sequence_number = 0
+
+    def start(self, start_time_ns):
+        """Schedules the e-mails of a new motion event.  Any scheduled events are discarded.
+
+        start_time_ns: The time motion started in monotonic nanoseconds.
+        """
+        self.events = []
+        stage_start_time_ns = start_time_ns
+        for stage in self.stages:
+            stage_start_time_ns = self._schedule_stage(stage, stage_start_time_ns)
+        self._schedule_stage(self.repeating_stage, stage_start_time_ns)
+
+    def stop(self):
+        """Discards every scheduled event."""
+        self.events = []
+
+    def is_due(self, time_ns):
+        """Returns whether an event is due at a frame's time."""
+        return bool(self.events) and self.events[0][0] < time_ns
+
+    def pop_due_events(self, time_ns):
+        """Removes and returns the events that are due at a frame's time.  An event is due on
+        the first frame after its deadline.
+
+        time_ns: The frame's capture time in monotonic nanoseconds.
+        Returns a list of (event_kind, stage) tuples in the order they are due.
+        """
+        due_events = []
+        while self.events and self.events[0][0] < time_ns:
+            deadline_ns, _, event_kind, stage = heapq.heappop(self.events)
+            due_events.append((event_kind, stage))
+            if event_kind == SEND_EMAIL and stage is self.repeating_stage:
+                # At most one repeating e-mail is sent per frame, even if frames are far
+                #   apart or the delay is 0.
+                self._schedule_stage(self.repeating_stage, max(
+                    deadline_ns, time_ns - framecapture.seconds_to_nanoseconds(stage.delay)))
+        return due_events
+
+    def _schedule_stage(self, stage, stage_start_time_ns):
+        """Adds a stage's image store times and e-mail send time to the heap.
+
+        stage: The EmailStage to schedule.
+        stage_start_time_ns: The time the stage starts in monotonic nanoseconds.
+        Returns the time the stage's e-mail is sent, which is when the next stage starts.
+        """
+        for image_save_time in stage.image_save_times:
+            self._schedule_event(
+                stage_start_time_ns + framecapture.seconds_to_nanoseconds(image_save_time),
+                STORE_IMAGE, stage)
+        send_time_ns = stage_start_time_ns + framecapture.seconds_to_nanoseconds(stage.delay)
+        self._schedule_event(send_time_ns, SEND_EMAIL, stage)
+        return send_time_ns
+
+    def _schedule_event(self, deadline_ns, event_kind, stage):
+        """Adds one event to the heap."""
+        self.sequence_number += 1
+        heapq.heappush(self.events, (deadline_ns, self.sequence_number, event_kind, stage))
@@ -0,0 +1,307 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['EmailSender']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import logging
+import queue
+import threading
+import time
+import traceback
+import cv2
+import mjpegcapture
+
+# Kinds of work queued for the sender thread.
+BUFFER_IMAGE = 'buffer_image'
+SEND_EMAIL = 'send_email'
+
+# The range of JPEG qualities searched when an attachment is encoded again to fit in
+#   email_max_bytes.  95 is what cv2.imencode uses by default.
+MIN_JPEG_QUALITY = 20
+MAX_JPEG_QUALITY = 95
+# When an attachment does not fit at MIN_JPEG_QUALITY, its width is multiplied by this and
+#   the quality is searched again, until the width would be less than MIN_IMAGE_WIDTH.
+WIDTH_REDUCTION_FACTOR = .75
+MIN_IMAGE_WIDTH = 160
+
+
+class EmailSender():
+    """Prepares e-mail attachments and queues e-mails with gpgmailer in a background thread
+    so the capture loop only has to hand over references to the images.  A single thread is
+    used so e-mails are queued in the order they were requested.
+
+    Decoded images for the next motion e-mail are scaled down to the e-mail image width as
+    soon as they are buffered and are JPEG encoded by the sender thread, so only e-mail sized
+    images are held until the e-mail is sent.  The total size of the images waiting to be
+    encoded and the buffered JPEGs is capped, even when the sender thread falls behind.
+
+    So the cost of encrypting and sending each e-mail is bounded, the attachments of an
+    e-mail are encoded again at a lower quality and width, or some are dropped, when they add
+    up to more than email_max_bytes.
+    """
+
+    def __init__(self, create_email_message, email_image_width, buffer_max_bytes,
+                 email_max_bytes, stage_timer):
+        """Starts the sender thread.
+
+        create_email_message: A function that returns a new GpgMailMessage compatible
+          object.
+        email_image_width: The maximum width of attached images in pixels.  Wider images
+          are scaled down proportionally.
+        buffer_max_bytes: The maximum total size of the images waiting to be encoded and the
+          encoded images waiting for the next e-mail.  Images that do not fit are discarded.
+        email_max_bytes: The maximum total size of the attachments of one e-mail.
+        stage_timer: The StageTimer that preparation times are recorded in.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.create_email_message = create_email_message
+        self.email_image_width = email_image_width
+        self.buffer_max_bytes = buffer_max_bytes
+        self.email_max_bytes = email_max_bytes
+        self.stage_timer = stage_timer
+
+        # Protects held_byte_count and dropped_attachment_count, which are updated by both
+        #   the caller and the sender thread.
+        self.lock = threading.Lock()
+        # The total size of the images queued to be buffered and the buffered JPEGs.
+        self.held_byte_count = 0
+        self.dropped_attachment_count = 0
+
+        # Only used by the sender thread.
+        self.buffered_attachments = []
+        self.buffered_byte_count = 0
+
+        self.email_queue = queue.Queue()
+        self.thread = threading.Thread(target=self._send_emails, name='email-sender',
+                                       daemon=True)
+        self.thread.start()
+
+    def buffer_image(self, filename, image):
+        """Scales an image down to the e-mail image width and queues it to be JPEG encoded
+        for the next e-mail sent with include_buffered_images.  The image is discarded if it
+        does not fit in buffer_max_bytes.  Returns without waiting for the encoding.
+
+        filename: The attachment filename.
+        image: The image to attach.  A mjpegcapture.MjpegImage that is no wider than the
+          e-mail image width and a JPEG that is already encoded (a one dimensional uint8
+          array) are attached as is.  The image must not be modified afterward.
+        """
+        with self.stage_timer.time('email_sender.resize_image'):
+            image = self._resize_attachment(image)
+        if isinstance(image, mjpegcapture.MjpegImage):
+            byte_count = image.jpeg.nbytes
+        else:
+            byte_count = image.nbytes
+
+        with self.lock:
+            image_fits = self.held_byte_count + byte_count <= self.buffer_max_bytes
+            if image_fits:
+                self.held_byte_count += byte_count
+            else:
+                self.dropped_attachment_count += 1
+        if image_fits:
+            self.email_queue.put((BUFFER_IMAGE, filename, image, byte_count))
+        else:
+            self.logger.warning('E-mail image buffer is full. Not attaching %s.', filename)
+
+    def queue_email(self, subject, body, include_buffered_images=False):
+        """Queues an e-mail to be sent.  Returns immediately.
+
+        subject: The e-mail subject.
+        body: The plain text e-mail body.
+        include_buffered_images: Attach, and then clear, the images buffered by
+          buffer_image().
+        """
+        self.email_queue.put((SEND_EMAIL, subject, body, include_buffered_images))
+
+    def close(self):
+        """Sends every queued e-mail and then stops the sender thread."""
+        self.email_queue.put(None)
+        self.thread.join()
+
+    def _send_emails(self):
+        """The body of the sender thread.  Encodes images and sends e-mails until a None is
+        dequeued.
+        """
+        while True:
+            queued_item = self.email_queue.get()
+            if queued_item is None:
+                break
+            if queued_item[0] == BUFFER_IMAGE:
+                self._buffer_image(*queued_item[1:])
+            else:
+                self._send_email(*queued_item[1:])
+
+    def _buffer_image(self, filename, image, byte_count):
+        """Encodes an image and adds it to the attachment buffer.
+
+        filename: The attachment filename.
+        image: The resized image.
+        byte_count: The size of the image counted in held_byte_count.
+        """
+        start_time = time.perf_counter()
+        try:
+            jpeg = self._encode_attachment(image)
+        except Exception as exception:  # pylint: disable=broad-except
+            self.logger.error('Failed to encode e-mail image %s. %s: %s\n%s', filename,
+                              type(exception).__name__, str(exception),
+                              traceback.format_exc())
+            with self.lock:
+                self.held_byte_count -= byte_count
+            return
+        finally:
+            self.stage_timer.record('email_sender.encode_image',
+                                    time.perf_counter() - start_time)
+
+        with self.lock:
+            self.held_byte_count += jpeg.nbytes - byte_count
+        self.buffered_attachments.append((filename, jpeg))
+        self.buffered_byte_count += jpeg.nbytes
+
+    def _send_email(self, subject, body, include_buffered_images):
+        """Creates an e-mail and queues it with gpgmailer."""
+        attachments = []
+        if include_buffered_images:
+            attachments = self.buffered_attachments
+            self.buffered_attachments = []
+            with self.lock:
+                self.held_byte_count -= self.buffered_byte_count
+            self.buffered_byte_count = 0
+            with self.stage_timer.time('email_sender.fit_attachments'):
+                attachments = self._fit_attachments(attachments)
+
+        start_time = time.perf_counter()
+        try:
+            email = self.create_email_message()
+            email.set_subject(subject)
+            email.set_body(body)
+            for filename, jpeg in attachments:
+                email.add_attachment(filename, jpeg)
+            email.queue_for_sending()
+        except Exception as exception:  # pylint: disable=broad-except
+            self.logger.error('Failed to send e-mail. %s: %s\n%s',
+                              type(exception).__name__, str(exception),
+                              traceback.format_exc())
+        self.stage_timer.record('email_sender.queue_for_sending',
+                                time.perf_counter() - start_time)
+
+    def _fit_attachments(self, attachments):
+        """Makes the attachments of an e-mail add up to no more than email_max_bytes.  The
+        smallest attachments are fitted first so the bytes they leave unused go to the larger
+        ones.  If an attachment cannot be made small enough, every other attachment is
+        dropped, so the remaining ones still cover the whole motion event, and the rest are
+        fitted again.
+
+        attachments: A list of (filename, jpeg) tuples.
+        Returns a list of (filename, jpeg) tuples in the same order.
+        """
+        while sum(jpeg.nbytes for _, jpeg in attachments) > self.email_max_bytes:
+            fitted_attachments = list(attachments)
+            remaining_byte_count = self.email_max_bytes
+            sorted_indexes = sorted(range(len(attachments)),
+                                    key=lambda index: attachments[index][1].nbytes)
+            for position, index in enumerate(sorted_indexes):
+                filename, jpeg = attachments[index]
+                max_bytes = remaining_byte_count // (len(attachments) - position)
+                if jpeg.nbytes > max_bytes:
+                    jpeg = self._encode_to_fit(jpeg, max_bytes)
+                    if jpeg is None:
+                        break
+                    fitted_attachments[index] = (filename, jpeg)
+                remaining_byte_count -= jpeg.nbytes
+            else:
+                return fitted_attachments
+
+            dropped_attachments = attachments[1::2] if len(attachments) > 1 else attachments
+            attachments = attachments[::2] if len(attachments) > 1 else []
+            with self.lock:
+                self.dropped_attachment_count += len(dropped_attachments)
+            self.logger.warning(
+                'E-mail images do not fit in email_max_bytes. Not attaching %s.',
+                ', '.join(filename for filename, _ in dropped_attachments))
+        return attachments
+
+    def _encode_to_fit(self, jpeg, max_bytes):
+        """Encodes a JPEG again at the highest quality that fits in a number of bytes.  If
+        it does not fit at MIN_JPEG_QUALITY, the image is scaled down until it does.
+
+        jpeg: The JPEG to encode again.
+        max_bytes: The maximum size of the new JPEG.
+        Returns the new JPEG or None if it does not fit at MIN_IMAGE_WIDTH.
+        """
+        image = cv2.imdecode(jpeg, cv2.IMREAD_UNCHANGED)
+        while True:
+            # Binary search for the highest quality that fits.
+            low_quality = MIN_JPEG_QUALITY
+            high_quality = MAX_JPEG_QUALITY
+            fitted_jpeg = None
+            while low_quality <= high_quality:
+                quality = (low_quality + high_quality) // 2
+                _, encoded_jpeg = cv2.imencode(
+                    '.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                if encoded_jpeg.nbytes <= max_bytes:
+                    fitted_jpeg = encoded_jpeg
+                    low_quality = quality + 1
+                else:
+                    high_quality = quality - 1
+            if fitted_jpeg is not None:
+                return fitted_jpeg
+
+            current_image_height, current_image_width = image.shape[:2]
+            desired_image_width = int(current_image_width * WIDTH_REDUCTION_FACTOR)
+            if desired_image_width < MIN_IMAGE_WIDTH:
+                return None
+            desired_image_height = int(desired_image_width * (current_image_height /
+                                                              current_image_width))
+            image = cv2.resize(image, (desired_image_width, desired_image_height),
+                               interpolation=cv2.INTER_AREA)
+
+    def _resize_attachment(self, image):
+        """Scales a decoded image down to the e-mail image width.
+
+        image: A decoded image, a mjpegcapture.MjpegImage, or an encoded JPEG.  Only
+          decoded images are scaled.  The others are returned as is.
+        Returns the image.
+        """
+        if isinstance(image, mjpegcapture.MjpegImage) or image.ndim == 1:
+            return image
+
+        # Resize for e-mail or don't resize if images is smaller than desired resolution.
+        desired_image_width = self.email_image_width  # In pixels
+        current_image_height, current_image_width = image.shape[:2]
+        if desired_image_width < current_image_width:
+            # Images are scaled proportionally.
+            desired_image_height = int(desired_image_width * (current_image_height /
+                                                              current_image_width))
+            image = cv2.resize(image, (desired_image_width, desired_image_height))
+        return image
+
+    def _encode_attachment(self, image):
+        """JPEG encodes an image resized by _resize_attachment.
+
+        image: The image to encode.  A decoded image, a mjpegcapture.MjpegImage, or an
+          encoded JPEG.
+        Returns the encoded JPEG.
+        """
+        if isinstance(image, mjpegcapture.MjpegImage):
+            return image.get_jpeg(self.email_image_width)
+        if image.ndim == 1:
+            return image  # Already encoded.
+
+        # Save the file in memory
+        ret, small_jpeg = cv2.imencode('.jpg', image)
+        return small_jpeg
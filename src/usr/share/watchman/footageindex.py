@@ -0,0 +1,159 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['FootageIndex', 'format_index_time']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+
+# How long the writer thread collects rows before writing them in one transaction.
+BATCH_SECONDS = 1
+# How long to wait for another camera's subprocess to finish writing.
+BUSY_TIMEOUT_SECONDS = 30
+
+# Rows are only ever inserted.  Times are local wall clock times formatted by
+#   format_index_time, so they sort and compare correctly as text.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    camera TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    stop_time TEXT NOT NULL,
+    peak_abs_diff_mean_total REAL NOT NULL,
+    email_count INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS events_start_time ON events (start_time);
+CREATE TABLE IF NOT EXISTS files (
+    camera TEXT NOT NULL,
+    time TEXT NOT NULL,
+    event_start_time TEXT,
+    kind TEXT NOT NULL,
+    pathname TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS files_time ON files (time);
+CREATE INDEX IF NOT EXISTS files_event ON files (camera, event_start_time);
+'''
+
+INSERT_EVENT = 'INSERT INTO events VALUES (?, ?, ?, ?, ?)'
+INSERT_FILE = 'INSERT INTO files VALUES (?, ?, ?, ?, ?)'
+
+
+def format_index_time(wall_clock_time):
+    """Formats a datetime the way times are stored in the index.  (e.g.
+    '2023-04-01 02:00:00.000000')
+    """
+    return wall_clock_time.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+class FootageIndex():
+    """Records motion events and saved files in an SQLite database so footage can be found
+    with a query instead of by listing the image directories.  Rows are written in batches
+    by a background thread.  Every camera's subprocess writes to the same database.
+    """
+
+    def __init__(self, database_pathname, camera_name):
+        """Starts the writer thread.  The database is created if it does not exist.
+
+        database_pathname: The SQLite database file.
+        camera_name: The camera the rows are recorded for.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.database_pathname = database_pathname
+        self.camera_name = camera_name
+
+        self.row_queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_rows, name='footage-index',
+                                       daemon=True)
+        self.thread.start()
+
+    def add_event(self, start_time, stop_time, peak_abs_diff_mean_total, email_count):
+        """Records a finished motion event.  Returns immediately.
+
+        start_time: The wall clock datetime of the first motion.
+        stop_time: The wall clock datetime the motion was considered stopped.
+        peak_abs_diff_mean_total: The largest abs_diff_mean_total during the event.
+        email_count: The number of motion e-mails sent for the event.
+        """
+        self.row_queue.put((INSERT_EVENT, (
+            self.camera_name, format_index_time(start_time), format_index_time(stop_time),
+            peak_abs_diff_mean_total, email_count)))
+
+    def add_file(self, file_time, pathname, kind, event_start_time):
+        """Records a saved file.  Returns immediately.
+
+        file_time: The wall clock datetime the file's first frame was captured.
+        pathname: Where the file was saved.
+        kind: 'image', 'pre_trigger', or 'clip'.
+        event_start_time: The wall clock datetime of the first motion of the file's motion
+          event, or None.
+        """
+        if event_start_time is not None:
+            event_start_time = format_index_time(event_start_time)
+        self.row_queue.put((INSERT_FILE, (
+            self.camera_name, format_index_time(file_time), event_start_time, kind,
+            pathname)))
+
+    def close(self):
+        """Writes every queued row and stops the writer thread."""
+        self.row_queue.put(None)
+        self.thread.join()
+
+    def _write_rows(self):
+        """The body of the writer thread.  Writes rows in batches until a None is
+        dequeued.
+        """
+        try:
+            connection = sqlite3.connect(self.database_pathname,
+                                         timeout=BUSY_TIMEOUT_SECONDS)
+            # Write ahead logging lets readers query while the subprocesses write.
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+        except Exception as exception:  # pylint: disable=broad-except
+            self.logger.error('Could not open footage index %s. Footage will not be '
+                              'indexed. %s: %s\n%s', self.database_pathname,
+                              type(exception).__name__, str(exception),
+                              traceback.format_exc())
+            # Keep emptying the queue so close() works.
+            while self.row_queue.get() is not None:
+                pass
+            return
+
+        stopping = False
+        while not stopping:
+            rows = [self.row_queue.get()]
+            batch_end_time = time.monotonic() + BATCH_SECONDS
+            while rows[-1] is not None:
+                try:
+                    rows.append(self.row_queue.get(
+                        timeout=max(batch_end_time - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if rows[-1] is None:
+                stopping = True
+                rows.pop()
+
+            try:
+                with connection:
+                    for statement, parameters in rows:
+                        connection.execute(statement, parameters)
+            except Exception as exception:  # pylint: disable=broad-except
+                self.logger.error('Could not write %d rows to footage index %s. %s: %s',
+                                  len(rows), self.database_pathname,
+                                  type(exception).__name__, str(exception))
+
+        connection.close()
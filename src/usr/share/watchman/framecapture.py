@@ -0,0 +1,201 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['CaptureThread', 'DROP_OLDEST', 'DROP_NEWEST', 'Frame', 'NANOSECONDS_PER_SECOND',
+           'monotonic_ns', 'monotonic_ns_to_datetime', 'seconds_to_nanoseconds']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import collections
+import datetime
+import logging
+import threading
+import time
+
+# Frame buffer drop policies.
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+# How long to wait for the capture thread to notice it should stop.
+STOP_TIMEOUT = 5
+
+NANOSECONDS_PER_SECOND = 1000000000
+
+
+def monotonic_ns():
+    """Returns the monotonic clock in integer nanoseconds.  Frames are timestamped with this
+    clock so time thresholds are not affected when the wall clock is changed (e.g. by NTP).
+    """
+    # time.monotonic_ns() is not available until Python 3.7.
+    return int(time.monotonic() * NANOSECONDS_PER_SECOND)
+
+
+def monotonic_ns_to_datetime(time_ns):
+    """Converts a monotonic_ns() value from the past to wall clock time.  The age of the
+    value is subtracted from the current wall clock time, so the result follows any wall
+    clock changes.
+    """
+    age_nanoseconds = monotonic_ns() - time_ns
+    return datetime.datetime.now() - datetime.timedelta(microseconds=age_nanoseconds // 1000)
+
+
+def seconds_to_nanoseconds(seconds):
+    """Converts a (possibly fractional) number of seconds to integer nanoseconds."""
+    return int(round(seconds * NANOSECONDS_PER_SECOND))
+
+
+class Frame():
+    """A captured frame and what has been calculated from it.  Slots keep the per frame
+    allocation small and attribute access fast.
+    """
+
+    __slots__ = ('time_ns', 'image', 'mjpeg_image', 'subtracted_image', 'save',
+                 'rotated_image', 'abs_diff_mean_total', 'active_cell_count', 'datetime')
+
+    def __init__(self, time_ns, image, mjpeg_image=None):
+        """time_ns: The capture time as a monotonic_ns() value.
+        image: The captured image.  In MJPEG mode, the reduced size copy.
+        mjpeg_image: The mjpegcapture.MjpegImage the image was decoded from, or None.
+        """
+        self.time_ns = time_ns
+        self.image = image
+        self.mjpeg_image = mjpeg_image
+        self.subtracted_image = None
+        self.save = False
+        self.rotated_image = None
+        self.abs_diff_mean_total = None
+        # Only calculated with the 'grid' motion metric.
+        self.active_cell_count = None
+        # Calculated by get_datetime().
+        self.datetime = None
+
+    def get_datetime(self):
+        """Returns the wall clock time the frame was captured.  Only needed for filenames
+        and e-mail text, so it is calculated on demand.  It is calculated once, so the
+        saved image, e-mail attachment, and footage index of a frame all use the same time.
+        """
+        if self.datetime is None:
+            self.datetime = monotonic_ns_to_datetime(self.time_ns)
+        return self.datetime
+
+
+class CaptureThread(threading.Thread):
+    """Reads frames from a capture device as fast as the device delivers them, timestamps
+    each frame on arrival, and stores it in a fixed size ring buffer.  This keeps the
+    device's own queue drained (and therefore the timestamps accurate) even when processing
+    a frame takes longer than the camera's frame period.
+
+    While a skip interval is set, frames that arrive sooner than that after the last
+    buffered frame are only grabbed and never retrieved, so they are not decoded.
+    """
+
+    def __init__(self, capture_device, get_time, buffer_size, drop_policy,
+                 block_when_full=False):
+        """capture_device: An object with cv2.VideoCapture compatible grab() and retrieve()
+          methods.
+        get_time: A function returning the capture time, in monotonic nanoseconds, of a
+          frame that was just read.
+        buffer_size: The maximum number of frames held in the ring buffer.
+        drop_policy: Which frame to discard when the buffer is full.  DROP_OLDEST discards
+          the oldest buffered frame.  DROP_NEWEST discards the frame that was just read.
+        block_when_full: Wait for space in the buffer instead of dropping frames.  Used when
+          replaying recorded footage where every frame should be processed.
+        """
+        threading.Thread.__init__(self, name='capture', daemon=True)
+        self.logger = logging.getLogger(__name__)
+
+        self.capture_device = capture_device
+        self.get_time = get_time
+        self.drop_policy = drop_policy
+        self.block_when_full = block_when_full
+
+        self.frames = collections.deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.finished = False
+        self.dropped_frame_count = 0
+        # Set by the main thread.  None to buffer every frame.
+        self.skip_interval_ns = None
+        # Only used by the capture thread.
+        self.last_buffered_time = None
+        self.skipped_frame_count = 0
+
+    def set_skip_interval(self, skip_interval_ns):
+        """Sets how far apart, in nanoseconds, buffered frames must be.  Frames in between
+        are skipped without being decoded.  None buffers every frame.
+        """
+        self.skip_interval_ns = skip_interval_ns
+
+    def run(self):
+        """Reads frames until the device stops delivering them or stop() is called."""
+        try:
+            while not self.stopping:
+                if not self.capture_device.grab():
+                    self.logger.warning('Could not read a frame from the capture device.')
+                    break
+                frame_time = self.get_time()
+
+                skip_interval_ns = self.skip_interval_ns
+                if skip_interval_ns is not None and self.last_buffered_time is not None and \
+                        frame_time - self.last_buffered_time < skip_interval_ns:
+                    self.skipped_frame_count += 1
+                    continue
+                return_value, image = self.capture_device.retrieve()
+                if not return_value:
+                    self.logger.warning('Could not read a frame from the capture device.')
+                    break
+
+                with self.condition:
+                    if len(self.frames) == self.frames.maxlen:
+                        if self.block_when_full:
+                            while len(self.frames) == self.frames.maxlen and \
+                                    not self.stopping:
+                                self.condition.wait()
+                        elif self.drop_policy == DROP_NEWEST:
+                            self.dropped_frame_count += 1
+                            continue
+                        else:
+                            # The deque discards the oldest frame on append.
+                            self.dropped_frame_count += 1
+                    self.frames.append((frame_time, image))
+                    self.last_buffered_time = frame_time
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def get_frame(self):
+        """Waits for and returns the oldest buffered frame as a (time, image) tuple.  Returns
+        None once the device has stopped delivering frames and the buffer is empty.
+        """
+        with self.condition:
+            while not self.frames and not self.finished:
+                self.condition.wait()
+            if not self.frames:
+                return None
+            captured_frame = self.frames.popleft()
+            self.condition.notify_all()
+            return captured_frame
+
+    def stop(self):
+        """Asks the thread to stop reading frames and waits for it to exit."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.join(STOP_TIMEOUT)
+        if self.is_alive():
+            self.logger.warning('Capture thread did not stop within %d seconds.',
+                                STOP_TIMEOUT)
@@ -0,0 +1,109 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['ImageWriterPool', 'WAIT_WHEN_FULL', 'DROP_WHEN_FULL']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import logging
+import queue
+import threading
+import time
+import cv2
+import mjpegcapture
+
+# What to do when the write queue is full.
+WAIT_WHEN_FULL = 'wait'
+DROP_WHEN_FULL = 'drop'
+
+
+class ImageWriterPool():
+    """Encodes and writes images to disk in background threads so the capture loop does not
+    wait on JPEG encoding or slow storage.  OpenCV releases the GIL while encoding and
+    writing, so more than one thread can be useful on multi-core machines.
+    """
+
+    def __init__(self, thread_count, queue_size, full_policy, stage_timer):
+        """Starts the writer threads.
+
+        thread_count: The number of writer threads.
+        queue_size: The maximum number of images waiting to be written.
+        full_policy: WAIT_WHEN_FULL to make write() wait for space in the queue or
+          DROP_WHEN_FULL to discard the image.
+        stage_timer: The StageTimer that encode and write times are recorded in.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.full_policy = full_policy
+        self.stage_timer = stage_timer
+        self.dropped_image_count = 0
+
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        for thread_number in range(thread_count):
+            thread = threading.Thread(
+                target=self._write_images, name='image-writer-%d' % thread_number,
+                daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, pathname, image):
+        """Queues an image to be encoded and written.  The image must not be modified
+        afterward.
+
+        pathname: Where the image is written.  The extension determines the image format.
+        image: The image to write.  A mjpegcapture.MjpegImage is written as the camera's
+          JPEG without being encoded again.  An already encoded image (a one dimensional
+          uint8 array) is written as is.
+        """
+        if self.full_policy == DROP_WHEN_FULL:
+            try:
+                self.write_queue.put_nowait((pathname, image))
+            except queue.Full:
+                self.dropped_image_count += 1
+                self.logger.warning('Image write queue is full. Not saving %s.', pathname)
+        else:
+            self.write_queue.put((pathname, image))
+
+    def close(self):
+        """Writes every queued image and then stops the writer threads."""
+        self.logger.info('Flushing %d queued images.', self.write_queue.qsize())
+        for _ in self.threads:
+            self.write_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _write_images(self):
+        """The body of each writer thread.  Writes images until a None is dequeued."""
+        while True:
+            queued_image = self.write_queue.get()
+            if queued_image is None:
+                break
+            pathname, image = queued_image
+
+            stage_name = 'cv2.imwrite'
+            start_time = time.perf_counter()
+            try:
+                if isinstance(image, mjpegcapture.MjpegImage):
+                    image = image.jpeg
+                if image.ndim == 1:
+                    stage_name = 'encoded_image.tofile'
+                    image.tofile(pathname)
+                elif not cv2.imwrite(pathname, image):
+                    self.logger.error('Failed to write image %s.', pathname)
+            except Exception as exception:  # pylint: disable=broad-except
+                self.logger.error('Failed to write image %s. %s: %s', pathname,
+                                  type(exception).__name__, str(exception))
+            self.stage_timer.record(stage_name, time.perf_counter() - start_time)
@@ -0,0 +1,436 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Hands images and e-mails from a camera's subprocess to its media worker process, which
+rotates, encodes, saves, and e-mails them on another core.  Each image is copied into shared
+memory once.  Only small messages describing the images are sent through a socket, so
+images are never pickled.
+"""
+
+__all__ = ['MediaWorker', 'MediaWorkerClient', 'MediaWorkerException', 'SharedImageBuffer',
+           'get_media_metric_values', 'get_media_worker_metrics_pathname',
+           'start_media_worker']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import array
+import collections
+import logging
+import mmap
+import os
+import pickle
+import select
+import socket
+import subprocess
+import tempfile
+import time
+import cv2
+import numpy
+import imagewriter
+import mjpegcapture
+import pretrigger
+
+# The shared memory is a file in this directory that is removed as soon as it is created,
+#   so it disappears when both processes exit, however they exit.
+SHARED_MEMORY_DIR = '/dev/shm'
+# The start of the shared memory holds the count of images the media worker has taken.
+HEADER_BYTES = 64
+# The largest message sent through the socket.  Images are not sent through the socket.
+MESSAGE_MAX_BYTES = 65536
+# How often a camera subprocess waiting for shared memory checks whether some was freed.
+WAIT_POLL_SECONDS = .005
+
+# Messages sent to the media worker.
+SHARED_BUFFER = 'shared_buffer'
+WRITE_IMAGE = 'write_image'
+BUFFER_IMAGE = 'buffer_image'
+QUEUE_EMAIL = 'queue_email'
+
+# Kinds of images in the shared memory.
+DECODED_IMAGE = 'decoded'
+ENCODED_IMAGE = 'encoded'
+MJPEG_IMAGE = 'mjpeg'
+
+# Where an image is in the shared memory and how to interpret it.  mjpeg_size is the
+#   (reduction, width, height) of an MJPEG image and None otherwise.
+ImageDescription = collections.namedtuple(
+    'ImageDescription', ['offset', 'shape', 'dtype', 'kind', 'mjpeg_size'])
+
+
+class MediaWorkerException(Exception):
+    """Indicates the media worker process stopped unexpectedly."""
+
+
+def start_media_worker(media_worker_pathname, arguments, preexec_fn=None):
+    """Starts a media worker process connected to a new socket.
+
+    media_worker_pathname: The media worker program.
+    arguments: The media worker's command line arguments, other than --socket-fd.
+    preexec_fn: Called in the child process before the program starts.  None for nothing.
+    Returns a (subprocess.Popen, socket) tuple.  The socket is passed to the camera's
+      subprocess with --media-worker-fd and then closed.
+    """
+    client_socket, worker_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        process = subprocess.Popen(
+            [media_worker_pathname] + arguments + [
+                '--socket-fd', str(worker_socket.fileno())],
+            pass_fds=(worker_socket.fileno(),), preexec_fn=preexec_fn)
+    except Exception:
+        client_socket.close()
+        raise
+    finally:
+        worker_socket.close()
+    return process, client_socket
+
+
+def get_media_worker_metrics_pathname(metrics_pathname):
+    """Returns the file a media worker writes its metrics to given the file its camera's
+    subprocess writes to.  A period cannot be in a camera name, so it never matches another
+    camera's file.  (e.g. '/run/watchman/metrics-front.media-worker.prom')
+    """
+    return '%s.media-worker.prom' % os.path.splitext(metrics_pathname)[0]
+
+
+def get_media_metric_values(image_writer, email_sender):
+    """Returns the (name, type, help, value) of each metric of the threads that save and
+    e-mail images.
+
+    image_writer: The imagewriter.ImageWriterPool, or None if there is not one yet.
+    email_sender: The emailsender.EmailSender.
+    """
+    metric_values = [
+        ('watchman_email_queue_depth', 'gauge',
+         'E-mail images and e-mails waiting for the e-mail sender.',
+         email_sender.email_queue.qsize()),
+        ('watchman_email_buffer_bytes', 'gauge',
+         'Bytes of encoded images buffered for the next e-mail.',
+         email_sender.buffered_byte_count),
+        ('watchman_dropped_email_images_total', 'counter',
+         'E-mail images dropped because email_image_buffer_max_bytes or email_max_bytes '
+         'was reached.',
+         email_sender.dropped_attachment_count)]
+    if image_writer is not None:
+        metric_values.extend([
+            ('watchman_image_write_queue_depth', 'gauge',
+             'Images waiting to be saved locally.', image_writer.write_queue.qsize()),
+            ('watchman_dropped_images_total', 'counter',
+             'Locally saved images dropped because the write queue was full.',
+             image_writer.dropped_image_count)])
+    return metric_values
+
+
+class SharedImageBuffer():
+    """Shared memory that images are copied into by a camera's subprocess and taken from by
+    its media worker.  Space is allocated by the subprocess in order and freed in the same
+    order as the media worker takes the images, so it is used as a ring.  The media worker
+    frees space by increasing a count stored at the start of the memory, so nothing has to
+    be sent back to the subprocess.
+    """
+
+    def __init__(self, size, fd=None):
+        """Creates or maps the shared memory.
+
+        size: The number of bytes available for images.
+        fd: The file descriptor of shared memory created by another SharedImageBuffer.
+          None to create new shared memory.
+        """
+        self.size = size
+        self.shared_file = None
+        if fd is None:
+            self.shared_file = tempfile.TemporaryFile(dir=SHARED_MEMORY_DIR)
+            os.ftruncate(self.shared_file.fileno(), HEADER_BYTES + size)
+            fd = self.shared_file.fileno()
+        self.memory = mmap.mmap(fd, HEADER_BYTES + size)
+        # Only written by the media worker.
+        self.taken_image_count = numpy.ndarray((1,), numpy.uint64, buffer=self.memory)
+
+        # Only used by the camera's subprocess.
+        self.allocation_sizes = collections.deque()
+        self.freed_image_count = 0
+        self.used_bytes = 0
+        self.write_offset = 0
+
+    def fileno(self):
+        """Returns the file descriptor of the shared memory."""
+        return self.shared_file.fileno()
+
+    def allocate(self, byte_count):
+        """Reserves space for an image.  Space is reused once the media worker takes the
+        images before it.
+
+        byte_count: The size of the image in bytes.
+        Returns the offset of the space or None if there is not enough free space.
+        """
+        taken_image_count = int(self.taken_image_count[0])
+        while self.freed_image_count < taken_image_count:
+            self.used_bytes -= self.allocation_sizes.popleft()
+            self.freed_image_count += 1
+        if not self.allocation_sizes:
+            self.write_offset = 0
+
+        # An image is never split across the end of the memory.  The space skipped at the
+        #   end is freed along with the image.
+        offset = self.write_offset
+        skipped_byte_count = 0
+        if offset + byte_count > self.size:
+            skipped_byte_count = self.size - offset
+            offset = 0
+        if self.used_bytes + skipped_byte_count + byte_count > self.size:
+            return None
+
+        self.allocation_sizes.append(skipped_byte_count + byte_count)
+        self.used_bytes += skipped_byte_count + byte_count
+        self.write_offset = offset + byte_count
+        return offset
+
+    def get_array(self, offset, shape, dtype):
+        """Returns a numpy array backed by the shared memory."""
+        return numpy.ndarray(shape, dtype, buffer=self.memory, offset=HEADER_BYTES + offset)
+
+    def free_oldest(self):
+        """Frees the space of the oldest image not yet taken.  Called by the media worker
+        once it has its own copy of the image.
+        """
+        self.taken_image_count[0] += 1
+
+    def close(self):
+        """Unmaps the shared memory."""
+        self.taken_image_count = None
+        self.memory.close()
+        if self.shared_file is not None:
+            self.shared_file.close()
+
+
+class MediaWorkerClient():
+    """Sends images and e-mails from a camera's subprocess to its media worker.  Has the
+    write() method of ImageWriterPool and the buffer_image() and queue_email() methods of
+    EmailSender, so the capture loop uses it in their place.  Copying an image into shared
+    memory is the only work left in the capture loop.
+    """
+
+    def __init__(self, worker_socket, buffer_bytes, full_policy, stage_timer,
+                 worker_process=None):
+        """Creates the shared memory and sends it to the media worker.
+
+        worker_socket: The socket connected to the media worker.
+        buffer_bytes: The size of the shared memory.
+        full_policy: imagewriter.WAIT_WHEN_FULL to wait for the media worker to free space
+          or imagewriter.DROP_WHEN_FULL to discard an image that does not fit.
+        stage_timer: The StageTimer that copy times are recorded in.
+        worker_process: The subprocess.Popen of a media worker this process started itself.
+          Waited for when closed.  None if the media worker is supervised by watchmand.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.worker_socket = worker_socket
+        self.full_policy = full_policy
+        self.stage_timer = stage_timer
+        self.worker_process = worker_process
+        self.dropped_image_count = 0
+        self.dropped_attachment_count = 0
+
+        self.shared_buffer = SharedImageBuffer(buffer_bytes)
+        fds = array.array('i', [self.shared_buffer.fileno()])
+        self._send((SHARED_BUFFER, buffer_bytes), [
+            (socket.SOL_SOCKET, socket.SCM_RIGHTS, fds.tobytes())])
+
+    def write(self, pathname, image):
+        """Sends an image to be rotated, encoded, and written.  Returns once it is copied.
+
+        pathname: Where the image is written.
+        image: The unrotated frame as a decoded image or a mjpegcapture.MjpegImage, or an
+          encoded JPEG (a one dimensional uint8 array) that is written as is.
+        """
+        if not self._send_image(WRITE_IMAGE, pathname, image):
+            self.dropped_image_count += 1
+            self.logger.warning('Media worker buffer is full. Not saving %s.', pathname)
+
+    def buffer_image(self, filename, image):
+        """Sends an image to be rotated and encoded for the next e-mail sent with
+        include_buffered_images.  Returns once it is copied.
+
+        filename: The attachment filename.
+        image: Same as for write().
+        """
+        if not self._send_image(BUFFER_IMAGE, filename, image):
+            self.dropped_attachment_count += 1
+            self.logger.warning('Media worker buffer is full. Not attaching %s.', filename)
+
+    def queue_email(self, subject, body, include_buffered_images=False):
+        """Sends an e-mail to be queued with gpgmailer.  Arguments are the same as
+        EmailSender.queue_email.
+        """
+        self._send((QUEUE_EMAIL, subject, body, include_buffered_images))
+
+    def close(self):
+        """Tells the media worker there is nothing more to send.  If this process started
+        the media worker, waits for it to finish.  Can be called more than once.
+        """
+        if self.worker_socket is None:
+            return
+        try:
+            self.worker_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass  # The media worker already exited.
+        if self.worker_process is not None:
+            self.worker_process.wait()
+        self.worker_socket.close()
+        self.worker_socket = None
+        self.shared_buffer.close()
+
+    def _send_image(self, message_type, name, image):
+        """Copies an image into the shared memory and sends its description.
+
+        message_type: WRITE_IMAGE or BUFFER_IMAGE.
+        name: The pathname or filename of the image.
+        image: The image to send.
+        Returns False if the image did not fit in the shared memory.
+        """
+        mjpeg_size = None
+        if isinstance(image, mjpegcapture.MjpegImage):
+            kind = MJPEG_IMAGE
+            mjpeg_size = (image.reduction, image.width, image.height)
+            image = image.jpeg
+        elif image.ndim == 1:
+            kind = ENCODED_IMAGE
+        else:
+            kind = DECODED_IMAGE
+
+        with self.stage_timer.time('media_worker_client.copy_image'):
+            offset = self._allocate(image.nbytes)
+            if offset is None:
+                return False
+            shared_image = self.shared_buffer.get_array(offset, image.shape, image.dtype)
+            numpy.copyto(shared_image, image)
+
+        self._send((message_type, name, ImageDescription(
+            offset, image.shape, image.dtype.str, kind, mjpeg_size)))
+        return True
+
+    def _allocate(self, byte_count):
+        """Reserves shared memory for an image, waiting for the media worker to free some
+        if full_policy is to wait.  Returns the offset or None if the image is dropped.
+        """
+        while True:
+            offset = self.shared_buffer.allocate(byte_count)
+            if offset is not None or self.full_policy == imagewriter.DROP_WHEN_FULL or \
+                    byte_count > self.shared_buffer.size:
+                return offset
+            # The media worker never sends anything, so the socket is only readable once
+            #   the media worker has exited.
+            readable_sockets, _, _ = select.select(
+                [self.worker_socket], [], [], WAIT_POLL_SECONDS)
+            if readable_sockets and not self.worker_socket.recv(1):
+                raise MediaWorkerException('The media worker exited.')
+
+    def _send(self, message, ancillary_data=()):
+        """Sends a message to the media worker."""
+        try:
+            self.worker_socket.sendmsg([pickle.dumps(message)], ancillary_data)
+        except OSError as os_error:
+            raise MediaWorkerException('Could not send to the media worker. %s: %s' % (
+                type(os_error).__name__, str(os_error)))
+
+
+class MediaWorker():
+    """Receives images and e-mails from a camera's subprocess and hands them to an
+    ImageWriterPool and an EmailSender.  Images are rotated as they are taken out of the
+    shared memory, which also makes this process's own copy.
+    """
+
+    def __init__(self, worker_socket, rotation_angle, image_writer, email_sender,
+                 stage_timer):
+        """worker_socket: The socket connected to the camera's subprocess.
+        rotation_angle: How far to rotate frames clockwise.  0, 90, 180, or 270.
+        image_writer: The imagewriter.ImageWriterPool that saves images.
+        email_sender: The emailsender.EmailSender that e-mails images.
+        stage_timer: The StageTimer that rotation times are recorded in.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.worker_socket = worker_socket
+        self.rotation_angle = rotation_angle
+        self.image_writer = image_writer
+        self.email_sender = email_sender
+        self.stage_timer = stage_timer
+        self.shared_buffer = None
+
+    def run(self):
+        """Handles messages until the camera's subprocess closes the socket."""
+        self._receive_shared_buffer()
+        try:
+            while True:
+                message = self.worker_socket.recv(MESSAGE_MAX_BYTES)
+                if not message:
+                    break
+                message = pickle.loads(message)
+                if message[0] == WRITE_IMAGE:
+                    self.image_writer.write(message[1], self._take_image(message[2]))
+                elif message[0] == BUFFER_IMAGE:
+                    self.email_sender.buffer_image(message[1], self._take_image(message[2]))
+                else:
+                    self.email_sender.queue_email(*message[1:])
+        finally:
+            self.shared_buffer.close()
+
+    def _receive_shared_buffer(self):
+        """Receives and maps the shared memory created by the camera's subprocess."""
+        fds = array.array('i')
+        message, ancillary_data, _, _ = self.worker_socket.recvmsg(
+            MESSAGE_MAX_BYTES, socket.CMSG_LEN(fds.itemsize))
+        if not message:
+            raise MediaWorkerException('The camera subprocess exited before starting.')
+        for level, ancillary_type, data in ancillary_data:
+            if level == socket.SOL_SOCKET and ancillary_type == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        message_type, size = pickle.loads(message)
+        if message_type != SHARED_BUFFER or len(fds) != 1:
+            raise MediaWorkerException('Did not receive the shared memory.')
+
+        # The mapping keeps the memory open.
+        self.shared_buffer = SharedImageBuffer(size, fds[0])
+        os.close(fds[0])
+
+    def _take_image(self, image_description):
+        """Copies an image out of the shared memory, rotating it if it is a frame, and
+        frees its space.
+
+        image_description: The ImageDescription of the image.
+        Returns the image in a form ImageWriterPool and EmailSender accept.
+        """
+        start_time = time.perf_counter()
+        shared_image = self.shared_buffer.get_array(
+            image_description.offset, image_description.shape, image_description.dtype)
+        if image_description.kind == ENCODED_IMAGE:
+            # Already rotated, scaled, and encoded.  (e.g. pre-trigger images)
+            image = shared_image.copy()
+        elif image_description.kind == MJPEG_IMAGE:
+            image = shared_image.copy()
+            if self.rotation_angle:
+                image = cv2.rotate(cv2.imdecode(image, cv2.IMREAD_COLOR),
+                                   pretrigger.ROTATE_CODES[self.rotation_angle])
+            else:
+                # Saved and e-mailed as the camera's JPEG.
+                reduction, width, height = image_description.mjpeg_size
+                image = mjpegcapture.MjpegImage(image, None, reduction, width, height)
+        elif self.rotation_angle:
+            image = cv2.rotate(shared_image, pretrigger.ROTATE_CODES[self.rotation_angle])
+        else:
+            image = shared_image.copy()
+        del shared_image
+        self.shared_buffer.free_oldest()
+        self.stage_timer.record('media_worker.take_image', time.perf_counter() - start_time)
+        # Each image counts as a frame in the timing report and metrics.
+        self.stage_timer.count_frame()
+        return image
@@ -0,0 +1,163 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Exports metrics in the Prometheus text format.  Each camera subprocess periodically
+writes its metrics to a file and watchmand serves them, along with its own, over HTTP.
+"""
+
+__all__ = ['METRICS_PATHNAME_FORMAT', 'MetricsFileWriter', 'MetricsServer',
+           'format_label_value', 'merge_metrics']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import http.server
+import logging
+import os
+import threading
+import traceback
+
+# Each camera subprocess writes its metrics here.  The directory is only accessible to the
+#   watchman user.
+METRICS_PATHNAME_FORMAT = '/run/watchman/metrics-%s.prom'
+# How often the subprocesses write their metrics.
+WRITE_INTERVAL_SECONDS = 10
+# Metrics are only served locally.
+LISTEN_ADDRESS = '127.0.0.1'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_label_value(value):
+    """Returns a string quoted and escaped for use as a Prometheus label value."""
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def merge_metrics(texts):
+    """Combines several Prometheus text format documents into one.  Samples of the same
+    metric are grouped under a single HELP and TYPE line, which Prometheus requires.
+
+    texts: The documents to combine.
+    Returns the combined document.
+    """
+    # Metric names mapped to their header lines and samples, in the order first seen.
+    metrics = {}
+    current_metric = None
+    for text in texts:
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                current_metric = line.split(' ', 3)[2]
+                header_lines, samples = metrics.setdefault(current_metric, ([], []))
+                if line[:7] not in (header_line[:7] for header_line in header_lines):
+                    header_lines.append(line)
+            elif line and not line.startswith('#'):
+                metrics.setdefault(current_metric, ([], []))[1].append(line)
+
+    lines = []
+    for header_lines, samples in metrics.values():
+        lines.extend(header_lines)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsFileWriter():
+    """Periodically writes a process's metrics to a file in a background thread.  The file
+    is replaced atomically so readers never see a partial file.
+    """
+
+    def __init__(self, pathname, format_metrics):
+        """Starts the writer thread.
+
+        pathname: The file the metrics are written to.
+        format_metrics: A function that returns the metrics in the Prometheus text format.
+          Called from the writer thread.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.pathname = pathname
+        self.format_metrics = format_metrics
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._write_metrics, name='metrics-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Writes the metrics one last time and stops the writer thread."""
+        self.stop_event.set()
+        self.thread.join()
+
+    def _write_metrics(self):
+        """The body of the writer thread.  Writes the metrics every WRITE_INTERVAL_SECONDS
+        until closed.
+        """
+        while not self.stop_event.wait(WRITE_INTERVAL_SECONDS):
+            self._write_metrics_file()
+        self._write_metrics_file()
+
+    def _write_metrics_file(self):
+        """Writes the metrics to a temporary file and renames it over the metrics file."""
+        temporary_pathname = '%s.tmp' % self.pathname
+        try:
+            with open(temporary_pathname, 'w') as metrics_file:
+                metrics_file.write(self.format_metrics())
+            os.replace(temporary_pathname, self.pathname)
+        except Exception as exception:  # pylint: disable=broad-except
+            self.logger.error('Could not write metrics to %s. %s: %s', self.pathname,
+                              type(exception).__name__, str(exception))
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Responds to every GET request with the current metrics."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Sends the metrics."""
+        try:
+            body = self.server.format_metrics().encode('utf-8')
+        except Exception as exception:  # pylint: disable=broad-except
+            self.server.logger.error('Could not format metrics. %s: %s\n%s',
+                                     type(exception).__name__, str(exception),
+                                     traceback.format_exc())
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Logs requests at debug level instead of writing them to stderr."""
+        self.server.logger.debug('Metrics request from %s: %s', self.address_string(),
+                                 format % args)
+
+
+class MetricsServer():
+    """Serves metrics over HTTP on the local host in a background thread so Prometheus can
+    scrape them.
+    """
+
+    def __init__(self, port, format_metrics):
+        """Starts listening and starts the server thread.
+
+        port: The TCP port to listen on.
+        format_metrics: A function that returns the metrics in the Prometheus text format.
+          Called from the server thread.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.http_server = http.server.HTTPServer((LISTEN_ADDRESS, port),
+                                                  _MetricsRequestHandler)
+        self.http_server.format_metrics = format_metrics
+        self.http_server.logger = self.logger
+        self.thread = threading.Thread(target=self.http_server.serve_forever,
+                                       name='metrics-server', daemon=True)
+        self.thread.start()
+        self.logger.info('Serving metrics at http://%s:%d/metrics.', LISTEN_ADDRESS, port)
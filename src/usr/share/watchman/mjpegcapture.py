@@ -0,0 +1,184 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Captures MJPEG frames without re-encoding them.  The camera's own JPEG is kept for
+saving and e-mailing while a reduced size copy is decoded for motion detection.
+"""
+
+__all__ = ['MjpegCaptureDevice', 'MjpegImage', 'choose_reduction', 'open_mjpeg_camera']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import logging
+import cv2
+
+# The power of two reductions libjpeg can apply while decoding, with the matching imdecode
+#   flags for color and grayscale.  Reducing during the decode skips most of the work.
+REDUCED_DECODE_FLAGS = {
+    1: (cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE),
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+}
+
+
+def choose_reduction(scale):
+    """Returns the largest reduction that libjpeg can decode with that still leaves at least
+    the requested scale.
+
+    scale: The fraction of the full width and height that is needed, from 0 to 1.
+    """
+    reduction = 1
+    for candidate_reduction in REDUCED_DECODE_FLAGS:
+        if 1.0 / candidate_reduction >= scale:
+            reduction = max(reduction, candidate_reduction)
+    return reduction
+
+
+def open_mjpeg_camera(video_device_number):
+    """Opens a camera and asks it for undecoded MJPEG frames.
+
+    video_device_number: The number of the /dev/video device.
+    Returns the cv2.VideoCapture.
+    """
+    camera = cv2.VideoCapture(video_device_number, cv2.CAP_V4L2)
+    mjpeg_fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+    camera.set(cv2.CAP_PROP_FOURCC, mjpeg_fourcc)
+    # Return the raw frame buffer instead of a decoded BGR image.
+    camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    if int(camera.get(cv2.CAP_PROP_FOURCC)) != mjpeg_fourcc:
+        camera.release()
+        raise ValueError('Video device %d does not support MJPEG.' % video_device_number)
+    return camera
+
+
+class MjpegImage():
+    """A captured frame as the JPEG the camera sent plus a reduced size decoded copy."""
+
+    def __init__(self, jpeg, decoded_image, reduction, width, height):
+        """jpeg: The encoded JPEG as a one dimensional uint8 array.
+        decoded_image: The JPEG decoded at 1/reduction of its full width and height.
+        reduction: How much smaller decoded_image is than the JPEG.  1, 2, 4, or 8.
+        width: The full width of the JPEG in pixels.
+        height: The full height of the JPEG in pixels.
+        """
+        self.jpeg = jpeg
+        self.decoded_image = decoded_image
+        self.reduction = reduction
+        self.width = width
+        self.height = height
+
+    def decode(self):
+        """Returns the full resolution color image."""
+        return cv2.imdecode(self.jpeg, cv2.IMREAD_COLOR)
+
+    def decode_to_width(self, maximum_width):
+        """Returns the color image scaled down proportionally to be no wider than
+        maximum_width.  As much of the scaling as possible is done while decoding.
+        """
+        if self.width <= maximum_width:
+            return self.decode()
+
+        reduction = choose_reduction(maximum_width / self.width)
+        image = cv2.imdecode(self.jpeg, REDUCED_DECODE_FLAGS[reduction][0])
+        current_image_height, current_image_width = image.shape[:2]
+        if current_image_width > maximum_width:
+            desired_image_height = int(maximum_width * (current_image_height /
+                                                        current_image_width))
+            image = cv2.resize(image, (maximum_width, desired_image_height))
+        return image
+
+    def get_jpeg(self, maximum_width):
+        """Returns a JPEG no wider than maximum_width.  The original JPEG is returned as is
+        if it is narrow enough.  Otherwise, it is scaled down and encoded again.
+        """
+        if self.width <= maximum_width:
+            return self.jpeg
+
+        return_value, small_jpeg = cv2.imencode('.jpg', self.decode_to_width(maximum_width))
+        return small_jpeg
+
+
+class MjpegCaptureDevice():
+    """Wraps a device that returns encoded JPEG frames so that read() and retrieve() return
+    MjpegImage objects.  The reduced size decode happens in the capture thread, off the main
+    loop, and is skipped for frames that are only grabbed.
+    """
+
+    def __init__(self, jpeg_device, reduction, grayscale):
+        """jpeg_device: An object with cv2.VideoCapture compatible grab() and retrieve()
+          methods that return encoded JPEGs.
+        reduction: How much smaller the decoded copy is than the JPEG.  1, 2, 4, or 8.
+        grayscale: Whether the decoded copy is grayscale instead of color.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.jpeg_device = jpeg_device
+        self.reduction = reduction
+        self.decode_flag = REDUCED_DECODE_FLAGS[reduction][1 if grayscale else 0]
+        # Learned from the first frame.
+        self.width = None
+        self.height = None
+
+    def read(self):
+        """Returns a (success, MjpegImage) tuple for the next frame, like
+        cv2.VideoCapture.read.
+        """
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def grab(self):
+        """Reads the next JPEG from the device without decoding it, like
+        cv2.VideoCapture.grab.  Returns whether a frame was read.
+        """
+        return self.jpeg_device.grab()
+
+    def retrieve(self):
+        """Returns a (success, MjpegImage) tuple for the JPEG read by grab(), like
+        cv2.VideoCapture.retrieve.  A corrupt JPEG is replaced by the next frame.
+        """
+        while True:
+            return_value, jpeg = self.jpeg_device.retrieve()
+            if not return_value:
+                return False, None
+            jpeg = jpeg.reshape(-1)
+
+            # Cameras occasionally send a corrupt frame.  Skip it rather than stopping.
+            if self.width is None:
+                # JPEG dimensions are in the header, but OpenCV has no way to read just the
+                #   header, so the first frame is decoded at full size once.
+                full_image = cv2.imdecode(jpeg, cv2.IMREAD_GRAYSCALE)
+                if full_image is None:
+                    self.logger.warning('Could not decode an MJPEG frame.')
+                    if not self.grab():
+                        return False, None
+                    continue
+                self.height, self.width = full_image.shape[:2]
+                self.logger.info('Capturing %dx%d MJPEG frames. Decoding at 1/%d size for '
+                                 'motion detection.', self.width, self.height,
+                                 self.reduction)
+
+            decoded_image = cv2.imdecode(jpeg, self.decode_flag)
+            if decoded_image is None:
+                self.logger.warning('Could not decode an MJPEG frame.')
+                if not self.grab():
+                    return False, None
+                continue
+            return True, MjpegImage(
+                jpeg, decoded_image, self.reduction, self.width, self.height)
+
+    def release(self):
+        """Releases the wrapped device."""
+        self.jpeg_device.release()
@@ -0,0 +1,51 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['MovementWindow']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import collections
+
+
+class MovementWindow():
+    """Remembers the times of the most recent different frames to decide whether there have
+    been enough of them, recently enough, to count as motion.
+    """
+
+    def __init__(self, prior_movement_count, time_threshold_ns):
+        """prior_movement_count: How many earlier different frames must be within
+          time_threshold_ns of a different frame for it to count as motion.  0 makes every
+          different frame count as motion.
+        time_threshold_ns: The time window in nanoseconds.
+        """
+        self.prior_movement_count = prior_movement_count
+        self.time_threshold_ns = time_threshold_ns
+        # Oldest first.  Only the last prior_movement_count times are kept.
+        self.movement_times = collections.deque(maxlen=max(prior_movement_count, 1))
+
+    def add_movement(self, time_ns):
+        """Records a different frame.
+
+        time_ns: The frame's capture time in monotonic nanoseconds.
+        Returns whether the frame counts as motion.
+        """
+        if self.prior_movement_count < 1:
+            return True
+
+        motion_detected = len(self.movement_times) == self.prior_movement_count and \
+            time_ns - self.movement_times[0] < self.time_threshold_ns
+        self.movement_times.append(time_ns)
+        return motion_detected
@@ -0,0 +1,292 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tunes the motion thresholds against recorded clips labelled with whether they contain
+motion.  Each clip is replayed once to record the abs_diff_mean_total of every frame.  The
+thresholds only decide what is done with those values, so every combination of thresholds
+is then evaluated from the recorded values without subtracting the background again.
+"""
+
+__all__ = ['DifferenceCache', 'LabelledClip', 'SWEPT_OPTIONS', 'SweepResult',
+           'count_motion_events', 'create_parameter_combinations', 'format_tradeoff_table',
+           'parse_sweep_values', 'read_clip_labels', 'sweep_parameters']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import argparse
+import collections
+import hashlib
+import itertools
+import multiprocessing
+import os
+import numpy
+import framecapture
+import movementwindow
+
+# The options that can be swept, mapped to a function that parses one value.
+SWEPT_OPTIONS = collections.OrderedDict([
+    ('pixel_difference_threshold', float),
+    ('prior_movements_per_threshold', int),
+    ('movement_time_threshold', float)])
+# Labels used in the clip list file.
+MOTION_LABEL = 'motion'
+NO_MOTION_LABEL = 'none'
+SECONDS_PER_HOUR = 3600
+
+LabelledClip = collections.namedtuple('LabelledClip', ['pathname', 'has_motion'])
+# parameters is a dictionary of option names to values.  motion_event_counts has an entry
+#   for each clip, in order.
+SweepResult = collections.namedtuple('SweepResult', ['parameters', 'motion_event_counts'])
+
+# Set in each sweep process by _initialize_sweep_process so the recorded values are only
+#   sent to each process once.
+_sweep_state = None
+
+
+def read_clip_labels(pathname):
+    """Reads the list of clips to tune against.  Each line is a label, 'motion' or 'none',
+    followed by the pathname of a video file or directory of images.  Relative pathnames
+    are relative to the list's directory.  Blank lines and lines starting with # are
+    ignored.  (e.g. 'motion clips/mail-carrier.avi')
+
+    pathname: The clip list file.
+    Returns a list of LabelledClip tuples.
+    """
+    clips = []
+    with open(pathname) as labels_file:
+        for line_number, line in enumerate(labels_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            if len(fields) != 2 or fields[0] not in (MOTION_LABEL, NO_MOTION_LABEL):
+                raise ValueError('Line %d of %s must be a label, %s or %s, followed by a '
+                                 'clip pathname.' % (line_number, pathname, MOTION_LABEL,
+                                                     NO_MOTION_LABEL))
+            clip_pathname = os.path.join(os.path.dirname(pathname), fields[1])
+            clips.append(LabelledClip(clip_pathname, fields[0] == MOTION_LABEL))
+
+    if not clips:
+        raise ValueError('%s does not list any clips.' % pathname)
+    return clips
+
+
+def parse_sweep_values(text):
+    """Parses a command line option and the values to sweep it over.  Used as an argparse
+    type.  (e.g. 'pixel_difference_threshold=3,4.5,6')
+
+    Returns an (option name, list of values) tuple.
+    """
+    option_name, _, value_list = text.partition('=')
+    option_name = option_name.strip()
+    if option_name not in SWEPT_OPTIONS:
+        raise argparse.ArgumentTypeError('Only %s can be swept.' % ', '.join(SWEPT_OPTIONS))
+    try:
+        values = [SWEPT_OPTIONS[option_name](value) for value in value_list.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            '%s must be a comma separated list of values.' % option_name)
+    if min(values) < 0:
+        raise argparse.ArgumentTypeError('%s values must be 0 or greater.' % option_name)
+    return option_name, values
+
+
+def count_motion_events(frame_differences, pixel_difference_threshold,
+                        prior_movements_per_threshold, movement_time_threshold,
+                        initial_frame_skip_count, stop_threshold):
+    """Counts the motion events WatchmanSubprocess detects in a clip with the given
+    thresholds.  Gives the same result as _detect_motion and the stop check in start_loop,
+    but only the frames over pixel_difference_threshold are looked at one at a time.
+
+    frame_differences: A (times_ns, abs_diff_mean_totals) tuple of arrays with an entry for
+      each frame after the first, as recorded by WatchmanSubprocess.
+    The remaining arguments are the configuration options of the same name.
+    Returns the number of motion events.
+    """
+    times_ns, abs_diff_mean_totals = frame_differences
+    different_frame_indexes = numpy.flatnonzero(
+        abs_diff_mean_totals > pixel_difference_threshold)
+    # The first frame difference is for frame_count 1.
+    different_frame_indexes = different_frame_indexes[
+        different_frame_indexes >= initial_frame_skip_count]
+
+    movement_window = movementwindow.MovementWindow(
+        prior_movements_per_threshold,
+        framecapture.seconds_to_nanoseconds(movement_time_threshold))
+    motion_frame_indexes = numpy.array([
+        frame_index for frame_index in different_frame_indexes
+        if movement_window.add_movement(int(times_ns[frame_index]))], dtype=numpy.int64)
+    if not motion_frame_indexes.size:
+        return 0
+
+    # A new event starts when a frame between two motion frames is more than stop_threshold
+    #   after the first of them.  Times only increase, so only the frame just before the
+    #   second motion frame needs to be checked.
+    previous_motion_indexes = motion_frame_indexes[:-1]
+    next_motion_indexes = motion_frame_indexes[1:]
+    stopped = (next_motion_indexes - 1 > previous_motion_indexes) & (
+        times_ns[next_motion_indexes - 1] - times_ns[previous_motion_indexes] >
+        framecapture.seconds_to_nanoseconds(stop_threshold))
+    return 1 + int(numpy.count_nonzero(stopped))
+
+
+def sweep_parameters(clip_differences, parameter_combinations, initial_frame_skip_count,
+                     stop_threshold, process_count):
+    """Counts the motion events in every clip for every combination of thresholds using a
+    pool of processes.
+
+    clip_differences: The recorded frame_differences of each clip.
+    parameter_combinations: A list of dictionaries of swept option names to values.
+    initial_frame_skip_count: The configured initial_frame_skip_count.
+    stop_threshold: The configured stop_threshold.
+    process_count: The number of processes to use.
+    Returns a list of SweepResult tuples in the order of parameter_combinations.
+    """
+    with multiprocessing.Pool(
+            process_count, initializer=_initialize_sweep_process,
+            initargs=(clip_differences, initial_frame_skip_count, stop_threshold)) as pool:
+        motion_event_counts = pool.map(
+            _count_clip_motion_events, parameter_combinations,
+            chunksize=max(len(parameter_combinations) // (process_count * 4), 1))
+    return [SweepResult(parameters, counts) for parameters, counts in zip(
+        parameter_combinations, motion_event_counts)]
+
+
+def _initialize_sweep_process(clip_differences, initial_frame_skip_count, stop_threshold):
+    """Stores the values shared by every combination in a sweep process."""
+    global _sweep_state  # pylint: disable=global-statement
+    _sweep_state = (clip_differences, initial_frame_skip_count, stop_threshold)
+
+
+def _count_clip_motion_events(parameters):
+    """Returns a list of the number of motion events in each clip for one combination of
+    thresholds.  Runs in a sweep process.
+    """
+    clip_differences, initial_frame_skip_count, stop_threshold = _sweep_state
+    return [count_motion_events(
+        frame_differences, parameters['pixel_difference_threshold'],
+        parameters['prior_movements_per_threshold'], parameters['movement_time_threshold'],
+        initial_frame_skip_count, stop_threshold) for frame_differences in clip_differences]
+
+
+def create_parameter_combinations(configured_values, swept_values):
+    """Returns a list of dictionaries, one for every combination of the swept values.
+
+    configured_values: A dictionary of every swept option name to its configured value.
+      Used for the options that are not swept.
+    swept_values: A list of (option name, list of values) tuples.
+    """
+    option_values = collections.OrderedDict(
+        (option_name, [value]) for option_name, value in configured_values.items())
+    option_values.update(swept_values)
+    return [dict(zip(option_values, combination))
+            for combination in itertools.product(*option_values.values())]
+
+
+def format_tradeoff_table(clips, clip_differences, results):
+    """Formats a table of how many motion clips each combination of thresholds detects and
+    how many false alarms it raises on the clips without motion.  Rows are ordered from the
+    most detected clips to the fewest false alarms.  Rows marked with * are not beaten by
+    any other row on both detections and false alarms.
+
+    clips: The LabelledClip of each clip.
+    clip_differences: The recorded frame_differences of each clip.
+    results: The SweepResult of each combination.
+    Returns the table as a string.
+    """
+    motion_clip_count = sum(1 for clip in clips if clip.has_motion)
+    no_motion_seconds = sum(
+        (times_ns[-1] - times_ns[0]) / framecapture.NANOSECONDS_PER_SECOND
+        for clip, (times_ns, _) in zip(clips, clip_differences)
+        if not clip.has_motion and times_ns.size)
+
+    rows = []
+    for result in results:
+        detected_count = sum(1 for clip, count in zip(clips, result.motion_event_counts)
+                             if clip.has_motion and count)
+        false_alarm_count = sum(count for clip, count in zip(
+            clips, result.motion_event_counts) if not clip.has_motion)
+        rows.append((detected_count, false_alarm_count, result.parameters))
+    rows.sort(key=lambda row: (-row[0], row[1]))
+
+    lines = ['  %10s %10s %10s  %9s %13s %15s' % (
+        'pixel diff', 'prior', 'time (s)', 'detected', 'false alarms', 'alarms / hour')]
+    best_false_alarm_count = None
+    for detected_count, false_alarm_count, parameters in rows:
+        # Rows are ordered by detections, so a row is only beaten if an earlier row had
+        #   fewer false alarms.
+        marker = ' '
+        if best_false_alarm_count is None or false_alarm_count < best_false_alarm_count:
+            marker = '*'
+            best_false_alarm_count = false_alarm_count
+        false_alarms_per_hour = float('nan')
+        if no_motion_seconds:
+            false_alarms_per_hour = false_alarm_count * SECONDS_PER_HOUR / no_motion_seconds
+        lines.append('%s %10g %10d %10g  %4d/%-4d %13d %15.2f' % (
+            marker, parameters['pixel_difference_threshold'],
+            parameters['prior_movements_per_threshold'],
+            parameters['movement_time_threshold'], detected_count, motion_clip_count,
+            false_alarm_count, false_alarms_per_hour))
+    return '\n'.join(lines)
+
+
+class DifferenceCache():
+    """Saves the frame differences recorded for each clip so later sweeps of the same clips
+    skip the replay.  Entries are keyed by the clip file and every configuration option
+    that is not swept, so changing the background subtractor or detection settings replays
+    the clip again.
+    """
+
+    def __init__(self, directory):
+        """directory: Where the recorded values are saved.  Created if needed."""
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def create_key(self, clip_pathname, replay_fps, config_items):
+        """Returns the cache key of a clip.
+
+        clip_pathname: The clip's video file or directory of images.
+        replay_fps: The frame rate used to timestamp the replayed frames, or None.
+        config_items: The (option name, value) tuples of the camera's configuration.
+        """
+        clip_stat = os.stat(clip_pathname)
+        key_text = repr((os.path.abspath(clip_pathname), clip_stat.st_mtime_ns,
+                         clip_stat.st_size, replay_fps, sorted(
+                             (option_name, value) for option_name, value in config_items
+                             if option_name not in SWEPT_OPTIONS)))
+        return hashlib.sha1(key_text.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        """Returns the saved frame differences of a key, or None if there are none."""
+        try:
+            with numpy.load(self._get_pathname(key)) as saved_arrays:
+                return saved_arrays['times_ns'], saved_arrays['abs_diff_mean_totals']
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, frame_differences):
+        """Saves the frame differences of a key.  The file is replaced atomically so an
+        interrupted sweep never leaves a partial entry.
+        """
+        pathname = self._get_pathname(key)
+        temporary_pathname = '%s.tmp.npz' % pathname[:-len('.npz')]
+        times_ns, abs_diff_mean_totals = frame_differences
+        numpy.savez(temporary_pathname, times_ns=times_ns,
+                    abs_diff_mean_totals=abs_diff_mean_totals)
+        os.replace(temporary_pathname, pathname)
+
+    def _get_pathname(self, key):
+        """Returns the file a key's frame differences are saved in."""
+        return os.path.join(self.directory, '%s.npz' % key)
@@ -0,0 +1,156 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['PreTriggerBuffer']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import collections
+import logging
+import math
+import queue
+import threading
+import time
+import cv2
+import framecapture
+import mjpegcapture
+
+# cv2.rotate codes for each clockwise image_rotation_angle.
+ROTATE_CODES = {
+    90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+
+
+class PreTriggerBuffer():
+    """Keeps small JPEGs of the last few seconds of frames so the frames leading up to motion
+    can be e-mailed and saved.  Frames are sampled at a fixed rate, scaled down to the
+    e-mail image width, rotated, and encoded in a background thread.  The buffer holds a
+    fixed number of images, so its memory use is bounded by that number of e-mail sized
+    JPEGs.
+    """
+
+    def __init__(self, seconds, images_per_second, email_image_width, rotation_angle,
+                 stage_timer):
+        """Starts the encoder thread.
+
+        seconds: How many seconds before motion to keep.
+        images_per_second: How many frames per second are kept.
+        email_image_width: The maximum width of the kept images in pixels, after rotation.
+        rotation_angle: How far to rotate the images clockwise.  0, 90, 180, or 270.
+        stage_timer: The StageTimer that encode times are recorded in.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.seconds_ns = framecapture.seconds_to_nanoseconds(seconds)
+        self.sample_interval_ns = framecapture.seconds_to_nanoseconds(
+            1.0 / images_per_second)
+        self.email_image_width = email_image_width
+        self.rotation_angle = rotation_angle
+        self.stage_timer = stage_timer
+        self.last_sample_time_ns = None
+
+        self.images = collections.deque(maxlen=math.ceil(seconds * images_per_second))
+        self.lock = threading.Lock()
+
+        # Only one frame waits to be encoded.  If the encoder falls behind, frames are
+        #   skipped rather than held.
+        self.encode_queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._encode_images, name='pre-trigger',
+                                       daemon=True)
+        self.thread.start()
+
+    def offer(self, time_ns, image):
+        """Queues a frame to be kept if enough time has passed since the last kept frame.
+        Returns immediately.
+
+        time_ns: The frame's capture time in monotonic nanoseconds.
+        image: The full resolution frame as a decoded image or a mjpegcapture.MjpegImage.
+          The image must not be modified afterward.
+        """
+        if self.last_sample_time_ns is not None and \
+                time_ns - self.last_sample_time_ns < self.sample_interval_ns:
+            return
+        self.last_sample_time_ns = time_ns
+
+        try:
+            self.encode_queue.put_nowait((time_ns, image))
+        except queue.Full:
+            self.logger.debug('Pre-trigger encoder is busy. Skipping a frame.')
+
+    def take_images(self, trigger_time_ns):
+        """Removes and returns the kept images from the seconds before a trigger.
+
+        trigger_time_ns: The time motion was detected in monotonic nanoseconds.
+        Returns a list of (time_ns, jpeg) tuples from oldest to newest.
+        """
+        with self.lock:
+            images = [(time_ns, jpeg) for time_ns, jpeg in self.images
+                      if trigger_time_ns - self.seconds_ns <= time_ns <= trigger_time_ns]
+            self.images.clear()
+        return images
+
+    def close(self):
+        """Stops the encoder thread."""
+        self.encode_queue.put(None)
+        self.thread.join()
+
+    def _encode_images(self):
+        """The body of the encoder thread.  Encodes frames until a None is dequeued."""
+        while True:
+            queued_image = self.encode_queue.get()
+            if queued_image is None:
+                break
+            time_ns, image = queued_image
+
+            start_time = time.perf_counter()
+            try:
+                jpeg = self._encode_image(image)
+                with self.lock:
+                    self.images.append((time_ns, jpeg))
+            except Exception as exception:  # pylint: disable=broad-except
+                self.logger.error('Failed to encode pre-trigger image. %s: %s',
+                                  type(exception).__name__, str(exception))
+            self.stage_timer.record('pre_trigger_buffer.encode',
+                                    time.perf_counter() - start_time)
+
+    def _encode_image(self, image):
+        """Scales an image down to the e-mail image width, rotates it, and JPEG encodes it.
+        The image is scaled before it is rotated because rotating a small image is cheaper.
+
+        image: A decoded image or a mjpegcapture.MjpegImage.
+        Returns the encoded JPEG.
+        """
+        # The width after rotation is the height before a quarter turn.
+        width_index = 0 if self.rotation_angle in (90, 270) else 1
+        if isinstance(image, mjpegcapture.MjpegImage):
+            full_size = (image.height, image.width)
+        else:
+            full_size = image.shape[:2]
+        scale = min(self.email_image_width / full_size[width_index], 1.0)
+        # Unrotated, the desired width is the full width scaled by the same amount.
+        maximum_width = int(full_size[1] * scale)
+
+        if isinstance(image, mjpegcapture.MjpegImage):
+            image = image.decode_to_width(maximum_width)
+        elif scale < 1:
+            image = cv2.resize(image, (maximum_width, int(full_size[0] * scale)),
+                               interpolation=cv2.INTER_AREA)
+
+        if self.rotation_angle:
+            image = cv2.rotate(image, ROTATE_CODES[self.rotation_angle])
+
+        return_value, jpeg = cv2.imencode('.jpg', image)
+        return jpeg
@@ -0,0 +1,129 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['SignalProfiler']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import cProfile
+import datetime
+import logging
+import os
+import pstats
+import signal
+import traceback
+
+# The number of functions listed in the summary.
+SUMMARY_FUNCTION_COUNT = 40
+
+
+class SignalProfiler():
+    """Profiles the main thread for a number of seconds when SIGUSR1 is received, so a
+    running daemon can be profiled without restarting it.  When the time is up, SIGALRM
+    stops the profiler and the stats are written to a .pstats file plus a readable .txt
+    summary.  Only the main thread is profiled.  Must be created in the main thread.
+    """
+
+    def __init__(self, output_dir, program_name, seconds, root_function_name):
+        """output_dir: The directory the stats files are written to.
+        program_name: Included in the stats filenames.  (e.g. 'watchman-subprocess-front')
+        seconds: How long to profile for after each SIGUSR1.
+        root_function_name: The name of the loop function running in the main thread.  Its
+          callees are listed separately in the summary.  (e.g. 'start_loop')
+        """
+        self.logger = logging.getLogger(__name__)
+        self.output_dir = output_dir
+        self.program_name = program_name
+        self.seconds = seconds
+        self.root_function_name = root_function_name
+        self.profiler = None
+
+    def install(self):
+        """Installs the SIGUSR1 and SIGALRM handlers."""
+        signal.signal(signal.SIGUSR1, self.handle_start_signal)
+        signal.signal(signal.SIGALRM, self.handle_stop_signal)
+
+    def handle_start_signal(self, signal_number, stack_frame):
+        """Signal handler for SIGUSR1.  Starts profiling unless profiling is already in
+        progress.
+
+        signal_number: The signal received.
+        stack_frame: The stack frame that was interrupted.
+        """
+        if self.profiler is not None:
+            self.logger.warning('SIGUSR1 received while already profiling. Ignoring.')
+            return
+
+        self.logger.info('SIGUSR1 received. Profiling for %d seconds.', self.seconds)
+        self.profiler = cProfile.Profile()
+        # Signal handlers run in the main thread, so this profiles the main thread.
+        self.profiler.enable()
+        signal.setitimer(signal.ITIMER_REAL, self.seconds)
+
+    def handle_stop_signal(self, signal_number, stack_frame):
+        """Signal handler for SIGALRM.  Stops profiling and writes the stats files.
+
+        signal_number: The signal received.
+        stack_frame: The stack frame that was interrupted.
+        """
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        profiler = self.profiler
+        self.profiler = None
+
+        pathname_prefix = os.path.join(self.output_dir, 'profile-%s-%s' % (
+            self.program_name, datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')))
+        try:
+            profiler.dump_stats('%s.pstats' % pathname_prefix)
+            with open('%s.txt' % pathname_prefix, 'w') as summary_file:
+                stats = pstats.Stats(profiler, stream=summary_file)
+                stats.sort_stats('cumulative').print_stats(SUMMARY_FUNCTION_COUNT)
+                self._write_root_callees(stats, summary_file)
+            self.logger.info('Wrote profile to %s.pstats and %s.txt.', pathname_prefix,
+                             pathname_prefix)
+        except Exception as exception:  # pylint: disable=broad-except
+            self.logger.error('Could not write profile %s. %s: %s\n%s', pathname_prefix,
+                              type(exception).__name__, str(exception),
+                              traceback.format_exc())
+
+    def _write_root_callees(self, stats, summary_file):
+        """Writes the functions called directly by the root function, ordered by cumulative
+        time.  The root function was already running when profiling started, so the
+        profiler never saw it called.  Calls made directly by it are the calls with no
+        recorded caller.
+
+        stats: The pstats.Stats of the profile.
+        summary_file: The file the summary is written to.
+        """
+        callees = []
+        for function, (primitive_call_count, call_count, total_time, cumulative_time,
+                       callers) in stats.stats.items():
+            # Subtract the calls that have a recorded caller.
+            for caller_call_count, _, caller_total_time, caller_cumulative_time in \
+                    callers.values():
+                call_count -= caller_call_count
+                total_time -= caller_total_time
+                cumulative_time -= caller_cumulative_time
+            if call_count > 0:
+                callees.append((cumulative_time, call_count, total_time, function))
+
+        summary_file.write('Functions called directly by %s:\n\n' % self.root_function_name)
+        summary_file.write('%10s %10s %10s  %s\n' % (
+            'ncalls', 'tottime', 'cumtime', 'filename:lineno(function)'))
+        for cumulative_time, call_count, total_time, function in sorted(
+                callees, reverse=True):
+            summary_file.write('%10d %10.3f %10.3f  %s\n' % (
+                call_count, total_time, cumulative_time, pstats.func_std_string(function)))
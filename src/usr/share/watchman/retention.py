@@ -0,0 +1,253 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['RetentionManager']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import collections
+import logging
+import os
+import select
+import threading
+import time
+import traceback
+import deviceevents
+
+# Files are indexed once they are completely written.  New subdirectories (e.g. a new day's
+#   directory) are watched as soon as they are created.
+WATCH_EVENT_MASK = \
+    deviceevents.IN_CLOSE_WRITE | deviceevents.IN_MOVED_TO | deviceevents.IN_CREATE
+# When the size limit is exceeded, files are removed until the total is this fraction of the
+#   limit, so files are removed in batches instead of one for every file written.
+LOW_WATER_FRACTION = .9
+# The longest the thread sleeps before checking for files that are too old.
+MAXIMUM_AGE_CHECK_INTERVAL = 60
+SECONDS_PER_DAY = 86400
+
+IndexedFile = collections.namedtuple('IndexedFile', ['modified_time', 'size', 'pathname'])
+
+
+class RetentionManager(threading.Thread):
+    """Removes the oldest saved images and clips when they use too much space or are too
+    old.  The directories and their subdirectories are scanned once on startup.  After that,
+    new files are learned about through inotify, so large directories are never listed
+    again.  Files are kept in an in memory index ordered from oldest to newest.
+    Subdirectories that become empty are removed, except for the newest subdirectory of each
+    directory, which its camera's subprocess might still be writing to.
+    """
+
+    def __init__(self, directories, max_bytes, max_age):
+        """directories: The directories saved images are written to.
+        max_bytes: The maximum total size of the files in bytes.  0 for no limit.
+        max_age: The maximum age of the files in days.  0 for no limit.
+        """
+        threading.Thread.__init__(self, name='retention', daemon=True)
+        self.logger = logging.getLogger(__name__)
+        self.directories = directories
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age * SECONDS_PER_DAY
+
+        self.index = collections.deque()
+        self.total_bytes = 0
+        self.inotify_fd = None
+        self.watched_directories = {}
+        # Files found by scanning a new subdirectory that might also have an event queued.
+        self.scanned_pathnames = set()
+        # The newest subdirectory (e.g. the current day's) of each of the directories.
+        self.newest_subdirectories = {}
+
+    def run(self):
+        """Indexes the directories and then removes files as needed forever."""
+        try:
+            self.inotify_fd = deviceevents.create_inotify_fd()
+            self._index_directories()
+
+            while True:
+                self._remove_files()
+                readable_fds, _, _ = select.select(
+                    [self.inotify_fd], [], [], self._get_wait_seconds())
+                if readable_fds:
+                    self._index_new_files()
+        except Exception as exception:  # pylint: disable=broad-except
+            self.logger.critical('Retention manager stopped. Old images will not be '
+                                 'removed. %s: %s\n%s', type(exception).__name__,
+                                 str(exception), traceback.format_exc())
+
+    def _index_directories(self):
+        """Indexes every file in the directories and their subdirectories.  This is the
+        only time the directories are listed.
+        """
+        indexed_files = []
+        for directory in self.directories:
+            self._scan_directory(directory, indexed_files)
+        indexed_files.sort()
+        self.scanned_pathnames = set()
+
+        self.index = collections.deque(indexed_files)
+        self.total_bytes = sum(indexed_file.size for indexed_file in indexed_files)
+        self.logger.info('Indexed %d saved files using %d bytes.', len(self.index),
+                         self.total_bytes)
+
+        # Skip events for files the scan already found.
+        indexed_pathnames = set(indexed_file.pathname for indexed_file in indexed_files)
+        self._index_new_files(indexed_pathnames)
+
+    def _scan_directory(self, directory, indexed_files):
+        """Watches a directory for new files and then lists it and its subdirectories.  The
+        watch is added before the listing so no files are missed.
+
+        directory: The directory to scan.
+        indexed_files: The list the found files are appended to as IndexedFile tuples.
+        """
+        watch_descriptor = deviceevents.add_inotify_watch(
+            self.inotify_fd, directory, WATCH_EVENT_MASK)
+        self.watched_directories[watch_descriptor] = directory
+
+        with os.scandir(directory) as directory_entries:
+            for directory_entry in directory_entries:
+                if directory_entry.is_dir(follow_symlinks=False):
+                    # Subdirectories are named by date, so the last name is the newest.
+                    if directory in self.directories and directory_entry.path > \
+                            self.newest_subdirectories.get(directory, ''):
+                        self.newest_subdirectories[directory] = directory_entry.path
+                    self._scan_directory(directory_entry.path, indexed_files)
+                elif directory_entry.is_file(follow_symlinks=False):
+                    file_stat = directory_entry.stat(follow_symlinks=False)
+                    indexed_files.append(IndexedFile(
+                        file_stat.st_mtime, file_stat.st_size, directory_entry.path))
+
+    def _index_new_files(self, indexed_pathnames=()):
+        """Adds newly written files to the end of the index and scans new subdirectories.
+
+        indexed_pathnames: Pathnames that are already in the index.
+        """
+        inotify_events = deviceevents.read_inotify_events(self.inotify_fd)
+        for watch_descriptor, mask, name in inotify_events:
+            if mask & deviceevents.IN_Q_OVERFLOW:
+                self.logger.warning('Missed some new file events. Indexing the saved files '
+                                    'again.')
+                self._index_directories()
+                return
+            if mask & deviceevents.IN_IGNORED:
+                # The directory was removed.
+                self.watched_directories.pop(watch_descriptor, None)
+                continue
+            if watch_descriptor not in self.watched_directories:
+                continue
+
+            pathname = os.path.join(
+                self.watched_directories[watch_descriptor], os.fsdecode(name))
+            if mask & deviceevents.IN_ISDIR:
+                self._index_new_directory(pathname)
+                continue
+            if mask & deviceevents.IN_CREATE:
+                continue  # Wait until the file is completely written.
+            if pathname in indexed_pathnames:
+                continue
+            if pathname in self.scanned_pathnames:
+                self.scanned_pathnames.discard(pathname)
+                continue
+            try:
+                file_stat = os.stat(pathname, follow_symlinks=False)
+            except FileNotFoundError:
+                continue  # Already removed.
+            self.index.append(IndexedFile(file_stat.st_mtime, file_stat.st_size, pathname))
+            self.total_bytes += file_stat.st_size
+
+    def _index_new_directory(self, directory):
+        """Watches and scans a newly created or moved in subdirectory.  Files in it are
+        newer than everything already indexed, so they are added to the end of the index.
+        """
+        parent_directory = os.path.dirname(directory)
+        if parent_directory in self.directories:
+            self.newest_subdirectories[parent_directory] = directory
+
+        new_files = []
+        try:
+            self._scan_directory(directory, new_files)
+        except FileNotFoundError:
+            return  # Already removed.
+        new_files.sort()
+
+        # Files written while the directory was being scanned also have events queued.
+        self.scanned_pathnames.update(new_file.pathname for new_file in new_files)
+        self.index.extend(new_files)
+        self.total_bytes += sum(new_file.size for new_file in new_files)
+
+    def _remove_files(self):
+        """Removes the oldest files until the limits are met."""
+        removed_file_count = 0
+        removed_byte_count = 0
+        # Directories that might now be empty.
+        emptied_directories = set()
+
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            target_bytes = self.max_bytes * LOW_WATER_FRACTION
+            while self.index and self.total_bytes > target_bytes:
+                removed_file = self._remove_oldest_file()
+                removed_byte_count += removed_file.size
+                removed_file_count += 1
+                emptied_directories.add(os.path.dirname(removed_file.pathname))
+
+        if self.max_age_seconds:
+            oldest_allowed_time = time.time() - self.max_age_seconds
+            while self.index and self.index[0].modified_time < oldest_allowed_time:
+                removed_file = self._remove_oldest_file()
+                removed_byte_count += removed_file.size
+                removed_file_count += 1
+                emptied_directories.add(os.path.dirname(removed_file.pathname))
+
+        if removed_file_count:
+            self.logger.info('Removed %d old saved files totaling %d bytes.',
+                             removed_file_count, removed_byte_count)
+            self._remove_empty_directories(emptied_directories)
+
+    def _remove_empty_directories(self, directories):
+        """Removes the subdirectories that no longer contain any files.  The configured
+        directories and the newest subdirectory of each are kept, because the subprocesses
+        only create the directory they write to when the day changes.
+
+        directories: The directories files were just removed from.
+        """
+        kept_directories = set(self.newest_subdirectories.values())
+        for directory in directories:
+            if directory in self.directories or directory in kept_directories:
+                continue
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass  # Not empty or already removed.
+
+    def _remove_oldest_file(self):
+        """Removes the oldest file from the disk and the index.  Returns its IndexedFile."""
+        indexed_file = self.index.popleft()
+        self.total_bytes -= indexed_file.size
+        try:
+            os.remove(indexed_file.pathname)
+        except FileNotFoundError:
+            pass  # Removed by someone else.
+        except OSError as os_error:
+            self.logger.error('Could not remove %s. %s: %s', indexed_file.pathname,
+                              type(os_error).__name__, str(os_error))
+        return indexed_file
+
+    def _get_wait_seconds(self):
+        """Returns how long to wait for new files before the oldest file is too old."""
+        if not self.max_age_seconds or not self.index:
+            return MAXIMUM_AGE_CHECK_INTERVAL
+        seconds_until_too_old = \
+            self.index[0].modified_time + self.max_age_seconds - time.time()
+        return min(max(seconds_until_too_old, 0), MAXIMUM_AGE_CHECK_INTERVAL)
@@ -0,0 +1,188 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['StageTimer', 'timed_method']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import bisect
+import functools
+import threading
+import time
+
+# The upper bounds of the histogram buckets stage timings are counted in, in seconds.  Each
+#   stage also has a bucket for anything slower.
+HISTOGRAM_BUCKET_SECONDS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class _Stage():
+    """Accumulates the timings of a single named stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        # Not cumulative.  The last bucket counts calls slower than every bound.
+        self.bucket_counts = [0] * (len(HISTOGRAM_BUCKET_SECONDS) + 1)
+
+    def add(self, elapsed_seconds):
+        """Adds one timed call to the totals."""
+        self.count += 1
+        self.total_seconds += elapsed_seconds
+        if elapsed_seconds > self.max_seconds:
+            self.max_seconds = elapsed_seconds
+        bucket_index = bisect.bisect_left(HISTOGRAM_BUCKET_SECONDS, elapsed_seconds)
+        self.bucket_counts[bucket_index] += 1
+
+
+class _StageContext():
+    """Context manager that adds the time spent inside the 'with' block to a stage."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.stage.add(time.perf_counter() - self.start_time)
+
+
+class StageTimer():
+    """Keeps cheap running totals of how long each stage of the capture loop takes.  Stages
+    are created the first time they are timed and are reported in that order.  time() is
+    only meant for the capture loop's thread.  Other threads use record().
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.contexts = {}
+        self.lock = threading.Lock()
+        self.frame_count = 0
+        self.start_time = time.perf_counter()
+
+    def time(self, stage_name):
+        """Returns a context manager that times the enclosed block as the named stage.  The
+        context managers are reused so timing a stage does not allocate per frame.
+
+        stage_name: The name the stage is reported under.
+        """
+        context = self.contexts.get(stage_name)
+        if context is None:
+            with self.lock:
+                stage = self.stages.get(stage_name)
+                if stage is None:
+                    stage = _Stage(stage_name)
+                    self.stages[stage_name] = stage
+            context = _StageContext(stage)
+            self.contexts[stage_name] = context
+        return context
+
+    def record(self, stage_name, elapsed_seconds):
+        """Adds an externally measured call to the named stage.  Safe to call from any
+        thread.
+
+        stage_name: The name the stage is reported under.
+        elapsed_seconds: How long the call took.
+        """
+        with self.lock:
+            stage = self.stages.get(stage_name)
+            if stage is None:
+                stage = _Stage(stage_name)
+                self.stages[stage_name] = stage
+            stage.add(elapsed_seconds)
+
+    def count_frame(self):
+        """Records that one more frame went through the capture loop."""
+        self.frame_count += 1
+
+    def format_report(self):
+        """Returns a human readable, multi-line summary of the frame rate and the time spent
+        in each stage.
+        """
+        elapsed_seconds = time.perf_counter() - self.start_time
+        frames_per_second = 0.0
+        if elapsed_seconds > 0:
+            frames_per_second = self.frame_count / elapsed_seconds
+
+        lines = ['Processed %d frames in %.3f seconds (%.2f frames/sec).' % (
+            self.frame_count, elapsed_seconds, frames_per_second)]
+        lines.append('%-44s %8s %12s %10s %10s %8s' % (
+            'stage', 'calls', 'total (s)', 'mean (ms)', 'max (ms)', 'loop %'))
+        for stage in list(self.stages.values()):
+            mean_milliseconds = 0.0
+            if stage.count:
+                mean_milliseconds = stage.total_seconds / stage.count * 1000
+            loop_percent = 0.0
+            if elapsed_seconds > 0:
+                loop_percent = stage.total_seconds / elapsed_seconds * 100
+            lines.append('%-44s %8d %12.3f %10.3f %10.3f %8.1f' % (
+                stage.name, stage.count, stage.total_seconds, mean_milliseconds,
+                stage.max_seconds * 1000, loop_percent))
+
+        return '\n'.join(lines)
+
+    def format_prometheus(self, labels):
+        """Returns the frame count and a histogram of each stage's timings in the
+        Prometheus text format.
+
+        labels: The Prometheus labels added to every sample.  (e.g. 'camera="front"')
+        """
+        lines = [
+            '# HELP watchman_frames_total Frames processed by the capture loop.',
+            '# TYPE watchman_frames_total counter',
+            'watchman_frames_total{%s} %d' % (labels, self.frame_count),
+            '# HELP watchman_stage_seconds Time spent in each stage of the capture loop.',
+            '# TYPE watchman_stage_seconds histogram']
+        with self.lock:
+            stages = list(self.stages.values())
+        for stage in stages:
+            # Copied first because other threads keep adding to the stage.
+            bucket_counts = list(stage.bucket_counts)
+            total_seconds = stage.total_seconds
+            stage_labels = '%s,stage="%s"' % (labels, stage.name)
+            cumulative_count = 0
+            for bucket_index, bucket_seconds in enumerate(HISTOGRAM_BUCKET_SECONDS):
+                cumulative_count += bucket_counts[bucket_index]
+                lines.append('watchman_stage_seconds_bucket{%s,le="%s"} %d' % (
+                    stage_labels, bucket_seconds, cumulative_count))
+            cumulative_count += bucket_counts[-1]
+            lines.append('watchman_stage_seconds_bucket{%s,le="+Inf"} %d' % (
+                stage_labels, cumulative_count))
+            lines.append('watchman_stage_seconds_sum{%s} %f' % (
+                stage_labels, total_seconds))
+            lines.append('watchman_stage_seconds_count{%s} %d' % (
+                stage_labels, cumulative_count))
+
+        return '\n'.join(lines)
+
+
+def timed_method(stage_name):
+    """Decorates a method so every call is timed as the named stage.  The decorated method's
+    object must have a 'stage_timer' attribute holding a StageTimer.
+
+    stage_name: The name the stage is reported under.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stage_timer.time(stage_name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
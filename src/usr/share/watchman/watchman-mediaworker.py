@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Rotates, encodes, saves, and e-mails the images of one camera in its own process when
+media_worker is 'process'.  Started by watchmand along with the camera's subprocess, or by
+the camera's subprocess itself when it is run by hand.
+"""
+
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import argparse
+import configparser
+import logging
+import os
+import socket
+import sys
+import traceback
+from parkbenchcommon import confighelper
+import emailsender
+import gpgmailmessage
+import imagewriter
+import mediaworker
+import metrics
+import profiling
+import stagetimer
+import watchmanconfig
+import watchmanreplay
+
+# Constants
+CONFIGURATION_PATHNAME = '/etc/watchman/watchman.conf'
+LOG_PATHNAME_FORMAT = '/var/log/watchman/watchman-mediaworker-%s.log'
+
+
+def parse_arguments():
+    """Parses the command line.  Returns the parsed arguments."""
+    parser = argparse.ArgumentParser(
+        description='Rotates, encodes, saves, and e-mails the images of one camera for its '
+        'watchman subprocess.')
+    parser.add_argument(
+        '--socket-fd', type=int, required=True,
+        help='The file descriptor of the socket connected to the camera\'s subprocess.')
+    parser.add_argument(
+        '--config', dest='config_pathname', default=CONFIGURATION_PATHNAME,
+        help='The configuration file to read.  (Default: %(default)s)')
+    parser.add_argument('--camera', dest='camera_name', required=True,
+                        help='The name of the camera.')
+    parser.add_argument(
+        '--log', dest='log_pathname', help='The file to log to.  Defaults to the camera\'s '
+        'media worker log file in /var/log/watchman.')
+    parser.add_argument(
+        '--metrics', dest='metrics_pathname', help='The file metrics are written to.  '
+        'Defaults to the camera\'s media worker file in /run/watchman.')
+    parser.add_argument(
+        '--email-dir', help='Write e-mails to this directory instead of sending them with '
+        'gpgmailer, and print a report when done.  Used by replays.')
+    return parser.parse_args()
+
+
+def format_metrics(stage_timer, labels, image_writer, email_sender):
+    """Returns the stage timings, queue depths, and counts in the Prometheus text format.
+    Called periodically from the metrics writer thread.
+    """
+    lines = [stage_timer.format_prometheus(labels)]
+    for name, metric_type, help_text, value in mediaworker.get_media_metric_values(
+            image_writer, email_sender):
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines.append('%s{%s} %s' % (name, labels, value))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    """Reads the camera's configuration and handles images until the camera's subprocess
+    exits.
+    """
+    arguments = parse_arguments()
+    # Taken over first so it is closed even if the configuration is bad.
+    worker_socket = socket.fromfd(arguments.socket_fd, socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    os.close(arguments.socket_fd)
+
+    config_parser = configparser.SafeConfigParser()
+    config_parser.read(arguments.config_pathname)
+    config_parser = watchmanconfig.create_camera_config_parser(
+        config_parser, arguments.camera_name)
+
+    config_helper = confighelper.ConfigHelper()
+    log_level = config_helper.verify_string_exists(config_parser, 'log_level')
+    log_pathname = arguments.log_pathname
+    if log_pathname is None:
+        log_pathname = LOG_PATHNAME_FORMAT % arguments.camera_name
+    config_helper.configure_logger(log_pathname, log_level)
+    logger = logging.getLogger(__name__)
+
+    try:
+        config = watchmanconfig.WatchmanConfig(config_parser, arguments.camera_name)
+
+        # SIGUSR1 profiles the message loop.  The profile is written next to the log.
+        profiling.SignalProfiler(
+            os.path.dirname(log_pathname), 'watchman-mediaworker-%s' % arguments.camera_name,
+            config.profile_seconds, 'run').install()
+
+        create_email_message = gpgmailmessage.GpgMailMessage
+        mail_sink = None
+        if arguments.email_dir is not None:
+            mail_sink = watchmanreplay.LocalMailSink(arguments.email_dir)
+            create_email_message = mail_sink.create_message
+
+        stage_timer = stagetimer.StageTimer()
+        image_writer = imagewriter.ImageWriterPool(
+            config.image_writer_thread_count, config.image_writer_queue_size,
+            config.image_writer_full_policy, stage_timer)
+        email_sender = emailsender.EmailSender(
+            create_email_message, config.email_image_width,
+            config.email_image_buffer_max_bytes, config.email_max_bytes, stage_timer)
+
+        metrics_pathname = arguments.metrics_pathname
+        if metrics_pathname is None:
+            metrics_pathname = mediaworker.get_media_worker_metrics_pathname(
+                metrics.METRICS_PATHNAME_FORMAT % arguments.camera_name)
+        labels = 'camera=%s,process="media_worker"' % metrics.format_label_value(
+            arguments.camera_name)
+        metrics_file_writer = metrics.MetricsFileWriter(
+            metrics_pathname,
+            lambda: format_metrics(stage_timer, labels, image_writer, email_sender))
+
+        logger.info('Media worker for camera %s started.', arguments.camera_name)
+        try:
+            mediaworker.MediaWorker(
+                worker_socket, config.image_rotation_angle, image_writer, email_sender,
+                stage_timer).run()
+        finally:
+            # Save and send everything already received.
+            image_writer.close()
+            email_sender.close()
+            metrics_file_writer.close()
+            worker_socket.close()
+
+        if mail_sink is not None:
+            print('Media worker timings:')
+            print(stage_timer.format_report())
+            print('Media worker dropped %d locally saved images and %d e-mail images.' % (
+                image_writer.dropped_image_count, email_sender.dropped_attachment_count))
+            print('Media worker wrote %d e-mails with %d attachments.' % (
+                mail_sink.email_count, mail_sink.attachment_count))
+
+    except Exception as exception:  # pylint: disable=broad-except
+        logger.critical('Fatal %s: %s\n%s', type(exception).__name__, str(exception),
+                        traceback.format_exc())
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
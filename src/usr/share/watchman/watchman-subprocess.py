@@ -23,22 +23,62 @@ __all__ = ['WatchmanSubprocess']
 __author__ = 'Joel Luellwitz and Emily Frost'
 __version__ = '0.8'
 
-import datetime
+import argparse
 import configparser
 import logging
 import math
+import multiprocessing
 import os
+import socket
 import random
+import time
 import traceback
 from parkbenchcommon import confighelper
 import cv2
+import numpy
+import backgroundsubtractor
+import clipwriter
+import emailschedule
+import emailsender
+import footageindex
+import framecapture
 import gpgmailmessage
+import imagewriter
+import mediaworker
+import metrics
+import mjpegcapture
+import movementwindow
+import parametersweep
+import pretrigger
+import profiling
+import stagetimer
 import watchmanconfig
+import watchmanreplay
 
 # Constants
+CONFIGURATION_PATHNAME = '/etc/watchman/watchman.conf'
 LOG_DIRS = '/var/log/watchman'
-LOG_PATHNAME = os.path.join(LOG_DIRS, 'watchman-subprocess.log')
+LOG_PATHNAME_FORMAT = os.path.join(LOG_DIRS, 'watchman-subprocess-%s.log')
 IMAGES_PATH = os.path.join(LOG_DIRS, 'images')
+FOOTAGE_INDEX_PATHNAME = os.path.join(LOG_DIRS, 'footage.sqlite')
+MEDIA_WORKER_PATHNAME = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'watchman-mediaworker.py')
+
+
+class MotionGridText():
+    """Formats a motion grid for logging only when it is converted to a string.  Each cell
+    is written as one digit, the tenths of its pixels that changed.  Rows are separated by
+    slashes.  (e.g. '0000/0130/0000')
+    """
+
+    def __init__(self, cell_fractions):
+        """cell_fractions: A 2D array of the fraction of each cell's pixels that changed."""
+        self.cell_fractions = cell_fractions
+
+    def __str__(self):
+        return '/'.join(
+            ''.join(str(min(int(cell_fraction * 10), 9)) for cell_fraction in row)
+            for row in self.cell_fractions)
 
 
 class WatchmanSubprocess():
@@ -47,11 +87,52 @@ class WatchmanSubprocess():
     around is to kill this process when the camera device disappears.
     """
 
-    def __init__(self):
+    def __init__(self, config_pathname=CONFIGURATION_PATHNAME, camera_name=None,
+                 log_pathname=None, images_path=None, footage_index_pathname=None,
+                 metrics_pathname=None, replay_source_pathname=None, replay_fps=None,
+                 mail_sink=None, config_overrides=None, interactive=False,
+                 record_differences=False, media_worker_fd=None):
+        """Reads the configuration and prepares the motion detection state.  The defaults
+        monitor the first configured camera.  The replay arguments are used to benchmark the
+        capture loop against recorded footage.
+
+        config_pathname: The configuration file to read.
+        camera_name: The name of the camera to monitor.  None for the first listed camera.
+        log_pathname: The file to log to.  None for the camera's log file in LOG_DIRS.
+        images_path: The directory locally saved images are written to.  None for the
+          camera's directory in IMAGES_PATH.
+        footage_index_pathname: The SQLite database motion events and saved files are
+          recorded in.  None for FOOTAGE_INDEX_PATHNAME.
+        metrics_pathname: The file metrics are periodically written to.  None for the
+          camera's file in metrics.METRICS_PATHNAME_FORMAT.
+        replay_source_pathname: A video file or directory of images to read frames from
+          instead of the camera.  None to use the camera.
+        replay_fps: The frame rate used to timestamp replayed frames.  None to use the rate
+          reported by the video file.
+        mail_sink: A watchmanreplay.LocalMailSink that receives e-mails instead of gpgmailer.
+          None to send e-mails with gpgmailer.
+        config_overrides: A dictionary of option names to string values that replace the
+          values in the configuration file.  Used to compare settings on the same footage.
+        interactive: Whether to check for the q key between frames.  Only useful when
+          debugging with windows open.
+        record_differences: Whether to keep the abs_diff_mean_total of every frame in
+          frame_differences.  Used to tune the motion thresholds.  The background
+          subtractor is not reset while recording.
+        media_worker_fd: The file descriptor of the socket connected to the media worker
+          started by watchmand.  None to start the media worker here if media_worker is
+          'process'.
+        """
 
         print('Loading configuration.')
         config_parser = configparser.SafeConfigParser()
-        config_parser.read('/etc/watchman/watchman.conf')
+        config_parser.read(config_pathname)
+        if camera_name is None:
+            camera_name = watchmanconfig.read_camera_names(config_parser)[0]
+        config_parser = watchmanconfig.create_camera_config_parser(
+            config_parser, camera_name)
+        if config_overrides is not None:
+            for option_name, option_value in config_overrides.items():
+                config_parser.set(watchmanconfig.GENERAL_SECTION, option_name, option_value)
 
         # Figure out the logging options so that can start before anything else.
         print('Verifying configuration.')
@@ -59,27 +140,122 @@ class WatchmanSubprocess():
 
         log_level = config_helper.verify_string_exists(config_parser, 'log_level')
 
-        config_helper.configure_logger(LOG_PATHNAME, log_level)
+        if log_pathname is None:
+            log_pathname = LOG_PATHNAME_FORMAT % camera_name
+        config_helper.configure_logger(log_pathname, log_level)
         self.logger = logging.getLogger(__name__)
 
         try:
-            self.config = watchmanconfig.WatchmanConfig(config_parser)
+            self.config = watchmanconfig.WatchmanConfig(config_parser, camera_name)
+
+            # SIGUSR1 profiles the capture loop.  The profile is written next to the log.
+            self.signal_profiler = profiling.SignalProfiler(
+                os.path.dirname(log_pathname), 'watchman-subprocess-%s' % camera_name,
+                self.config.profile_seconds, 'start_loop')
+
+            self.images_path = images_path
+            if self.images_path is None:
+                self.images_path = os.path.join(IMAGES_PATH, camera_name)
+            # Saved files are sharded into a subdirectory for each day.
+            self.image_date_directory = None
+            if footage_index_pathname is None:
+                footage_index_pathname = FOOTAGE_INDEX_PATHNAME
+            self.footage_index = footageindex.FootageIndex(
+                footage_index_pathname, camera_name)
+            self.metrics_pathname = metrics_pathname
+            if self.metrics_pathname is None:
+                self.metrics_pathname = metrics.METRICS_PATHNAME_FORMAT % camera_name
+            self.metrics_labels = 'camera=%s' % metrics.format_label_value(camera_name)
+            self.metrics_file_writer = None
+            # Used to calculate the frame rate between metrics writes.
+            self.metrics_last_frame_count = 0
+            self.metrics_last_time = time.monotonic()
+            self.replay_source_pathname = replay_source_pathname
+            self.replay_fps = replay_fps
+            self.mail_sink = mail_sink
+            self.interactive = interactive
+            self.create_email_message = gpgmailmessage.GpgMailMessage
+            if mail_sink is not None:
+                self.create_email_message = mail_sink.create_message
+            # Replayed frames are timestamped by the replay device instead of the clock.
+            self.get_frame_time = framecapture.monotonic_ns
+            self.stage_timer = stagetimer.StageTimer()
+            self.capture_device = None
+            self.capture_thread = None
+            self.image_writer = None
+            self.pre_trigger_buffer = None
+            self.clip_writer = None
+            # The time of the first motion of the event being recorded as a clip.
+            self.clip_motion_start_time = None
+            self.next_clip_frame_time = None
+            # In MJPEG mode, frames are decoded at 1/decode_reduction size and the rest of
+            #   detection_scale is applied by resizing.
+            self.decode_reduction = 1
+            if self.config.capture_mode == 'mjpeg':
+                self.decode_reduction = mjpegcapture.choose_reduction(
+                    self.config.detection_scale)
+            self.detection_resize_scale = self.config.detection_scale * self.decode_reduction
+            # Calculated from the first frame's size.
+            self.detection_crop = None
+            self.detection_mask = None
+            # The fraction of each motion grid cell inside the detection regions.
+            self.motion_grid_coverage = None
+            self.media_worker_client = None
+            if self.config.media_worker == 'process':
+                self.media_worker_client = self._create_media_worker_client(
+                    config_pathname, log_pathname, media_worker_fd)
+                # The client has the EmailSender and ImageWriterPool interfaces.
+                self.email_sender = self.media_worker_client
+            else:
+                self.email_sender = emailsender.EmailSender(
+                    self.create_email_message, self.config.email_image_width,
+                    self.config.email_image_buffer_max_bytes, self.config.email_max_bytes,
+                    self.stage_timer)
+            self.reported_dropped_frame_count = 0
+            # Frames are skipped to process idle_frames_per_second while there is no
+            #   motion.
+            self.idle_frame_interval = None
+            if self.config.idle_frames_per_second > 0:
+                self.idle_frame_interval = framecapture.seconds_to_nanoseconds(
+                    1.0 / self.config.idle_frames_per_second)
+            self.last_processed_frame_time = None
+            # The time of the last frame that was different from the one before it.
+            self.last_difference_time = None
+            self.idle = True
+            self.idle_skipped_frame_count = 0
+            # Counted for replay reports.
+            self.motion_frame_count = 0
+            self.motion_event_count = 0
+            # (time_ns, abs_diff_mean_total) of each processed frame after the first.
+            self.frame_differences = None
+            if record_differences:
+                self.frame_differences = []
 
             self.subtractor = self._create_background_subtractor()
             # TODO: See if there is a better option than to create another background
             #   subtractor. (issue 6)
             self.replacement_subtractor = None
             self.replacement_subtractor_frame_count = 0
+            self.replacement_subtractor_offered_frame_count = 0
+            # Used instead of a replacement subtractor by the 'boost' reset strategy.
+            self.learning_rate_boost_frame_count = 0
+            # Time spent retraining the background during the current reset.
+            self.subtractor_reset_seconds = 0.0
             self.subtractor_motion_start_time = None
 
-            self.email_frames = []
-            self.prior_movements = [None] * self.config.prior_movements_per_threshold
+            # The images themselves are encoded and buffered by the e-mail sender.
+            self.email_image_count = 0
+            self.movement_window = movementwindow.MovementWindow(
+                self.config.prior_movements_per_threshold,
+                framecapture.seconds_to_nanoseconds(self.config.movement_time_threshold))
 
             self.first_trigger_motion = None
-            self.first_motion_email_sent = None
-            self.second_motion_email_sent = None
-            self.last_motion_email_sent = None
+            # Recorded in the footage index when the motion event ends.
+            self.event_start_datetime = None
+            self.event_peak_abs_diff_mean_total = 0
+            self.event_email_count = 0
             self.last_trigger_motion = None
+            self.email_schedule = self._create_email_schedule()
         except Exception as exception:  # pylint: disable=broad-except
             self.logger.critical('Fatal %s: %s\n%s', type(exception).__name__,
                                  str(exception), traceback.format_exc())
@@ -88,19 +264,75 @@ class WatchmanSubprocess():
     def start_loop(self):
         """The main program loop monitoring a camera."""
 
+        last_frame = None
+        current_frame = None
         try:
+            self.signal_profiler.install()
+
             # Open the camera.
-            self.capture_device = cv2.VideoCapture(self.config.video_device_number)
+            mjpeg_mode = self.config.capture_mode == 'mjpeg'
+            if self.replay_source_pathname is not None:
+                self.capture_device = watchmanreplay.ReplayCaptureDevice(
+                    self.replay_source_pathname, self.replay_fps, encoded=mjpeg_mode)
+                self.get_frame_time = self.capture_device.get_frame_time
+            elif mjpeg_mode:
+                self.capture_device = mjpegcapture.open_mjpeg_camera(
+                    self.config.video_device_number)
+            else:
+                self.capture_device = cv2.VideoCapture(self.config.video_device_number)
+            if mjpeg_mode:
+                self.capture_device = mjpegcapture.MjpegCaptureDevice(
+                    self.capture_device, self.decode_reduction,
+                    self.config.detection_color_mode == 'grayscale')
+
+            # Read frames in their own thread so they are timestamped on arrival. Every
+            #   replayed frame is processed, so a replay waits instead of dropping frames.
+            self.capture_thread = framecapture.CaptureThread(
+                self.capture_device, self.get_frame_time, self.config.capture_buffer_size,
+                self.config.capture_buffer_drop_policy,
+                block_when_full=self.replay_source_pathname is not None)
+            if self.idle_frame_interval is not None:
+                # Frames start out idle.  Skipped frames are not decoded.
+                self.capture_thread.set_skip_interval(self.idle_frame_interval)
+            self.capture_thread.start()
+
+            self.metrics_file_writer = metrics.MetricsFileWriter(
+                self.metrics_pathname, self._format_metrics)
+
+            if self.media_worker_client is not None:
+                self.image_writer = self.media_worker_client
+            else:
+                self.image_writer = imagewriter.ImageWriterPool(
+                    self.config.image_writer_thread_count,
+                    self.config.image_writer_queue_size,
+                    self.config.image_writer_full_policy, self.stage_timer)
+
+            if self.config.local_save_mode == 'clip':
+                self.clip_writer = clipwriter.ClipWriter(
+                    self.config.clip_fps, self.config.clip_fourcc,
+                    self.config.image_rotation_angle, self.config.image_writer_queue_size,
+                    self.config.image_writer_full_policy, self.stage_timer)
+
+            if self.config.pre_trigger_seconds > 0:
+                self.pre_trigger_buffer = pretrigger.PreTriggerBuffer(
+                    self.config.pre_trigger_seconds,
+                    self.config.pre_trigger_images_per_second,
+                    self.config.email_image_width, self.config.image_rotation_angle,
+                    self.stage_timer)
+
             current_frame = self._capture_frame()  # Capture the first frame
+            if current_frame is None:
+                return
             # These next couple lines are not exactly accurate, but they will do for now.
-            self.last_image_save_time = current_frame['time']
+            self.last_image_save_time = current_frame.time_ns
             # All e-mails, not just motion.
-            self.last_email_sent_time = current_frame['time']
+            self.last_email_sent_time = current_frame.time_ns
             self._calculate_still_running_email_delay()
             frame_count = 0
 
-            # Sometimes we run this program interactively for debugging purposes.
-            while cv2.waitKey(1) & 0xFF != ord('q'):
+            # Sometimes we run this program interactively for debugging purposes.  waitKey
+            #   is only called then because it is slow and needs a display.
+            while not self.interactive or cv2.waitKey(1) & 0xFF != ord('q'):
 
                 # This will never wrap around. If there is a frame every millisecond, it
                 #   would take millions of years for this value to exceed a 64 bit int, and
@@ -110,80 +342,29 @@ class WatchmanSubprocess():
                 last_frame = current_frame
 
                 current_frame = self._capture_frame()  # Read the next frame
+                if current_frame is None:
+                    break
+                self.stage_timer.count_frame()
 
                 self._calculate_absolute_difference_mean_total(current_frame, last_frame)
+                if self.frame_differences is not None:
+                    self.frame_differences.append(
+                        (current_frame.time_ns, current_frame.abs_diff_mean_total))
+                if self.config.motion_metric == 'grid':
+                    self._calculate_motion_grid(current_frame, last_frame)
 
                 self._detect_motion(frame_count, current_frame)
 
-                # TODO: The following code and comments are half baked ideas. I need to fix
-                #   something now so I'll leave them commented. (issue 12)
-                # TODO: The following shouldn't always return. Maybe return by reference?
-                #   (issue 12)
-                #self.first_motion_email_sent = self._processInitialEmails(
-                #    self.first_trigger_motion, self.first_email_image_save_times,
-                #    last_frame, current_frame, 'Motion just detected.')
-                #self.second_motion_email_sent = self._processInitialEmails(
-                #    self.second_trigger_motion, self.second_email_image_save_times,
-                #    last_frame, current_frame, 'Follow up one.')
-                #self.third_motion_email_sent = self._processInitialEmails(
-                #    self.third_trigger_motion, self.third_email_image_save_times,
-                #    last_frame, current_frame, 'Follow up two.')
-
-                # Grab images for the first e-mail.
-                if self.first_trigger_motion is not None:
-                    self._store_email_frames_on_threshold(
-                        self.first_trigger_motion, last_frame, current_frame,
-                        self.config.first_email_image_save_times)
-
-                # Send first e-mail after so many seconds.
-                if self.first_trigger_motion is not None and self._did_threshold_trigger(
-                        self.first_trigger_motion, last_frame, current_frame,
-                        self.config.first_email_delay):
-                    self._send_image_emails('Motion just detected.', current_frame)
-                    self.first_motion_email_sent = self.first_trigger_motion + \
-                        datetime.timedelta(0, self.config.first_email_delay)
-
-                # Grab images for the second e-mail.
-                if self.first_motion_email_sent is not None:
-                    self._store_email_frames_on_threshold(
-                        self.first_motion_email_sent, last_frame, current_frame,
-                        self.config.second_email_image_save_times)
-
-                # Send another e-mail after so many seconds.
-                if self.first_motion_email_sent is not None and self._did_threshold_trigger(
-                        self.first_motion_email_sent, last_frame, current_frame,
-                        self.config.second_email_delay):
-                    self._send_image_emails('Follow up one.', current_frame)
-                    self.second_motion_email_sent = self.first_motion_email_sent + \
-                        datetime.timedelta(0, self.config.second_email_delay)
-
-                # Grab images for the third e-mail.
-                if self.second_motion_email_sent is not None:
-                    self._store_email_frames_on_threshold(
-                        self.second_motion_email_sent, last_frame, current_frame,
-                        self.config.third_email_image_save_times)
-
-                # Send third e-mail after so many seconds.
-                if self.second_motion_email_sent is not None and self._did_threshold_trigger(
-                        self.second_motion_email_sent, last_frame, current_frame,
-                        self.config.third_email_delay):
-                    self._send_image_emails('Follow up two.', current_frame)
-                    self.last_motion_email_sent = self.second_motion_email_sent + \
-                        datetime.timedelta(0, self.config.third_email_delay)
-
-                # Grab images for subsequent e-mails.
-                if self.last_motion_email_sent is not None:
-                    self._store_email_frames_on_threshold(
-                        self.last_motion_email_sent, last_frame, current_frame,
-                        self.config.subsequent_email_image_save_times)
-
-                # Send subsequent e-mails after so many seconds.
-                if self.last_motion_email_sent is not None and self._did_threshold_trigger(
-                        self.last_motion_email_sent, last_frame, current_frame,
-                        self.config.subsequent_email_delay):
-                    self._send_image_emails('Continued motion.', current_frame)
-                    self.last_motion_email_sent = self.last_motion_email_sent + \
-                        datetime.timedelta(0, self.config.subsequent_email_delay)
+                # Keep small images of the frames before motion for the first e-mail.
+                if self.pre_trigger_buffer is not None and self.first_trigger_motion is None:
+                    image = current_frame.image
+                    if current_frame.mjpeg_image is not None:
+                        image = current_frame.mjpeg_image
+                    self.pre_trigger_buffer.offer(current_frame.time_ns, image)
+
+                # Store images and send e-mails when their times come up.
+                if self.email_schedule.is_due(current_frame.time_ns):
+                    self._process_email_schedule(current_frame)
 
                 # See if the motion has stopped.
                 if self.last_trigger_motion is not None and self._did_threshold_trigger(
@@ -191,32 +372,61 @@ class WatchmanSubprocess():
                         self.config.stop_threshold):
 
                     # Clear out the image buffer if images exist.
-                    if self.email_frames:
+                    if self.email_image_count:
                         self._send_image_emails('Continued motion.', current_frame)
 
+                    self._record_motion_event(current_frame.get_datetime())
                     self.first_trigger_motion = None
-                    self.first_motion_email_sent = None
-                    self.second_motion_email_sent = None
-                    self.last_motion_email_sent = None
                     self.last_trigger_motion = None
+                    self.email_schedule.stop()
+
+                if self.clip_writer is not None:
+                    self._record_clip_frame(current_frame)
 
-                # Save the image?
-                if current_frame['save'] is True:
+                # Save the image?  In clip mode, the clip already contains it.
+                if current_frame.save is True and self.clip_writer is None:
 
-                    pathname = os.path.join(
-                        IMAGES_PATH,
-                        current_frame['time'].strftime('%Y-%m-%d_%H-%M-%S_%f.jpg'))
-                    cv2.imwrite(pathname, current_frame['rotated_image'])
+                    frame_datetime = current_frame.get_datetime()
+                    pathname = self._create_image_pathname(
+                        frame_datetime, '%Y-%m-%d_%H-%M-%S_%f.jpg')
+                    with self.stage_timer.time('image_writer.write'):
+                        self.image_writer.write(pathname, current_frame.rotated_image)
+                    self.footage_index.add_file(
+                        frame_datetime, pathname, 'image', self.event_start_datetime)
 
                 self._send_still_running_notification(current_frame)
 
-                self._process_replacement_subtractor(last_frame, current_frame)
+                # While the differences are recorded for tuning, the subtractor is never
+                #   reset, because when it is reset depends on the configured thresholds
+                #   and would change the differences the swept thresholds are evaluated on.
+                if self.frame_differences is None:
+                    self._process_replacement_subtractor(last_frame, current_frame)
 
         finally:
             # Clean up.
-            self.capture_device.release()
-            cv2.destroyAllWindows()  # Again for interactive debugging.
-
+            if self.capture_thread is not None:
+                self.capture_thread.stop()
+            if self.pre_trigger_buffer is not None:
+                self.pre_trigger_buffer.close()
+            if self.clip_writer is not None:
+                self.clip_writer.close()
+            if self.image_writer is not None:
+                self.image_writer.close()
+            self.email_sender.close()
+            if self.metrics_file_writer is not None:
+                self.metrics_file_writer.close()
+            # The motion event in progress ends with the last frame.
+            if current_frame is None:
+                current_frame = last_frame
+            if self.event_start_datetime is not None and current_frame is not None:
+                self._record_motion_event(current_frame.get_datetime())
+            self.footage_index.close()
+            if self.capture_device is not None:
+                self.capture_device.release()
+            if self.interactive:
+                cv2.destroyAllWindows()  # Again for interactive debugging.
+
+    @stagetimer.timed_method('_calculate_absolute_difference_mean_total')
     def _calculate_absolute_difference_mean_total(self, current_frame, last_frame):
         """Finds the summation of the absolute mean value of each channel from the difference
         of the two prior background subtracted images.  (If you don't understand what this
@@ -226,14 +436,14 @@ class WatchmanSubprocess():
         """
 
         # Find the difference between the two subtracted images
-        difference_image = last_frame['subtracted_image'] - current_frame['subtracted_image']
+        difference_image = last_frame.subtracted_image - current_frame.subtracted_image
 
-        #cv2.imshow('last subtracted_image', last_frame['subtracted_image'])
-        #cv2.imshow('current subtracted_image', current_frame['subtracted_image'])
+        #cv2.imshow('last subtracted_image', last_frame.subtracted_image)
+        #cv2.imshow('current subtracted_image', current_frame.subtracted_image)
         #cv2.imshow('difference_image', difference_image)
 
-        # Find the mean difference of each channel.
-        channel_means = cv2.mean(difference_image)
+        # Find the mean difference of each channel, ignoring excluded pixels.
+        channel_means = cv2.mean(difference_image, mask=self.detection_mask)
 
         abs_diff_mean_total = 0
         for channel_mean in channel_means:
@@ -242,7 +452,60 @@ class WatchmanSubprocess():
 
         self.logger.trace('abs_diff_mean_total: {0:.10f}'.format(abs_diff_mean_total))
 
-        current_frame['abs_diff_mean_total'] = abs_diff_mean_total
+        current_frame.abs_diff_mean_total = abs_diff_mean_total
+
+    @stagetimer.timed_method('_calculate_motion_grid')
+    def _calculate_motion_grid(self, current_frame, last_frame):
+        """Divides the difference of the two subtracted images into a grid and counts the
+        cells where at least motion_grid_cell_threshold of the pixels changed.  Resizing
+        with INTER_AREA averages each cell's pixels in a single pass.
+        """
+
+        difference_image = cv2.absdiff(last_frame.subtracted_image,
+                                       current_frame.subtracted_image)
+        if self.detection_mask is not None:
+            difference_image = cv2.bitwise_and(
+                difference_image, difference_image, mask=self.detection_mask)
+
+        grid = cv2.resize(difference_image, self.config.motion_grid_size,
+                          interpolation=cv2.INTER_AREA)
+        if grid.ndim == 3:
+            grid = grid.max(axis=2)
+
+        if self.motion_grid_coverage is None:
+            self._calculate_motion_grid_coverage(difference_image.shape[:2])
+        # Pixels outside the detection regions never change, so only the pixels inside
+        #   count toward a cell's fraction.
+        cell_fractions = grid / self.motion_grid_coverage
+        current_frame.active_cell_count = int(numpy.count_nonzero(
+            cell_fractions >= self.config.motion_grid_cell_threshold))
+
+        # The grid is only formatted if trace logging is enabled.
+        self.logger.trace('motion grid: %s active cells: %d', MotionGridText(cell_fractions),
+                          current_frame.active_cell_count)
+
+    def _calculate_motion_grid_coverage(self, shape):
+        """Calculates the fraction of each motion grid cell inside the detection regions,
+        scaled to 255 to match the grid of a difference image.  Cells entirely outside the
+        regions are made infinite so they are never active.
+
+        shape: The (height, width) of the subtracted images.
+        """
+        mask = self.detection_mask
+        if mask is None:
+            mask = numpy.full(shape, 255, numpy.uint8)
+        coverage = cv2.resize(mask, self.config.motion_grid_size,
+                              interpolation=cv2.INTER_AREA).astype(numpy.float32)
+        coverage[coverage == 0] = numpy.inf
+        self.motion_grid_coverage = coverage
+
+    def _is_frame_different(self, current_frame):
+        """Returns whether the frame is different enough from the one before it to count
+        as motion, according to the configured motion metric.
+        """
+        if self.config.motion_metric == 'grid':
+            return current_frame.active_cell_count >= self.config.motion_grid_active_cells
+        return current_frame.abs_diff_mean_total > self.config.pixel_difference_threshold
 
     def _detect_motion(self, frame_count, current_frame):
         """See if there has been enough motion to start sending e-mails or to save an image.
@@ -251,80 +514,166 @@ class WatchmanSubprocess():
         """
 
         if frame_count > self.config.initial_frame_skip_count and \
-                current_frame['abs_diff_mean_total'] > \
-                self.config.pixel_difference_threshold:
+                self._is_frame_different(current_frame):
 
             # Obtain the time of the differnce.
-            now = current_frame['time']
+            now = current_frame.time_ns
+            self.motion_frame_count += 1
+            self.last_difference_time = now
 
             # Make sure a specific amount of time has passed since the last local image save.
-            #   (E-mail initiated saves do not count.)
-            if (now - self.last_image_save_time) >= \
-                    datetime.timedelta(seconds=self.config.image_save_throttle_delay):
+            #   (E-mail initiated saves do not count.)  Clips save every frame anyway.
+            if self.clip_writer is None and \
+                    (now - self.last_image_save_time) >= framecapture.seconds_to_nanoseconds(
+                        self.config.image_save_throttle_delay):
 
                 # Mark the image to be saved.
-                self.last_image_save_time = current_frame['time']
+                self.last_image_save_time = current_frame.time_ns
                 self._mark_for_saving_and_rotate(current_frame)
 
             # See if there has been a sufficient amount of differences in the specified
             #   time frame.
-            motion_detected = False
-            if self.config.prior_movements_per_threshold < 1:
-                motion_detected = True
-            else:
-                oldest_movement_time = \
-                    self.prior_movements[self.config.prior_movements_per_threshold - 1]
-                if oldest_movement_time is not None:
-                    time_difference = now - oldest_movement_time
-                    if time_difference.total_seconds() < \
-                            self.config.movement_time_threshold:
-                        motion_detected = True
-
-                # Move the array contents down one, discard the oldest and add the new one
-                self.prior_movements = [now] + self.prior_movements[:-1]
+            motion_detected = self.movement_window.add_movement(now)
 
             if motion_detected is True:
                 #self.logger.debug('Motion Detected')
                 self.last_trigger_motion = now
                 if self.first_trigger_motion is None:
                     self.first_trigger_motion = now
+                    self.motion_event_count += 1
+                    self.event_start_datetime = current_frame.get_datetime()
+                    self.email_schedule.start(now)
+                    self._store_pre_trigger_images(now)
+
+            if self.first_trigger_motion is not None:
+                self.event_peak_abs_diff_mean_total = max(
+                    self.event_peak_abs_diff_mean_total, current_frame.abs_diff_mean_total)
+
+    def _record_clip_frame(self, current_frame):
+        """Adds frames to the current motion event's clip at the clip frame rate.  A clip
+        starts when motion is first detected and ends when the stop threshold is reached.
+        """
 
-    # TODO: This is a work in progress. (issue 12)
-    def _processInitialEmails(
-            self, period_start_time, email_image_save_times, email_delay, last_frame,
-            current_frame, message):
-
-        email_sent_time = None
-
-        # Grab images for the e-mail
-        if period_start_time is not None:
-            self._store_email_frames_on_threshold(
-                period_start_time, last_frame, current_frame, email_image_save_times)
+        if self.first_trigger_motion is None:
+            if self.clip_motion_start_time is not None:
+                self.clip_writer.end_clip()
+                self.clip_motion_start_time = None
+            return
+
+        if self.clip_motion_start_time is None:
+            self.clip_motion_start_time = self.first_trigger_motion
+            self.next_clip_frame_time = current_frame.time_ns
+            frame_datetime = current_frame.get_datetime()
+            pathname = self._create_image_pathname(
+                frame_datetime, '%Y-%m-%d_%H-%M-%S_%f.avi')
+            self.clip_writer.start_clip(pathname)
+            self.footage_index.add_file(
+                frame_datetime, pathname, 'clip', self.event_start_datetime)
+
+        # Frames are repeated if the camera is slower than the clip frame rate so the clip
+        #   plays back in real time.  After a long stall, the clip just skips ahead.
+        clip_frame_interval = framecapture.seconds_to_nanoseconds(1.0 / self.config.clip_fps)
+        if current_frame.time_ns - self.next_clip_frame_time > \
+                framecapture.NANOSECONDS_PER_SECOND:
+            self.next_clip_frame_time = current_frame.time_ns
+
+        image = current_frame.image
+        if current_frame.mjpeg_image is not None:
+            image = current_frame.mjpeg_image
+        while self.next_clip_frame_time <= current_frame.time_ns:
+            self.clip_writer.add_frame(image)
+            self.next_clip_frame_time += clip_frame_interval
+
+    def _store_pre_trigger_images(self, trigger_time):
+        """Saves the images from the seconds before motion was detected and buffers them
+        for the first e-mail.  The images are already scaled down and encoded.
+        """
 
-        # Send first e-mail after so many seconds
-        if period_start_time is not None and self._did_threshold_trigger(
-                period_start_time, last_frame, current_frame, email_delay):
-            self._send_image_emails(message, current_frame)
-            email_sent_time = period_start_time + datetime.timedelta(0, email_delay)
+        if self.pre_trigger_buffer is None:
+            return
+
+        for time_ns, jpeg in self.pre_trigger_buffer.take_images(trigger_time):
+            image_datetime = framecapture.monotonic_ns_to_datetime(time_ns)
+            pathname = self._create_image_pathname(
+                image_datetime, '%Y-%m-%d_%H-%M-%S_%f-sm.jpg')
+            self.image_writer.write(pathname, jpeg)
+            self.footage_index.add_file(
+                image_datetime, pathname, 'pre_trigger', self.event_start_datetime)
+            self.email_sender.buffer_image(os.path.basename(pathname), jpeg)
+            self.email_image_count += 1
+
+    def _create_image_pathname(self, wall_clock_time, filename_format):
+        """Returns the pathname a locally saved file is written to.  Files are sharded into
+        a subdirectory for each day so no directory gets too large.  The subdirectory is
+        created if needed.
+
+        wall_clock_time: The datetime the file's first frame was captured.
+        filename_format: The strftime format of the filename.
+        """
+        directory = os.path.join(self.images_path, wall_clock_time.strftime('%Y-%m-%d'))
+        if directory != self.image_date_directory:
+            os.makedirs(directory, exist_ok=True)
+            self.image_date_directory = directory
+        return os.path.join(directory, wall_clock_time.strftime(filename_format))
+
+    def _record_motion_event(self, stop_time):
+        """Records the current motion event in the footage index and resets its totals."""
+        self.footage_index.add_event(
+            self.event_start_datetime, stop_time, self.event_peak_abs_diff_mean_total,
+            self.event_email_count)
+        self.event_start_datetime = None
+        self.event_peak_abs_diff_mean_total = 0
+        self.event_email_count = 0
+
+    def _create_email_schedule(self):
+        """Creates the schedule of the e-mails sent during each motion event from the
+        configuration.
+        """
+        stages = [
+            emailschedule.EmailStage(self.config.first_email_image_save_times,
+                                     self.config.first_email_delay, 'Motion just detected.'),
+            emailschedule.EmailStage(self.config.second_email_image_save_times,
+                                     self.config.second_email_delay, 'Follow up one.'),
+            emailschedule.EmailStage(self.config.third_email_image_save_times,
+                                     self.config.third_email_delay, 'Follow up two.')]
+        for follow_up_number, (delay, image_save_times) in enumerate(
+                self.config.additional_follow_up_emails, 3):
+            stages.append(emailschedule.EmailStage(
+                image_save_times, delay, 'Follow up %d.' % follow_up_number))
+        repeating_stage = emailschedule.EmailStage(
+            self.config.subsequent_email_image_save_times,
+            self.config.subsequent_email_delay, 'Continued motion.')
+        return emailschedule.EmailSchedule(stages, repeating_stage)
+
+    def _process_email_schedule(self, current_frame):
+        """Stores images and sends the e-mails that are due.  A frame is only stored once per
+        e-mail even if several of its store times passed since the last frame.
+        """
 
-        return email_sent_time
+        image_stored = False
+        for event_kind, stage in self.email_schedule.pop_due_events(current_frame.time_ns):
+            if event_kind == emailschedule.STORE_IMAGE:
+                if not image_stored:
+                    self._store_email_frame(current_frame)
+                    image_stored = True
+            else:
+                self._send_image_emails(stage.message, current_frame)
+                # The frame can still be stored for the next e-mail.
+                image_stored = False
 
     def _send_still_running_notification(self, current_frame):
         """Sends a still running notifcation e-mail if no e-mail has been sent in a while."""
 
-        if current_frame['time'] > self.last_email_sent_time + datetime.timedelta(
-                seconds=self.next_still_running_email_delay):
-
-            email = gpgmailmessage.GpgMailMessage()
-            email.set_subject(self.config.still_running_email_subject)
-            email.set_body(
-                'Watchman is still running as of %s.' %
-                current_frame['time'].strftime('%Y-%m-%d %H:%M:%S.%f'))
+        if current_frame.time_ns > self.last_email_sent_time + \
+                framecapture.seconds_to_nanoseconds(self.next_still_running_email_delay):
 
             self.logger.info('Sending still running notification e-mail.')
-            email.queue_for_sending()
+            self.email_sender.queue_email(
+                self.config.still_running_email_subject,
+                'Watchman is still running as of %s.' %
+                current_frame.get_datetime().strftime('%Y-%m-%d %H:%M:%S.%f'))
 
-            self.last_email_sent_time = current_frame['time']
+            self.last_email_sent_time = current_frame.time_ns
             self._calculate_still_running_email_delay()
 
     def _calculate_still_running_email_delay(self):
@@ -337,42 +686,215 @@ class WatchmanSubprocess():
         self.next_still_running_email_delay = random.uniform(
             0, self.config.still_running_email_max_delay * 86400)
 
+    @stagetimer.timed_method('_capture_frame')
     def _capture_frame(self):
         """Captures a frame, performs actions necessary for each frame, and stores the data
-        in a frame dictionary.
+        in a Frame.  Returns None if no frame could be read.
         """
 
-        return_value, image = self.capture_device.read()
-
-        frame_dict = {}
-        frame_dict['time'] = datetime.datetime.now()
-        frame_dict['image'] = image
+        while True:
+            captured_frame = self.capture_thread.get_frame()
+            if captured_frame is None:
+                return None
+            if not self._skip_idle_frame(captured_frame[0]):
+                break
+        self.last_processed_frame_time = captured_frame[0]
+
+        dropped_frame_count = self.capture_thread.dropped_frame_count
+        if dropped_frame_count != self.reported_dropped_frame_count:
+            self.logger.debug('Capture buffer full. %d frames dropped so far.',
+                              dropped_frame_count)
+            self.reported_dropped_frame_count = dropped_frame_count
+
+        time_ns, image = captured_frame
+        # How long the frame waited to be processed.  Replayed frames have simulated
+        #   timestamps.
+        if self.replay_source_pathname is None:
+            self.stage_timer.record('capture_latency', (
+                framecapture.monotonic_ns() - time_ns) / framecapture.NANOSECONDS_PER_SECOND)
+
+        # In MJPEG mode, the frame's image is only the reduced size copy used for motion
+        #   detection.
+        if isinstance(image, mjpegcapture.MjpegImage):
+            frame = framecapture.Frame(time_ns, image.decoded_image, image)
+        else:
+            frame = framecapture.Frame(time_ns, image)
+        detection_image = self._create_detection_image(frame.image)
         # Remove the 'background'.  Basically this removes noise.
-        # TODO: I might have found the solution to our background subtractor problem:
-        #   https://stackoverflow.com/questions/26741081/opencv-python-cv2-backgroundsubtractor-parameters
-        #   Consider explicitly setting learningRate when apply is called. (issue 6)
-        frame_dict['subtracted_image'] = self.subtractor.apply(image)
-        #frame_dict['subtracted_image'] = cv2.morphologyEx(frame_dict['subtracted_image'], \
+        if self.learning_rate_boost_frame_count > 0:
+            self._apply_boosted_subtractor(frame, detection_image)
+        else:
+            with self.stage_timer.time('subtractor.apply'):
+                frame.subtracted_image = self.subtractor.apply(
+                    detection_image,
+                    learningRate=self.config.background_subtractor_learning_rate)
+        #frame.subtracted_image = cv2.morphologyEx(frame.subtracted_image, \
         #    cv2.MORPH_OPEN, kernel)
 
         # If a replacement subtractor exists, also apply to that subtractor. We don't
         #   need to save the result however.
         if self.replacement_subtractor is not None:
-            self.replacement_subtractor.apply(image)
+            self._train_replacement_subtractor(detection_image)
+
+        return frame
 
-        frame_dict['save'] = False
-        return frame_dict
+    def _skip_idle_frame(self, time_ns):
+        """Returns whether a captured frame should be discarded to keep to the idle frame
+        rate.  Every frame is processed during motion and until stop_threshold seconds after
+        the last frame that was different from the one before it.
 
-    def _store_email_frames_on_threshold(
-            self, start_time, last_frame, current_frame, thresholds):
-        """Stores current_frame in saves_frame frame array if the threshold has been crossed.
+        time_ns: The frame's capture time in monotonic nanoseconds.
         """
+        if self.idle_frame_interval is None:
+            return False
+
+        idle = self.first_trigger_motion is None and (
+            self.last_difference_time is None or time_ns - self.last_difference_time >
+            framecapture.seconds_to_nanoseconds(self.config.stop_threshold))
+        if idle != self.idle:
+            self.idle = idle
+            # Frames the capture thread skips are not decoded.  Skipping here catches the
+            #   frames it buffered before the change.
+            self.capture_thread.set_skip_interval(self.idle_frame_interval if idle else None)
+            if idle:
+                self.logger.debug('No motion. Processing %.2f frames per second.',
+                                  self.config.idle_frames_per_second)
+            else:
+                self.logger.debug('Difference detected. Processing every frame.')
 
-        for threshold in thresholds:
-            if self._did_threshold_trigger(start_time, last_frame, current_frame, threshold):
-                self._mark_for_saving_and_rotate(current_frame)
-                self.email_frames.append(current_frame)
-                break
+        if idle and self.last_processed_frame_time is not None and \
+                time_ns - self.last_processed_frame_time < self.idle_frame_interval:
+            self.idle_skipped_frame_count += 1
+            return True
+        return False
+
+    def get_idle_skipped_frame_count(self):
+        """Returns the number of frames skipped to keep to the idle frame rate, by the
+        capture thread and by the main loop.
+        """
+        skipped_frame_count = self.idle_skipped_frame_count
+        if self.capture_thread is not None:
+            skipped_frame_count += self.capture_thread.skipped_frame_count
+        return skipped_frame_count
+
+    def _apply_boosted_subtractor(self, frame, detection_image):
+        """Applies the main subtractor with the replacement learning rate so it quickly
+        relearns the background.  This is how the 'boost' reset strategy replaces the
+        background without the cost of a second subtractor.
+        """
+
+        start_time = time.perf_counter()
+        frame.subtracted_image = self.subtractor.apply(
+            detection_image, learningRate=self.config.replacement_learning_rate)
+        elapsed_seconds = time.perf_counter() - start_time
+        self.stage_timer.record('subtractor.apply (boosted)', elapsed_seconds)
+        self.subtractor_reset_seconds += elapsed_seconds
+
+        self.learning_rate_boost_frame_count -= 1
+        if self.learning_rate_boost_frame_count == 0:
+            self.logger.info('Background subtractor learning rate boost finished. Boosted '
+                             'frames took %.3f seconds.', self.subtractor_reset_seconds)
+
+    def _train_replacement_subtractor(self, detection_image):
+        """Applies the replacement subtractor to every replacement_subtractor_frame_interval
+        frames.  Training on fewer frames reduces the cost of running two subtractors.
+        """
+
+        self.replacement_subtractor_offered_frame_count += 1
+        if (self.replacement_subtractor_offered_frame_count - 1) % \
+                self.config.replacement_subtractor_frame_interval == 0:
+            start_time = time.perf_counter()
+            self.replacement_subtractor.apply(
+                detection_image,
+                learningRate=self.config.background_subtractor_learning_rate)
+            elapsed_seconds = time.perf_counter() - start_time
+            self.stage_timer.record('replacement_subtractor.apply', elapsed_seconds)
+            self.subtractor_reset_seconds += elapsed_seconds
+            self.replacement_subtractor_frame_count += 1
+
+    def _create_detection_image(self, image):
+        """Returns the copy of a captured image that motion detection runs on.  The copy is
+        cropped to the detection regions and, depending on the configuration, scaled down and
+        converted to grayscale.  The captured image is not modified.
+        """
+
+        if self.detection_crop is None:
+            self._create_detection_mask(image)
+
+        with self.stage_timer.time('_create_detection_image'):
+            # Cropping only creates a view, so it is done before anything that copies.
+            detection_image = image[self.detection_crop]
+            if self.detection_resize_scale < 1:
+                # INTER_AREA averages the source pixels, which also reduces sensor noise.
+                detection_image = cv2.resize(
+                    detection_image, None, fx=self.detection_resize_scale,
+                    fy=self.detection_resize_scale, interpolation=cv2.INTER_AREA)
+            # MJPEG frames are already decoded in grayscale.
+            if self.config.detection_color_mode == 'grayscale' and \
+                    detection_image.ndim == 3:
+                detection_image = cv2.cvtColor(detection_image, cv2.COLOR_BGR2GRAY)
+
+        return detection_image
+
+    def _create_detection_mask(self, image):
+        """Calculates the crop and the motion mask from the configured detection regions and
+        exclusions.  Called with the first frame because the frame size must be known.  If
+        the regions are a single rectangle with no exclusions, no mask is needed.
+        """
+
+        height, width = image.shape[:2]
+        mask = numpy.zeros((height, width), numpy.uint8)
+        if self.config.detection_regions:
+            cv2.fillPoly(mask, self._scale_regions(self.config.detection_regions), 255)
+        else:
+            mask[:] = 255
+        if self.config.detection_exclusions:
+            cv2.fillPoly(mask, self._scale_regions(self.config.detection_exclusions), 0)
+
+        if not cv2.countNonZero(mask):
+            raise watchmanconfig.ConfigurationException(
+                'The detection regions do not include any part of the %dx%d frame.' %
+                (width, height))
+
+        crop_x, crop_y, crop_width, crop_height = cv2.boundingRect(mask)
+        self.detection_crop = (slice(crop_y, crop_y + crop_height),
+                               slice(crop_x, crop_x + crop_width))
+        mask = mask[self.detection_crop]
+
+        if cv2.countNonZero(mask) == crop_width * crop_height:
+            self.detection_mask = None
+        else:
+            # Resize exactly the way _create_detection_image does so the sizes match.
+            if self.detection_resize_scale < 1:
+                mask = cv2.resize(
+                    mask, None, fx=self.detection_resize_scale,
+                    fy=self.detection_resize_scale, interpolation=cv2.INTER_NEAREST)
+            self.detection_mask = mask
+
+        # Logged in full resolution frame pixels.
+        self.logger.info('Detecting motion in the %dx%d area at %d,%d of the %dx%d frame.',
+                         *(size * self.decode_reduction for size in (
+                             crop_width, crop_height, crop_x, crop_y, width, height)))
+
+    def _scale_regions(self, regions):
+        """Returns the configured regions, which are in full resolution frame pixels, as
+        polygons in the pixels of a captured image that was decoded at reduced size.
+        """
+        return [(numpy.array(region, numpy.float64) / self.decode_reduction).round().astype(
+            numpy.int32) for region in regions]
+
+    def _store_email_frame(self, current_frame):
+        """Buffers current_frame's image for the next e-mail.  The image is scaled down to
+        its e-mail size right away so the full frame is not kept until the e-mail is sent.
+        """
+
+        self._mark_for_saving_and_rotate(current_frame)
+        # Warning: Making this filename too long causes the signature to fail for some
+        #   unknown reason.
+        image_filename = '%s-sm.jpg' % current_frame.get_datetime().strftime(
+            '%Y-%m-%d_%H-%M-%S_%f')
+        self.email_sender.buffer_image(image_filename, current_frame.rotated_image)
+        self.email_image_count += 1
 
     # TODO: Consider returning False if start_time is null. (issue 7)
     def _did_threshold_trigger(self, start_time, last_frame, current_frame, threshold):
@@ -381,78 +903,64 @@ class WatchmanSubprocess():
         """
 
         threshold_triggered = False
-        last_frame_difference = (last_frame['time'] - start_time).total_seconds()
-        current_frame_difference = (current_frame['time'] - start_time).total_seconds()
-        if last_frame_difference <= threshold and current_frame_difference > threshold:
+        threshold_ns = framecapture.seconds_to_nanoseconds(threshold)
+        last_frame_difference = last_frame.time_ns - start_time
+        current_frame_difference = current_frame.time_ns - start_time
+        if last_frame_difference <= threshold_ns and \
+                current_frame_difference > threshold_ns:
             threshold_triggered = True
         return threshold_triggered
 
+    @stagetimer.timed_method('_send_image_emails')
     def _send_image_emails(self, message, current_frame):
         """Send an signed encrypted MIME/PGP e-mail with a message and image attachments.
-        Images might be resized and compressed before sending.
+        The images were already buffered by the e-mail sender thread, which also queues the
+        e-mail.
 
         Param message - A text message to be displayed in the e-mail.
         Param current_frame - The current frame because it contains the current time.
         """
 
-        email = gpgmailmessage.GpgMailMessage()
-
-        email.set_subject(self.config.motion_detection_email_subject)
-        email.set_body(
-            '%s E-mail queued at %s. Current abs_diff_mean_total: %f' %
-            (message, current_frame['time'].strftime('%Y-%m-%d %H:%M:%S.%f'),
-             current_frame['abs_diff_mean_total']))
-
-        # Process all the frames
-        for frame in self.email_frames:
-
-            # Resize for e-mail or don't resize if images is smaller than desired resolution.
-            desired_image_width = self.config.email_image_width  # In pixels
-            # depth is discarded
-            current_image_height, current_image_width, depth = frame['rotated_image'].shape
-            if desired_image_width < current_image_width:
-                # Images are scaled proportionally.
-                desired_image_height = int(desired_image_width * (current_image_height /
-                                                                  current_image_width))
-                small_frame = cv2.resize(frame['rotated_image'],
-                                         (desired_image_width, desired_image_height))
-            else:
-                small_frame = frame['rotated_image']
-
-            # Save the file in memory
-            ret, small_jpeg = cv2.imencode('.jpg', small_frame)
+        body = '%s E-mail queued at %s. Current abs_diff_mean_total: %f' % (
+            message, current_frame.get_datetime().strftime('%Y-%m-%d %H:%M:%S.%f'),
+            current_frame.abs_diff_mean_total)
 
-            # Attach the image to the email message
-            # Warning: Making this filename too long causes the signature to fail for some
-            #   unknown reason.
-            image_filename = '%s-sm.jpg' % frame['time'].strftime('%Y-%m-%d_%H-%M-%S_%f')
-            email.add_attachment(image_filename, small_jpeg)
-
-        del self.email_frames[:]
+        self.email_image_count = 0
 
         self.logger.info('Sending "%s" e-mail.', message)
-        email.queue_for_sending()
+        self.event_email_count += 1
+        self.email_sender.queue_email(
+            self.config.motion_detection_email_subject, body, include_buffered_images=True)
 
-        self.last_email_sent_time = current_frame['time']
+        self.last_email_sent_time = current_frame.time_ns
 
+    @stagetimer.timed_method('_mark_for_saving_and_rotate')
     def _mark_for_saving_and_rotate(self, frame):
         """Rotates an image either 0, 90, 180, or 270 degrees. Rotation angle is dictated by
         the configuration variable 'image_rotation_angle'.
         """
 
         # Don't do this operation if the frame has already been marked for saving.
-        if frame['save'] is False:
+        if frame.save is False:
 
-            frame['save'] = True
+            frame.save = True
 
             rotation_angle = self.config.image_rotation_angle
 
-            # Don't rotate the image if the rotation angle is 0 (as an optimization).
-            if rotation_angle == 0:
-                frame['rotated_image'] = frame['image']
+            # Don't rotate the image if the rotation angle is 0 (as an optimization).  MJPEG
+            #   frames are then saved and e-mailed as the camera's JPEG.  The media worker
+            #   process rotates images itself.
+            if rotation_angle == 0 or self.media_worker_client is not None:
+                frame.rotated_image = frame.image
+                if frame.mjpeg_image is not None:
+                    frame.rotated_image = frame.mjpeg_image
             else:
 
-                (height, width) = frame['image'].shape[:2]
+                image = frame.image
+                if frame.mjpeg_image is not None:
+                    image = frame.mjpeg_image.decode()
+
+                (height, width) = image.shape[:2]
                 (center_x, center_y) = (width / 2.0, height / 2.0)
 
                 # Create the rotation matrix with the angle adjusted to turn the image
@@ -476,15 +984,15 @@ class WatchmanSubprocess():
                     rotation_matrix[1, 2] += (height / 2.0) - center_y
 
                 # Actually do the rotation.
-                frame['rotated_image'] = cv2.warpAffine(
-                    frame['image'], rotation_matrix, (width, height))
+                frame.rotated_image = cv2.warpAffine(
+                    image, rotation_matrix, (width, height))
 
                 self.logger.trace('Image marked for local save at %s.' %
-                                  frame['time'].strftime('%Y-%m-%d %H:%M:%S.%f'))
+                                  frame.get_datetime().strftime('%Y-%m-%d %H:%M:%S.%f'))
 
                 # Show the images while testing.
-                #cv2.imshow('Image Before Rotation', frame['image'])
-                #cv2.imshow('Rotated Image', frame['rotated_image'])
+                #cv2.imshow('Image Before Rotation', frame.image)
+                #cv2.imshow('Rotated Image', frame.rotated_image)
                 #cv2.waitKey(0)
 
     # TODO: This is probably temporary code to quickly get around a bug.  This is why this
@@ -497,6 +1005,7 @@ class WatchmanSubprocess():
         # If motion is no longer detected, remove the replacement subtractor.
         if self.first_trigger_motion is None:
             self.replacement_subtractor = None
+            self.learning_rate_boost_frame_count = 0
             self.subtractor_motion_start_time = None
 
         # Start the subtractor motion start time
@@ -504,46 +1013,417 @@ class WatchmanSubprocess():
                 self.subtractor_motion_start_time is None:
             self.subtractor_motion_start_time = self.first_trigger_motion
 
-        # Increment the replacement subtractor frame count if it has processed frames.
-        if self.replacement_subtractor is not None:
-            self.replacement_subtractor_frame_count += 1
-
         # See if enough time has passed since first motion detection to create a replacement
         #   background subtractor.
         if self.first_trigger_motion is not None and self._did_threshold_trigger(
                 self.subtractor_motion_start_time, last_frame, current_frame,
                 self.config.replacement_subtractor_creation_threshold):
-            self.logger.info('Creating replacement background subtractor.')
-            self.replacement_subtractor = self._create_background_subtractor()
-            self.replacement_subtractor_frame_count = 0
+            self.subtractor_reset_seconds = 0.0
+            if self.config.subtractor_reset_strategy == 'boost':
+                # Boost for the same number of frames used to initiate the main subtractor
+                #   on program start.
+                self.logger.info('Boosting background subtractor learning rate.')
+                self.learning_rate_boost_frame_count = max(
+                    self.config.initial_frame_skip_count, 1)
+                self.subtractor_motion_start_time = current_frame.time_ns
+            else:
+                self.logger.info('Creating replacement background subtractor.')
+                self.replacement_subtractor = self._create_background_subtractor()
+                self.replacement_subtractor_frame_count = 0
+                self.replacement_subtractor_offered_frame_count = 0
 
         # Collect a certain number of frames before we replace the main subtractor. Use
         #   the same number of frames used to initiate the main subtractor on program start.
         if self.replacement_subtractor is not None and \
                 self.replacement_subtractor_frame_count > \
                 self.config.initial_frame_skip_count:
-            self.logger.info('Replacing main background subtractor.')
+            self.logger.info('Replacing main background subtractor. Training took %.3f '
+                             'seconds.', self.subtractor_reset_seconds)
             self.subtractor = self.replacement_subtractor
             self.replacement_subtractor = None
-            self.subtractor_motion_start_time = current_frame['time']
+            self.subtractor_motion_start_time = current_frame.time_ns
+
+    def _format_metrics(self):
+        """Returns the stage timings, frame rate, queue depths, and counts in the
+        Prometheus text format.  Called periodically from the metrics writer thread.
+        """
+        now = time.monotonic()
+        frame_count = self.stage_timer.frame_count
+        frames_per_second = (frame_count - self.metrics_last_frame_count) / max(
+            now - self.metrics_last_time, .001)
+        self.metrics_last_frame_count = frame_count
+        self.metrics_last_time = now
+
+        # (name, type, help, value) of each metric other than the stage timings.
+        metric_values = [
+            ('watchman_frames_per_second', 'gauge',
+             'Frames processed per second since the last metrics write.', frames_per_second),
+            ('watchman_idle_skipped_frames_total', 'counter',
+             'Captured frames skipped to keep to idle_frames_per_second.',
+             self.get_idle_skipped_frame_count()),
+            ('watchman_dropped_frames_total', 'counter',
+             'Captured frames dropped because the capture buffer was full.',
+             self.capture_thread.dropped_frame_count),
+            ('watchman_motion_frames_total', 'counter',
+             'Frames that were different from the frame before them.',
+             self.motion_frame_count),
+            ('watchman_motion_events_total', 'counter', 'Motion events detected.',
+             self.motion_event_count)]
+        if self.media_worker_client is None:
+            metric_values.extend(mediaworker.get_media_metric_values(
+                self.image_writer, self.email_sender))
+        else:
+            # The media worker writes the rest of the e-mail and image metrics.
+            metric_values.extend([
+                ('watchman_media_worker_buffer_bytes', 'gauge',
+                 'Bytes of shared memory used by images waiting for the media worker.',
+                 self.media_worker_client.shared_buffer.used_bytes),
+                ('watchman_media_worker_dropped_images_total', 'counter',
+                 'Images dropped because media_worker_buffer_bytes was reached.',
+                 self.media_worker_client.dropped_image_count +
+                 self.media_worker_client.dropped_attachment_count)])
+        if self.clip_writer is not None:
+            metric_values.extend([
+                ('watchman_clip_write_queue_depth', 'gauge',
+                 'Clip frames waiting to be encoded.', self.clip_writer.write_queue.qsize()),
+                ('watchman_dropped_clip_frames_total', 'counter',
+                 'Clip frames dropped because the write queue was full.',
+                 self.clip_writer.dropped_frame_count)])
+
+        lines = [self.stage_timer.format_prometheus(self.metrics_labels)]
+        for name, metric_type, help_text, value in metric_values:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            lines.append('%s{%s} %s' % (name, self.metrics_labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def _create_media_worker_client(self, config_pathname, log_pathname, media_worker_fd):
+        """Connects to the media worker process, starting it first if watchmand did not.
+
+        config_pathname: The configuration file the media worker reads.
+        log_pathname: The file this process logs to.  A media worker started here logs to
+          the same directory.
+        media_worker_fd: The file descriptor of the socket connected to the media worker, or
+          None.
+        Returns the mediaworker.MediaWorkerClient.
+        """
+        worker_process = None
+        if media_worker_fd is None:
+            camera_name = self.config.camera_name
+            arguments = [
+                '--config', config_pathname, '--camera', camera_name,
+                '--log', os.path.join(os.path.dirname(log_pathname),
+                                      'watchman-mediaworker-%s.log' % camera_name),
+                '--metrics', mediaworker.get_media_worker_metrics_pathname(
+                    self.metrics_pathname)]
+            if self.mail_sink is not None:
+                arguments.extend(['--email-dir', self.mail_sink.output_directory])
+            self.logger.info('Starting media worker.')
+            worker_process, worker_socket = mediaworker.start_media_worker(
+                MEDIA_WORKER_PATHNAME, arguments)
+        else:
+            worker_socket = socket.fromfd(
+                media_worker_fd, socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            os.close(media_worker_fd)
+
+        return mediaworker.MediaWorkerClient(
+            worker_socket, self.config.media_worker_buffer_bytes,
+            self.config.image_writer_full_policy, self.stage_timer, worker_process)
 
     def _create_background_subtractor(self):
         """Creates and returns a background subtractor."""
-        # I typically hate one line methods, but it is used in two places and is likely to
-        #   change.
-
-        # TODO: Consider using Python 3's more advanced background subtraction algorithms.
-        #   (issue 8)
-        return cv2.bgsegm.createBackgroundSubtractorMOG()
-        #return cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(3,3))
-
-
-# TODO: Consider making sure this class owns the process. (issue 9)
-watchman_subprocess = WatchmanSubprocess()
-try:
-    watchman_subprocess.start_loop()
-except Exception as exception:  # pylint: disable=broad-except
-    # TODO: This is using an internal object variable. Will probably be solved when we fix
-    #   gpgmailer issue 18.
-    watchman_subprocess.logger.critical('Fatal %s: %s\n%s', type(exception).__name__,
-                                        str(exception), traceback.format_exc())
+        # I typically hate one line methods, but it is used in two places.
+        return backgroundsubtractor.create_background_subtractor(
+            self.config.background_subtractor, self.config.background_subtractor_parameters)
+
+
+def parse_arguments():
+    """Parses the command line.  With no arguments, the configured camera is monitored.
+    Returns the parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Monitors a camera for motion.  Can instead replay recorded footage to '
+        'benchmark the capture loop.')
+    parser.add_argument(
+        '--replay', metavar='SOURCE', dest='replay_source_pathname',
+        help='Read frames from this video file or directory of images instead of the '
+        'camera.  E-mails and images are written to --output-dir and a per-stage timing '
+        'report is printed on completion.')
+    parser.add_argument(
+        '--replay-fps', type=float, help='The frame rate used to timestamp replayed frames. '
+        'Defaults to the rate reported by the video file.')
+    parser.add_argument(
+        '--compare-subtractors', action='store_true',
+        help='Replay the footage once with each background subtractor and print the '
+        'per-frame cost and trigger counts of each.  Subtractors other than the configured '
+        'one use their default parameters.')
+    parser.add_argument(
+        '--tune', metavar='CLIP_LIST', dest='clip_list_pathname',
+        help='Replay every clip in this list once and print how many of the motion clips '
+        'and false alarms each combination of --sweep values detects.  Each line of the '
+        'list is motion or none followed by a clip pathname.')
+    parser.add_argument(
+        '--sweep', metavar='OPTION=VALUES', action='append', default=[],
+        type=parametersweep.parse_sweep_values,
+        help='A threshold to tune and the comma separated values to try.  (e.g. '
+        'pixel_difference_threshold=3,4.5,6)  May be repeated.  Options that are not swept '
+        'keep their configured values.')
+    parser.add_argument(
+        '--processes', type=int, default=os.cpu_count(),
+        help='The number of processes used by --tune.  (Default: %(default)s)')
+    parser.add_argument(
+        '--config', dest='config_pathname', default=CONFIGURATION_PATHNAME,
+        help='The configuration file to read.  (Default: %(default)s)')
+    parser.add_argument(
+        '--camera', dest='camera_name',
+        help='The name of the camera to monitor.  Defaults to the first camera listed in '
+        'the configuration file.')
+    parser.add_argument(
+        '--interactive', action='store_true',
+        help='Check for the q key between frames.  Only useful when debugging with windows '
+        'open.')
+    parser.add_argument(
+        '--media-worker-fd', type=int,
+        help='The file descriptor of the socket connected to the camera\'s media worker.  '
+        'Passed by watchmand when media_worker is process.')
+    parser.add_argument(
+        '--output-dir', help='Where replayed e-mails, saved images, and the log are '
+        'written.  Required with --replay.')
+
+    arguments = parser.parse_args()
+    if arguments.replay_source_pathname is not None and arguments.output_dir is None:
+        parser.error('--output-dir is required with --replay.')
+    if arguments.clip_list_pathname is not None:
+        if arguments.output_dir is None:
+            parser.error('--output-dir is required with --tune.')
+        if arguments.replay_source_pathname is not None:
+            parser.error('--tune replays the listed clips and cannot be used with --replay.')
+        if arguments.processes < 1:
+            parser.error('--processes must be greater than 0.')
+    elif arguments.sweep:
+        parser.error('--sweep requires --tune.')
+    if arguments.compare_subtractors and arguments.replay_source_pathname is None:
+        parser.error('--compare-subtractors requires --replay.')
+
+    return arguments
+
+
+def create_watchman_subprocess(arguments, output_dir=None, config_overrides=None,
+                               record_differences=False):
+    """Creates the WatchmanSubprocess described by the command line arguments.
+
+    arguments: The parsed command line arguments.
+    output_dir: Where a replay's e-mails, images, and log are written.
+    config_overrides: A dictionary of option names to string values that replace the values
+      in the configuration file.
+    record_differences: Whether the WatchmanSubprocess keeps the abs_diff_mean_total of
+      every frame.
+    Returns the WatchmanSubprocess.
+    """
+    if arguments.replay_source_pathname is None:
+        return WatchmanSubprocess(config_pathname=arguments.config_pathname,
+                                  camera_name=arguments.camera_name,
+                                  interactive=arguments.interactive,
+                                  media_worker_fd=arguments.media_worker_fd)
+
+    images_path = os.path.join(output_dir, 'images')
+    os.makedirs(images_path, exist_ok=True)
+    return WatchmanSubprocess(
+        config_pathname=arguments.config_pathname,
+        camera_name=arguments.camera_name,
+        log_pathname=os.path.join(output_dir, 'watchman-subprocess.log'),
+        images_path=images_path,
+        footage_index_pathname=os.path.join(output_dir, 'footage.sqlite'),
+        metrics_pathname=os.path.join(output_dir, 'metrics.prom'),
+        replay_source_pathname=arguments.replay_source_pathname,
+        replay_fps=arguments.replay_fps,
+        mail_sink=watchmanreplay.LocalMailSink(os.path.join(output_dir, 'email')),
+        config_overrides=config_overrides, interactive=arguments.interactive,
+        record_differences=record_differences)
+
+
+def run_watchman_subprocess(watchman_subprocess):
+    """Runs the capture loop and logs any fatal exception.  Returns whether the loop
+    finished without an exception.
+    """
+    try:
+        watchman_subprocess.start_loop()
+    except Exception as exception:  # pylint: disable=broad-except
+        # TODO: This is using an internal object variable. Will probably be solved when we
+        #   fix gpgmailer issue 18.
+        watchman_subprocess.logger.critical('Fatal %s: %s\n%s', type(exception).__name__,
+                                            str(exception), traceback.format_exc())
+        return False
+    return True
+
+
+def print_replay_report(watchman_subprocess):
+    """Prints the timing report and totals of a finished replay."""
+    print(watchman_subprocess.stage_timer.format_report())
+    if watchman_subprocess.capture_thread is not None:
+        print('Dropped %d captured frames.' % (
+            watchman_subprocess.capture_thread.dropped_frame_count))
+    print('Skipped %d frames at the idle frame rate.' % (
+        watchman_subprocess.get_idle_skipped_frame_count()))
+    if watchman_subprocess.image_writer is not None:
+        print('Dropped %d locally saved images.' % (
+            watchman_subprocess.image_writer.dropped_image_count))
+    if watchman_subprocess.clip_writer is not None:
+        print('Dropped %d clip frames.' % (
+            watchman_subprocess.clip_writer.dropped_frame_count))
+    print('%d frames were different from the frame before them in %d motion events.' % (
+        watchman_subprocess.motion_frame_count, watchman_subprocess.motion_event_count))
+    print('Dropped %d e-mail images.' % (
+        watchman_subprocess.email_sender.dropped_attachment_count))
+    # Otherwise, the media worker already printed its own totals.
+    if watchman_subprocess.media_worker_client is None:
+        print('Wrote %d e-mails with %d attachments.' % (
+            watchman_subprocess.mail_sink.email_count,
+            watchman_subprocess.mail_sink.attachment_count))
+
+
+def compare_background_subtractors(arguments):
+    """Replays the same footage with every background subtractor and prints a table of
+    their costs and trigger counts.
+    """
+    config_parser = configparser.ConfigParser()
+    config_parser.read(arguments.config_pathname)
+    camera_name = arguments.camera_name
+    if camera_name is None:
+        camera_name = watchmanconfig.read_camera_names(config_parser)[0]
+    config_parser = watchmanconfig.create_camera_config_parser(config_parser, camera_name)
+    configured_subtractor_name = config_parser.get(
+        watchmanconfig.GENERAL_SECTION, 'background_subtractor').strip().lower()
+
+    rows = []
+    for subtractor_name in backgroundsubtractor.SUBTRACTOR_PARAMETERS:
+        print('Replaying with the %s background subtractor.' % subtractor_name)
+        # E-mails are counted in this process.  Every frame is processed, because which
+        #   frames are skipped at the idle rate depends on each subtractor's detections.
+        config_overrides = {'background_subtractor': subtractor_name,
+                            'idle_frames_per_second': '0', 'media_worker': 'thread'}
+        # Tuning parameters are specific to the configured subtractor.
+        if subtractor_name != configured_subtractor_name:
+            config_overrides['background_subtractor_parameters'] = 'none'
+        watchman_subprocess = create_watchman_subprocess(
+            arguments, os.path.join(arguments.output_dir, subtractor_name), config_overrides)
+        run_watchman_subprocess(watchman_subprocess)
+        print_replay_report(watchman_subprocess)
+
+        stage_timer = watchman_subprocess.stage_timer
+        apply_stage = stage_timer.stages.get('subtractor.apply')
+        apply_milliseconds = 0.0
+        if apply_stage is not None and apply_stage.count:
+            apply_milliseconds = apply_stage.total_seconds / apply_stage.count * 1000
+        rows.append((subtractor_name, stage_timer.frame_count, apply_milliseconds,
+                     watchman_subprocess.motion_frame_count,
+                     watchman_subprocess.motion_event_count,
+                     watchman_subprocess.mail_sink.email_count))
+
+    print('%-12s %8s %14s %14s %14s %8s' % (
+        'subtractor', 'frames', 'apply (ms)', 'motion frames', 'motion events', 'e-mails'))
+    for row in rows:
+        print('%-12s %8d %14.3f %14d %14d %8d' % row)
+
+
+def record_clip_differences(arguments, clip_pathname, output_dir):
+    """Replays one clip, processing every frame, and returns the abs_diff_mean_total of
+    each frame.  Runs in a pool process.
+
+    arguments: The parsed command line arguments.
+    clip_pathname: The clip's video file or directory of images.
+    output_dir: Where the replay's e-mails, images, and log are written.
+    Returns a (times_ns, abs_diff_mean_totals) tuple of arrays, or None if the replay
+    failed.
+    """
+    clip_arguments = argparse.Namespace(**vars(arguments))
+    clip_arguments.replay_source_pathname = clip_pathname
+    # Skipped frames would not be evaluated against the swept thresholds.  Nothing is gained
+    #   from a media worker process when every core is already replaying a clip.
+    config_overrides = {'idle_frames_per_second': '0', 'media_worker': 'thread'}
+    watchman_subprocess = create_watchman_subprocess(
+        clip_arguments, output_dir, config_overrides, record_differences=True)
+    if not run_watchman_subprocess(watchman_subprocess):
+        return None
+    frame_differences = watchman_subprocess.frame_differences
+    return (numpy.array([time_ns for time_ns, _ in frame_differences], dtype=numpy.int64),
+            numpy.array([total for _, total in frame_differences], dtype=numpy.float64))
+
+
+def tune_parameters(arguments):
+    """Replays the listed clips once each and prints the detections and false alarms of
+    every combination of the swept thresholds.  Recorded clips are cached in the output
+    directory, so tuning the same clips again only evaluates the thresholds.
+    """
+    try:
+        clips = parametersweep.read_clip_labels(arguments.clip_list_pathname)
+    except (OSError, ValueError) as exception:
+        print('Could not read the clip list. %s' % exception)
+        return
+
+    config_parser = configparser.ConfigParser()
+    config_parser.read(arguments.config_pathname)
+    camera_name = arguments.camera_name
+    if camera_name is None:
+        camera_name = watchmanconfig.read_camera_names(config_parser)[0]
+    config_parser = watchmanconfig.create_camera_config_parser(config_parser, camera_name)
+    config = watchmanconfig.WatchmanConfig(config_parser, camera_name)
+    if config.motion_metric != 'mean':
+        print('Only the mean motion metric can be tuned. Set motion_metric to mean.')
+        return
+
+    difference_cache = parametersweep.DifferenceCache(
+        os.path.join(arguments.output_dir, 'cache'))
+    config_items = config_parser.items(watchmanconfig.GENERAL_SECTION)
+    cache_keys = [difference_cache.create_key(clip.pathname, arguments.replay_fps,
+                                              config_items) for clip in clips]
+    clip_differences = [difference_cache.load(cache_key) for cache_key in cache_keys]
+
+    # Background subtraction is the expensive part, so each clip is only replayed once,
+    #   even if it is listed more than once.
+    uncached_clip_indexes = {}
+    for clip_index, cache_key in enumerate(cache_keys):
+        if clip_differences[clip_index] is None:
+            uncached_clip_indexes.setdefault(cache_key, clip_index)
+    print('Replaying %d clips. The rest are cached.' % len(uncached_clip_indexes))
+    if uncached_clip_indexes:
+        # Each replay configures logging, so every clip gets a new process.
+        with multiprocessing.Pool(arguments.processes, maxtasksperchild=1) as pool:
+            replayed_differences = pool.starmap(record_clip_differences, [
+                (arguments, clips[clip_index].pathname, os.path.join(
+                    arguments.output_dir, 'clips', '%d-%s' % (clip_index, os.path.basename(
+                        os.path.normpath(clips[clip_index].pathname)))))
+                for clip_index in uncached_clip_indexes.values()])
+        for (cache_key, clip_index), frame_differences in zip(
+                uncached_clip_indexes.items(), replayed_differences):
+            if frame_differences is None:
+                print('Could not replay %s. See its log in %s.' % (
+                    clips[clip_index].pathname, os.path.join(arguments.output_dir, 'clips')))
+                return
+            difference_cache.save(cache_key, frame_differences)
+        clip_differences = [difference_cache.load(cache_key) for cache_key in cache_keys]
+
+    configured_values = {option_name: getattr(config, option_name)
+                         for option_name in parametersweep.SWEPT_OPTIONS}
+    parameter_combinations = parametersweep.create_parameter_combinations(
+        configured_values, arguments.sweep)
+    print('Evaluating %d combinations of thresholds.' % len(parameter_combinations))
+    results = parametersweep.sweep_parameters(
+        clip_differences, parameter_combinations, config.initial_frame_skip_count,
+        config.stop_threshold, arguments.processes)
+    print(parametersweep.format_tradeoff_table(clips, clip_differences, results))
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+
+    if arguments.compare_subtractors:
+        compare_background_subtractors(arguments)
+    elif arguments.clip_list_pathname is not None:
+        tune_parameters(arguments)
+    else:
+        # TODO: Consider making sure this class owns the process. (issue 9)
+        watchman_subprocess = create_watchman_subprocess(arguments, arguments.output_dir)
+        run_watchman_subprocess(watchman_subprocess)
+        if arguments.replay_source_pathname is not None:
+            print_replay_report(watchman_subprocess)
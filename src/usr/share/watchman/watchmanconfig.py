@@ -13,36 +13,58 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ['WatchmanConfig']
+__all__ = ['ConfigurationException', 'WatchmanConfig', 'create_camera_config_parser',
+           'read_camera_configs', 'read_camera_names']
 __author__ = 'Joel Luellwitz and Emily Frost'
 __version__ = '0.8'
 
+import configparser
 import logging
+import re
 from parkbenchcommon import confighelper
 
+# Options in a camera's section override the options in the General section.
+GENERAL_SECTION = 'General'
+CAMERA_SECTION_PREFIX = 'Camera '
+# Camera names are used in file and directory names.
+CAMERA_NAME_PATTERN = re.compile('^[A-Za-z0-9_-]+$')
+
+
+class ConfigurationException(Exception):
+    """Indicates a configuration value is not one of the values watchman understands."""
+
 
 class WatchmanConfig():
     """Loads the configuration for the 'watchman' program.  An instance of this object
     contains all the configuration values.
     """
 
-    def __init__(self, config_parser):
+    def __init__(self, config_parser, camera_name):
         """Reads the watchman configuration file and throws an exception if there is an
         error.
 
-        config_parser: The ConfigParser instance the configuration is read from.
+        config_parser: The ConfigParser instance the configuration is read from.  Usually
+          created by create_camera_config_parser.
+        camera_name: The name of the camera this configuration is for.
         """
         logger = logging.getLogger()
 
-        logger.info('Validating watchman configuration.')
+        logger.info('Validating watchman configuration for camera %s.', camera_name)
 
         config_helper = confighelper.ConfigHelper()
 
+        # Names the camera's subprocess, log file, and image directory.
+        self.camera_name = camera_name
+
         # The number of the video device we want to capture photos with. Corresponds to the
         #   video device number that is in the Linux /dev directory.
         self.video_device_number = config_helper.verify_integer_within_range(
             config_parser, 'video_device_number', lower_bound=0)
 
+        # The CPUs the camera's subprocess is allowed to run on. None means any CPU.
+        self.cpu_affinity = self._verify_cpu_list(
+            config_helper, config_parser, 'cpu_affinity')
+
         # Skips this many frames before detecting motion.  Gives the camera a chance to warm
         #   up.  Set to zero to disable.
         self.initial_frame_skip_count = config_helper.verify_integer_within_range(
@@ -60,6 +82,27 @@ class WatchmanConfig():
         # How much the two frames have to vary to be considered different
         self.pixel_difference_threshold = config_helper.verify_number_within_range(
             config_parser, 'pixel_difference_threshold', lower_bound=0)
+        # How frames are judged different. 'mean' compares abs_diff_mean_total to
+        #   pixel_difference_threshold. 'grid' counts the grid cells where enough pixels
+        #   changed.
+        self.motion_metric = self._verify_string_in_list(
+            config_helper, config_parser, 'motion_metric', ('mean', 'grid'))
+        # The number of (columns, rows) the detection area is divided into.
+        self.motion_grid_size = self._verify_grid_size(
+            config_helper, config_parser, 'motion_grid_size')
+        # The fraction of a cell's pixels that must change for the cell to be active.
+        self.motion_grid_cell_threshold = config_helper.verify_number_within_range(
+            config_parser, 'motion_grid_cell_threshold', lower_bound=0)
+        if self.motion_grid_cell_threshold == 0 or self.motion_grid_cell_threshold > 1:
+            raise ConfigurationException(
+                'motion_grid_cell_threshold must be greater than 0 and no more than 1.')
+        # How many cells must be active for the frame to be different.
+        self.motion_grid_active_cells = config_helper.verify_integer_within_range(
+            config_parser, 'motion_grid_active_cells', lower_bound=1)
+        if self.motion_grid_active_cells > \
+                self.motion_grid_size[0] * self.motion_grid_size[1]:
+            raise ConfigurationException(
+                'motion_grid_active_cells cannot be more than the number of grid cells.')
         self.first_email_image_save_times = config_helper.verify_number_list_exists(
             config_parser, 'first_email_image_save_times')
         # Time in seconds before first e-mail
@@ -75,6 +118,9 @@ class WatchmanConfig():
         # Time in seconds since second e-mail
         self.third_email_delay = config_helper.verify_number_within_range(
             config_parser, 'third_email_delay', lower_bound=0)
+        # More follow up e-mails sent after the third, as (delay, image_save_times) tuples.
+        self.additional_follow_up_emails = self._verify_follow_up_email_list(
+            config_helper, config_parser, 'additional_follow_up_emails')
         self.subsequent_email_image_save_times = config_helper.verify_number_list_exists(
             config_parser, 'subsequent_email_image_save_times')
         # Time in seconds since last e-mail
@@ -83,12 +129,35 @@ class WatchmanConfig():
         # Time in seconds since last e-mail triggering motion
         self.stop_threshold = config_helper.verify_number_within_range(
             config_parser, 'stop_threshold', lower_bound=0)
+        # How many frames per second are processed while there is no motion. Every frame is
+        #   processed from the first frame over pixel_difference_threshold until
+        #   stop_threshold. 0 to always process every frame.
+        self.idle_frames_per_second = config_helper.verify_number_within_range(
+            config_parser, 'idle_frames_per_second', lower_bound=0)
         # The maximum image width for images sent via the e-mail.  If the image width is
         #   smaller than this value, the image is sent as captured.  If the image width is
         #   larger than this value, the image is scaled proportionally before it is sent.
         self.email_image_width = config_helper.verify_integer_within_range(
             config_parser, 'email_image_width', lower_bound=1)
 
+        # How many seconds of images from before motion is detected are kept for the first
+        #   e-mail. 0 disables this.
+        self.pre_trigger_seconds = config_helper.verify_number_within_range(
+            config_parser, 'pre_trigger_seconds', lower_bound=0)
+        # How many images per second are kept from before motion is detected.
+        self.pre_trigger_images_per_second = config_helper.verify_number_within_range(
+            config_parser, 'pre_trigger_images_per_second', lower_bound=0)
+        if self.pre_trigger_images_per_second == 0:
+            raise ConfigurationException(
+                'pre_trigger_images_per_second must be greater than 0.')
+
+        # The maximum total size, in bytes, of the encoded images waiting to be e-mailed.
+        self.email_image_buffer_max_bytes = config_helper.verify_integer_within_range(
+            config_parser, 'email_image_buffer_max_bytes', lower_bound=1)
+        # The maximum total size, in bytes, of the images attached to one e-mail.
+        self.email_max_bytes = config_helper.verify_integer_within_range(
+            config_parser, 'email_max_bytes', lower_bound=1)
+
         # Angle to rotate the images before they are saved or e-mailed. Only values of 0, 90,
         #   180, or 270 are permitted. This is useful if your camera is placed sideways or
         #   upside down.
@@ -99,6 +168,24 @@ class WatchmanConfig():
         self.image_save_throttle_delay = config_helper.verify_number_within_range(
             config_parser, 'image_save_throttle_delay', lower_bound=0)
 
+        # How images are saved locally during motion. 'images' saves a JPEG every
+        #   image_save_throttle_delay seconds. 'clip' saves each motion event as a video.
+        self.local_save_mode = self._verify_string_in_list(
+            config_helper, config_parser, 'local_save_mode', ('images', 'clip'))
+        # The frame rate of motion event clips.
+        self.clip_fps = config_helper.verify_number_within_range(
+            config_parser, 'clip_fps', lower_bound=0)
+        if self.clip_fps == 0:
+            raise ConfigurationException('clip_fps must be greater than 0.')
+        # The four character code of the codec motion event clips are encoded with.
+        self.clip_fourcc = config_helper.verify_string_exists(config_parser, 'clip_fourcc')
+        if len(self.clip_fourcc) != 4:
+            raise ConfigurationException('clip_fourcc must be exactly four characters.')
+
+        # How many seconds the subprocess is profiled for after receiving SIGUSR1.
+        self.profile_seconds = config_helper.verify_integer_within_range(
+            config_parser, 'profile_seconds', lower_bound=1)
+
         # Subject for still running notification.
         self.still_running_email_subject = config_helper.verify_string_exists(
             config_parser, 'still_running_email_subject')
@@ -110,3 +197,331 @@ class WatchmanConfig():
         self.replacement_subtractor_creation_threshold = \
             config_helper.verify_number_within_range(
                 config_parser, 'replacement_subtractor_creation_threshold', lower_bound=0)
+        # How the background is relearned during long motion. 'replace' trains a second
+        #   subtractor and swaps it in. 'boost' temporarily raises the main subtractor's
+        #   learning rate instead.
+        self.subtractor_reset_strategy = self._verify_string_in_list(
+            config_helper, config_parser, 'subtractor_reset_strategy', ('replace', 'boost'))
+        # The replacement subtractor is only trained on every this many frames.
+        self.replacement_subtractor_frame_interval = \
+            config_helper.verify_integer_within_range(
+                config_parser, 'replacement_subtractor_frame_interval', lower_bound=1)
+        # The learning rate used by the 'boost' reset strategy.
+        self.replacement_learning_rate = config_helper.verify_number_within_range(
+            config_parser, 'replacement_learning_rate', lower_bound=0)
+        if self.replacement_learning_rate > 1:
+            raise ConfigurationException('replacement_learning_rate must be from 0 to 1.')
+
+        # How frames are read from the camera. 'decoded' lets OpenCV decode every frame.
+        #   'mjpeg' keeps the camera's JPEG for saving and e-mailing and only decodes a
+        #   reduced size copy for motion detection.
+        self.capture_mode = self._verify_string_in_list(
+            config_helper, config_parser, 'capture_mode', ('decoded', 'mjpeg'))
+
+        # The maximum number of captured frames waiting to be processed.
+        self.capture_buffer_size = config_helper.verify_integer_within_range(
+            config_parser, 'capture_buffer_size', lower_bound=1)
+        # Which frame is discarded when the capture buffer is full. Either 'oldest' or
+        #   'newest'.
+        self.capture_buffer_drop_policy = self._verify_string_in_list(
+            config_helper, config_parser, 'capture_buffer_drop_policy',
+            ('oldest', 'newest'))
+
+        # The number of threads that encode and write locally saved images.
+        self.image_writer_thread_count = config_helper.verify_integer_within_range(
+            config_parser, 'image_writer_thread_count', lower_bound=1)
+        # The maximum number of images waiting to be written locally.
+        self.image_writer_queue_size = config_helper.verify_integer_within_range(
+            config_parser, 'image_writer_queue_size', lower_bound=1)
+        # What to do when the image write queue is full. Either 'wait' or 'drop'.
+        self.image_writer_full_policy = self._verify_string_in_list(
+            config_helper, config_parser, 'image_writer_full_policy', ('wait', 'drop'))
+
+        # Where images are rotated, encoded, saved, and e-mailed. 'thread' uses background
+        #   threads of the camera's subprocess. 'process' hands frames to a separate media
+        #   worker process through shared memory.
+        self.media_worker = self._verify_string_in_list(
+            config_helper, config_parser, 'media_worker', ('thread', 'process'))
+        # The size of the shared memory frames wait in for the media worker.
+        self.media_worker_buffer_bytes = config_helper.verify_integer_within_range(
+            config_parser, 'media_worker_buffer_bytes', lower_bound=1)
+        # The CPUs the camera's media worker is allowed to run on. None means any CPU.
+        self.media_worker_cpu_affinity = self._verify_cpu_list(
+            config_helper, config_parser, 'media_worker_cpu_affinity')
+
+        # Scale applied to frames before motion detection. Saved and e-mailed images always
+        #   use the full resolution. Must be greater than 0 and no more than 1.
+        self.detection_scale = config_helper.verify_number_within_range(
+            config_parser, 'detection_scale', lower_bound=0)
+        if self.detection_scale == 0 or self.detection_scale > 1:
+            raise ConfigurationException(
+                'detection_scale must be greater than 0 and no more than 1.')
+        # Whether motion detection uses 'color' or 'grayscale' frames.
+        self.detection_color_mode = self._verify_string_in_list(
+            config_helper, config_parser, 'detection_color_mode', ('color', 'grayscale'))
+
+        # Polygons, in captured (unrotated) frame pixels, that are checked for motion. Frames
+        #   are cropped to the bounding box of these regions before background subtraction.
+        #   An empty list means the whole frame.
+        self.detection_regions = self._verify_region_list(
+            config_helper, config_parser, 'detection_regions', 'all')
+        # Polygons, in captured (unrotated) frame pixels, that are ignored when checking for
+        #   motion. An empty list means nothing is ignored.
+        self.detection_exclusions = self._verify_region_list(
+            config_helper, config_parser, 'detection_exclusions', 'none')
+
+        # The background subtraction algorithm. One of 'mog', 'mog2', 'knn', 'cnt', or
+        #   'difference'.
+        self.background_subtractor = self._verify_string_in_list(
+            config_helper, config_parser, 'background_subtractor',
+            ('mog', 'mog2', 'knn', 'cnt', 'difference'))
+        # Tuning parameters passed to the background subtractor. An empty dictionary uses
+        #   the defaults.
+        self.background_subtractor_parameters = self._verify_parameter_dictionary(
+            config_helper, config_parser, 'background_subtractor_parameters')
+        # How quickly the background model adapts, from 0 (never) to 1 (only the last
+        #   frame). -1 lets the subtractor choose.
+        self.background_subtractor_learning_rate = config_helper.verify_number_within_range(
+            config_parser, 'background_subtractor_learning_rate', lower_bound=-1)
+        if self.background_subtractor_learning_rate > 1 or \
+                -1 < self.background_subtractor_learning_rate < 0:
+            raise ConfigurationException(
+                'background_subtractor_learning_rate must be -1 or from 0 to 1.')
+
+    def _verify_cpu_list(self, config_helper, config_parser, key):
+        """Reads a comma separated list of CPU numbers and throws an exception if it cannot
+        be parsed.
+
+        config_helper: The ConfigHelper instance used to read the option.
+        config_parser: The ConfigParser instance the option is read from.
+        key: The name of the option.
+        Returns a set of CPU numbers or None if the option is 'none'.
+        """
+        value = config_helper.verify_string_exists(config_parser, key)
+        if value.strip().lower() == 'none':
+            return None
+
+        cpus = set()
+        for cpu_text in value.split(','):
+            try:
+                cpu = int(cpu_text)
+            except ValueError as value_error:
+                raise ConfigurationException(
+                    '%s must be \'none\' or a comma separated list of CPU numbers.' %
+                    key) from value_error
+            if cpu < 0:
+                raise ConfigurationException('%s cannot contain negative numbers.' % key)
+            cpus.add(cpu)
+
+        return cpus
+
+    def _verify_grid_size(self, config_helper, config_parser, key):
+        """Reads a grid size written as 'columnsxrows' and throws an exception if it
+        cannot be parsed.  (e.g. '8x6')
+
+        config_helper: The ConfigHelper instance used to read the option.
+        config_parser: The ConfigParser instance the option is read from.
+        key: The name of the option.
+        Returns a (columns, rows) tuple of integers.
+        """
+        value = config_helper.verify_string_exists(config_parser, key)
+        try:
+            columns, rows = (int(size_text) for size_text in value.lower().split('x'))
+        except ValueError as value_error:
+            raise ConfigurationException(
+                '%s must be written as columnsxrows. (e.g. 8x6)' % key) from value_error
+        if columns < 1 or rows < 1:
+            raise ConfigurationException('%s must have at least one column and row.' % key)
+        return columns, rows
+
+    def _verify_string_in_list(self, config_helper, config_parser, key, valid_values):
+        """Reads a case insensitive string option and throws an exception if it is not one
+        of the valid values.
+
+        config_helper: The ConfigHelper instance used to read the option.
+        config_parser: The ConfigParser instance the option is read from.
+        key: The name of the option.
+        valid_values: A sequence of the permitted lowercase values.
+        Returns the lowercase option value.
+        """
+        value = config_helper.verify_string_exists(config_parser, key).lower()
+        if value not in valid_values:
+            raise ConfigurationException('%s must be one of: %s.' % (
+                key, ', '.join(valid_values)))
+        return value
+
+    def _verify_region_list(self, config_helper, config_parser, key, empty_keyword):
+        """Reads a list of image regions and throws an exception if it cannot be parsed.
+        Regions are separated by semicolons.  Each region is a whitespace separated list of
+        'x,y' points.  Two points describe a rectangle by its opposite corners.  Three or
+        more points describe a polygon.
+
+        config_helper: The ConfigHelper instance used to read the option.
+        config_parser: The ConfigParser instance the option is read from.
+        key: The name of the option.
+        empty_keyword: The case insensitive value that means no regions are listed.
+        Returns a list of regions.  Each region is a list of (x, y) integer tuples.
+          Rectangles are converted to four point polygons.
+        """
+        value = config_helper.verify_string_exists(config_parser, key)
+        if value.strip().lower() == empty_keyword:
+            return []
+
+        regions = []
+        for region_text in value.split(';'):
+            points = []
+            for point_text in region_text.split():
+                try:
+                    x, y = point_text.split(',')
+                    points.append((int(x), int(y)))
+                except ValueError as value_error:
+                    raise ConfigurationException(
+                        '%s contains the invalid point "%s". Points must be written as '
+                        'x,y.' % (key, point_text)) from value_error
+
+            if len(points) == 2:
+                (left, top), (right, bottom) = points
+                points = [(left, top), (right, top), (right, bottom), (left, bottom)]
+            elif len(points) < 2:
+                raise ConfigurationException(
+                    'Each region in %s must have at least two points.' % key)
+            regions.append(points)
+
+        return regions
+
+    def _verify_follow_up_email_list(self, config_helper, config_parser, key):
+        """Reads a list of follow up e-mails and throws an exception if it cannot be parsed.
+        E-mails are separated by semicolons.  Each e-mail is written as its delay in seconds
+        since the previous e-mail, a colon, and a comma separated list of the times after
+        the previous e-mail that images are stored.  (e.g. '10: 2.5,5,7.5,10; 20: 10,20')
+
+        config_helper: The ConfigHelper instance used to read the option.
+        config_parser: The ConfigParser instance the option is read from.
+        key: The name of the option.
+        Returns a list of (delay, image_save_times) tuples.  'none' returns an empty list.
+        """
+        value = config_helper.verify_string_exists(config_parser, key)
+        if value.strip().lower() == 'none':
+            return []
+
+        follow_up_emails = []
+        for email_text in value.split(';'):
+            try:
+                delay_text, image_save_times_text = email_text.split(':')
+                delay = float(delay_text)
+                image_save_times = [float(image_save_time_text) for image_save_time_text
+                                    in image_save_times_text.split(',')]
+            except ValueError as value_error:
+                raise ConfigurationException(
+                    '%s contains the invalid e-mail "%s". E-mails must be written as '
+                    'delay: time,time,...' % (key, email_text.strip())) from value_error
+            if delay < 0:
+                raise ConfigurationException('%s cannot contain negative delays.' % key)
+            follow_up_emails.append((delay, image_save_times))
+
+        return follow_up_emails
+
+    def _verify_parameter_dictionary(self, config_helper, config_parser, key):
+        """Reads a comma separated list of name=value pairs and throws an exception if it
+        cannot be parsed.  Values may be 'true', 'false', integers, or decimal numbers.
+
+        config_helper: The ConfigHelper instance used to read the option.
+        config_parser: The ConfigParser instance the option is read from.
+        key: The name of the option.
+        Returns a dictionary of parameter names to values.  'none' returns an empty
+          dictionary.
+        """
+        value = config_helper.verify_string_exists(config_parser, key)
+        if value.strip().lower() == 'none':
+            return {}
+
+        parameters = {}
+        for parameter_text in value.split(','):
+            name, separator, value_text = parameter_text.partition('=')
+            name = name.strip()
+            value_text = value_text.strip().lower()
+            if not separator or not name or not value_text:
+                raise ConfigurationException(
+                    '%s contains "%s". Parameters must be written as name=value.' % (
+                        key, parameter_text.strip()))
+
+            if value_text in ('true', 'false'):
+                parameters[name] = value_text == 'true'
+            else:
+                try:
+                    parameters[name] = int(value_text)
+                except ValueError:
+                    try:
+                        parameters[name] = float(value_text)
+                    except ValueError as value_error:
+                        raise ConfigurationException(
+                            'The value of %s in %s must be true, false, or a number.' % (
+                                name, key)) from value_error
+
+        return parameters
+
+
+def read_camera_names(config_parser):
+    """Reads the list of camera names and throws an exception if it is not valid.  Every
+    camera section must belong to a listed camera.
+
+    config_parser: The ConfigParser instance the configuration file was read into.
+    Returns the camera names in the order they are listed.
+    """
+    config_helper = confighelper.ConfigHelper()
+    camera_names = [camera_name.strip() for camera_name in
+                    config_helper.verify_string_exists(config_parser, 'cameras').split(',')]
+
+    for camera_name in camera_names:
+        if not CAMERA_NAME_PATTERN.match(camera_name):
+            raise ConfigurationException(
+                'Camera name "%s" may only contain letters, numbers, underscores, and '
+                'hyphens.' % camera_name)
+    if len(set(camera_names)) != len(camera_names):
+        raise ConfigurationException('cameras cannot list the same camera twice.')
+
+    for section in config_parser.sections():
+        if section.startswith(CAMERA_SECTION_PREFIX) and \
+                section[len(CAMERA_SECTION_PREFIX):] not in camera_names:
+            raise ConfigurationException(
+                'Section [%s] is not for a camera listed in cameras.' % section)
+
+    return camera_names
+
+
+def create_camera_config_parser(config_parser, camera_name):
+    """Creates a ConfigParser whose General section holds one camera's configuration.  The
+    options in the camera's section, if it exists, override the options in the General
+    section.
+
+    config_parser: The ConfigParser instance the configuration file was read into.
+    camera_name: The name of the camera.
+    Returns the new ConfigParser.
+    """
+    camera_config_parser = configparser.ConfigParser()
+    camera_config_parser.add_section(GENERAL_SECTION)
+    sections = [GENERAL_SECTION, CAMERA_SECTION_PREFIX + camera_name]
+    for section in sections:
+        if config_parser.has_section(section):
+            for option_name, option_value in config_parser.items(section, raw=True):
+                camera_config_parser.set(GENERAL_SECTION, option_name, option_value)
+
+    return camera_config_parser
+
+
+def read_camera_configs(config_parser):
+    """Reads and validates the configuration of every camera.
+
+    config_parser: The ConfigParser instance the configuration file was read into.
+    Returns a list of WatchmanConfig instances in the order the cameras are listed.
+    """
+    camera_configs = []
+    for camera_name in read_camera_names(config_parser):
+        camera_configs.append(WatchmanConfig(
+            create_camera_config_parser(config_parser, camera_name), camera_name))
+
+    video_device_numbers = [config.video_device_number for config in camera_configs]
+    if len(set(video_device_numbers)) != len(video_device_numbers):
+        raise ConfigurationException('Two cameras cannot use the same video_device_number.')
+
+    return camera_configs
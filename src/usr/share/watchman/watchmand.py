@@ -22,21 +22,24 @@
 __author__ = 'Joel Luellwitz and Emily Frost'
 __version__ = '0.8'
 
-import glob
 import grp
 import logging
 import os
 import pwd
 import signal
 import stat
-import subprocess
 import sys
-import time
 import traceback
 import configparser
 import daemon
 from lockfile import pidlockfile
 from parkbenchcommon import confighelper
+import camerasupervisor
+import deviceevents
+import mediaworker
+import metrics
+import profiling
+import retention
 import watchmanconfig
 
 # Constants
@@ -52,11 +55,16 @@ PROCESS_USERNAME = PROGRAM_NAME
 PROCESS_GROUP_NAME = PROGRAM_NAME
 SUBPROCESS_PATHNAME = os.path.join(
     '/usr/share', PROGRAM_NAME, '%s-subprocess.py' % PROGRAM_NAME)
-VIDEO_DEVICE_PREFIX = '/dev/video%d'
+MEDIA_WORKER_PATHNAME = os.path.join(
+    '/usr/share', PROGRAM_NAME, '%s-mediaworker.py' % PROGRAM_NAME)
+DEVICE_DIR = '/dev'
+VIDEO_DEVICE_NAME_PREFIX = 'video'
+VIDEO_DEVICE_PREFIX = os.path.join(DEVICE_DIR, VIDEO_DEVICE_NAME_PREFIX + '%d')
 PROGRAM_UMASK = 0o027  # -rw-r----- and drwxr-x---
 
-# Use a global variable to track the subprocess. This is needed for sig_term_handler.
-watchman_subprocess = None
+# Use a global variable to track the camera subprocesses. This is needed for
+#   sig_term_handler.
+camera_supervisors = []
 
 
 class InitializationException(Exception):
@@ -91,7 +99,8 @@ def read_configuration_and_create_logger(program_uid, program_gid):
 
     program_uid: The system user ID this program should drop to before daemonization.
     program_gid: The system group ID this program should drop to before daemonization.
-    Returns the read system config, a confighelper instance, and a logger instance.
+    Returns a list of per camera configs, a dictionary of daemon options, a confighelper
+      instance, and a logger instance.
     """
     print('Reading %s...' % CONFIGURATION_PATHNAME)
 
@@ -129,10 +138,36 @@ def read_configuration_and_create_logger(program_uid, program_gid):
 
     logger.info('Verifying non-logging configuration.')
 
-    # Parse the configuration file. The parsed result is returned as an object.
-    config = watchmanconfig.WatchmanConfig(config_file)
+    # Parse the configuration file. Each camera's configuration is returned as an object.
+    camera_configs = watchmanconfig.read_camera_configs(config_file)
 
-    return config, config_helper, logger
+    # Limits on the images and clips saved by every camera combined.
+    config['images_max_bytes'] = config_helper.verify_integer_within_range(
+        config_file, 'images_max_bytes', lower_bound=0)
+    config['images_max_age'] = config_helper.verify_number_within_range(
+        config_file, 'images_max_age', lower_bound=0)
+
+    config['metrics_port'] = config_helper.verify_integer_within_range(
+        config_file, 'metrics_port', lower_bound=0)
+    if config['metrics_port'] > 65535:
+        raise InitializationException('metrics_port must be 65535 or less.')
+
+    # How many seconds the daemon and the subprocesses are profiled for after receiving
+    #   SIGUSR1.
+    config['profile_seconds'] = config_helper.verify_integer_within_range(
+        config_file, 'profile_seconds', lower_bound=1)
+
+    available_cpus = os.sched_getaffinity(0)
+    for camera_config in camera_configs:
+        for option_name in ('cpu_affinity', 'media_worker_cpu_affinity'):
+            cpu_affinity = getattr(camera_config, option_name)
+            if cpu_affinity is not None and not cpu_affinity <= available_cpus:
+                raise InitializationException(
+                    '%s for camera %s lists CPUs that are not available. Available CPUs '
+                    'are: %s.' % (option_name, camera_config.camera_name,
+                                  ', '.join(str(cpu) for cpu in sorted(available_cpus))))
+
+    return camera_configs, config, config_helper, logger
 
 
 # TODO: Consider checking ACLs. (gpgmailer issue 22)
@@ -203,19 +238,24 @@ def sig_term_handler(signal, stack_frame):
     stack_frame: Represents the stack frame.
     """
     logger.info('SIGTERM received. Quitting.')
-    if watchman_subprocess is not None:
-        logger.info('Killing watchman subprocess.')
-        watchman_subprocess.kill()
+    kill_camera_subprocesses()
     sys.exit(0)
 
 
-def setup_daemon_context(log_file_handle, program_uid, program_gid):
+def kill_camera_subprocesses():
+    """Kills every running camera subprocess."""
+    for camera_supervisor in camera_supervisors:
+        camera_supervisor.kill()
+
+
+def setup_daemon_context(log_file_handle, program_uid, program_gid, signal_profiler):
     """Creates the daemon context. Specifies daemon permissions, PID file information, and
-    the signal handler.
+    the signal handlers.
 
     log_file_handle: The file handle to the log file.
     program_uid: The system user ID that should own the daemon process.
     program_gid: The system group ID that should be assigned to the daemon process.
+    signal_profiler: The profiling.SignalProfiler that handles SIGUSR1 and SIGALRM.
     Returns the daemon context.
     """
     daemon_context = daemon.DaemonContext(
@@ -227,6 +267,8 @@ def setup_daemon_context(log_file_handle, program_uid, program_gid):
 
     daemon_context.signal_map = {
         signal.SIGTERM: sig_term_handler,
+        signal.SIGUSR1: signal_profiler.handle_start_signal,
+        signal.SIGALRM: signal_profiler.handle_stop_signal,
     }
 
     daemon_context.files_preserve = [log_file_handle]
@@ -245,7 +287,7 @@ def main():
     os.umask(PROGRAM_UMASK)
     program_uid, program_gid = get_user_and_group_ids()
     global logger
-    config, config_helper, logger = read_configuration_and_create_logger(
+    camera_configs, config, config_helper, logger = read_configuration_and_create_logger(
         program_uid, program_gid)
 
     try:
@@ -255,10 +297,12 @@ def main():
         os.seteuid(os.getuid())
         os.setegid(os.getgid())
 
-        # drwxr-x--- watchman watchman
-        create_directory(
-            LOG_DIR, IMAGE_DIRS, program_uid, program_gid,
-            stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP)
+        # Each camera saves images to its own directory.  drwxr-x--- watchman watchman
+        for camera_config in camera_configs:
+            create_directory(
+                LOG_DIR, os.path.join(IMAGE_DIRS, camera_config.camera_name), program_uid,
+                program_gid,
+                stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP)
 
         # Non-root users cannot create files in /run, so create a directory that can be
         #   written to. Full access to user only.  drwx------ watchman watchman
@@ -268,64 +312,120 @@ def main():
         # Configuration has been read and directories setup. Now drop permissions forever.
         drop_permissions_forever(program_uid, program_gid)
 
+        # SIGUSR1 profiles the main loop.
+        signal_profiler = profiling.SignalProfiler(
+            LOG_DIR, PROGRAM_NAME, config['profile_seconds'], 'main_loop')
         daemon_context = setup_daemon_context(
-            config_helper.get_log_file_handle(), program_uid, program_gid)
+            config_helper.get_log_file_handle(), program_uid, program_gid, signal_profiler)
 
         logger.info('Daemonizing...')
         with daemon_context:
-            main_loop(config)
+            main_loop(camera_configs, config)
 
     except Exception as exception:  # pylint: disable=broad-except
         logger.critical('Fatal %s: %s\n%s', type(exception).__name__, str(exception),
                         traceback.format_exc())
-        if watchman_subprocess is not None:
-            logger.critical('Killing watchman subprocess.')
-            watchman_subprocess.kill()
+        if camera_supervisors:
+            logger.critical('Killing watchman subprocesses.')
+            kill_camera_subprocesses()
         raise exception
 
 
-def main_loop(config):
-    """The main program loop.
-
-    config: The program configuration object, mostly based on the configuration file.
+def format_metrics():
+    """Returns the state of each camera's subprocess and the metrics last written by each
+    running subprocess in the Prometheus text format.  Called from the metrics server
+    thread.
     """
-    global watchman_subprocess
-
-    selected_device_pathname = VIDEO_DEVICE_PREFIX % config.video_device_number
+    # (name, type, help, attribute function) of each per camera metric.
+    supervisor_metrics = [
+        ('watchman_subprocess_running', 'gauge',
+         'Whether the camera\'s subprocess is running.',
+         lambda camera_supervisor: int(camera_supervisor.subprocess is not None)),
+        ('watchman_subprocess_starts_total', 'counter',
+         'Times the camera\'s subprocess was started.',
+         lambda camera_supervisor: camera_supervisor.start_count),
+        ('watchman_subprocess_exits_total', 'counter',
+         'Times the camera\'s subprocess exited on its own.',
+         lambda camera_supervisor: camera_supervisor.exit_count)]
+
+    lines = []
+    for name, metric_type, help_text, get_value in supervisor_metrics:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for camera_supervisor in camera_supervisors:
+            lines.append('%s{camera=%s} %d' % (
+                name, metrics.format_label_value(camera_supervisor.camera_name),
+                get_value(camera_supervisor)))
+    texts = ['\n'.join(lines)]
+
+    # A stopped subprocess's metrics are out of date.
+    for camera_supervisor in camera_supervisors:
+        if camera_supervisor.subprocess is not None:
+            metrics_pathname = \
+                metrics.METRICS_PATHNAME_FORMAT % camera_supervisor.camera_name
+            metrics_pathnames = [metrics_pathname]
+            if camera_supervisor.media_worker is not None:
+                metrics_pathnames.append(
+                    mediaworker.get_media_worker_metrics_pathname(metrics_pathname))
+            for metrics_pathname in metrics_pathnames:
+                try:
+                    with open(metrics_pathname) as metrics_file:
+                        texts.append(metrics_file.read())
+                except FileNotFoundError:
+                    pass  # Not written yet.
+
+    return metrics.merge_metrics(texts)
+
+
+def main_loop(camera_configs, config):
+    """The main program loop.  Starts and stops a subprocess for each camera as its video
+    device appears and disappears.  Sleeps until a video device changes or a subprocess
+    exits.  Old saved images are removed in a background thread.  Metrics are served in
+    another background thread.
+
+    camera_configs: The configuration object of each camera, mostly based on the
+      configuration file.
+    config: The dictionary of daemon options.
+    """
+    if config['images_max_bytes'] or config['images_max_age']:
+        retention.RetentionManager(
+            [os.path.join(LOG_DIR, IMAGE_DIRS, camera_config.camera_name)
+             for camera_config in camera_configs],
+            config['images_max_bytes'], config['images_max_age']).start()
+
+    for camera_config in camera_configs:
+        media_worker_pathname = None
+        if camera_config.media_worker == 'process':
+            media_worker_pathname = MEDIA_WORKER_PATHNAME
+        camera_supervisors.append(camerasupervisor.CameraSupervisor(
+            camera_config.camera_name,
+            VIDEO_DEVICE_PREFIX % camera_config.video_device_number, SUBPROCESS_PATHNAME,
+            camera_config.cpu_affinity, media_worker_pathname,
+            camera_config.media_worker_cpu_affinity))
+
+    if config['metrics_port']:
+        metrics.MetricsServer(config['metrics_port'], format_metrics)
+
+    device_event_monitor = deviceevents.DeviceEventMonitor(
+        DEVICE_DIR, VIDEO_DEVICE_NAME_PREFIX)
 
     # Loop forever.
     while True:
-        try:
-            # Wait for the device to show up.
-            while not glob.glob(selected_device_pathname):
-                time.sleep(.1)
-
-            # Startup the subprocess to that takes photos.
-            logger.info("Detected video device %s. Starting watchman subprocess.",
-                        selected_device_pathname)
-            watchman_subprocess = subprocess.Popen([SUBPROCESS_PATHNAME])
-
-            # Loop while the device exists and the subprocess is still running.
-            while glob.glob(selected_device_pathname) and watchman_subprocess.poll() is None:
-                time.sleep(.1)
-
-            # Kill the subprocess so it can be restarted.
+        timeout = None
+        for camera_supervisor in camera_supervisors:
             try:
-                logger.info('Detected device removal. Killing watchman subprocess.')
-                # TODO: Send a signal to watchman to flush its current e-mail buffer, give it
-                #   a second then do a kill or kill -9. (issue 4)
-                watchman_subprocess.kill()
-            except OSError as os_error:
-                logger.error('Error killing watchman subprocess. %s: %s',
-                             type(os_error).__name__, str(os_error))
-                logger.error('%s', traceback.format_exc())
-                logger.error('Ignoring.')  # The subprocess might no longer exist.
-
-        except Exception as exception:  # pylint: disable=broad-except
-            logger.error(
-                'Unexpected error %s: %s\n%s', type(exception).__name__, str(exception),
-                traceback.format_exc())
-            time.sleep(.1)
+                poll_delay = camera_supervisor.poll()
+            except Exception as exception:  # pylint: disable=broad-except
+                logger.error(
+                    'Unexpected error supervising camera %s. %s: %s\n%s',
+                    camera_supervisor.camera_name, type(exception).__name__,
+                    str(exception), traceback.format_exc())
+                # Try again later.
+                poll_delay = camerasupervisor.MINIMUM_RESTART_DELAY
+            if poll_delay is not None and (timeout is None or poll_delay < timeout):
+                timeout = poll_delay
+
+        device_event_monitor.wait(timeout)
 
 
 if __name__ == "__main__":
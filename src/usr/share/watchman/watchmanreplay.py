@@ -0,0 +1,193 @@
+# Copyright 2015-2023 Joel Allen Luellwitz and Emily Frost
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Stand-ins for the camera and gpgmailer that let the watchman subprocess run against
+recorded footage.  Used for benchmarking and tuning.
+"""
+
+__all__ = ['ReplayCaptureDevice', 'LocalMailSink']
+__author__ = 'Joel Luellwitz and Emily Frost'
+__version__ = '0.8'
+
+import logging
+import os
+import cv2
+import numpy
+import framecapture
+
+# Used when a video file does not report its frame rate.
+DEFAULT_REPLAY_FPS = 30.0
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.ppm', '.tif', '.tiff')
+JPEG_EXTENSIONS = ('.jpeg', '.jpg')
+
+
+class ReplayCaptureDevice():
+    """Reads frames from a video file or a directory of images using the same read(),
+    grab(), and retrieve() interface as cv2.VideoCapture.  Frames are timestamped as if they
+    had been captured live at the source frame rate, so time based thresholds behave the
+    same no matter how fast the frames are actually processed.
+    """
+
+    def __init__(self, source_pathname, fps=None, encoded=False):
+        """Opens the recorded footage.
+
+        source_pathname: A video file or a directory of image files.  Images in a directory
+          are replayed in filename order.
+        fps: The frame rate used to timestamp frames.  Defaults to the rate reported by the
+          video file or DEFAULT_REPLAY_FPS.
+        encoded: Return JPEGs, like an MJPEG camera, instead of decoded images.  JPEG files
+          are returned as is.  Anything else is encoded first.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.encoded = encoded
+
+        self.video_capture = None
+        self.image_pathnames = None
+        if os.path.isdir(source_pathname):
+            self.image_pathnames = sorted(
+                os.path.join(source_pathname, filename)
+                for filename in os.listdir(source_pathname)
+                if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS)
+            if not self.image_pathnames:
+                raise ValueError('Directory %s contains no images.' % source_pathname)
+        else:
+            self.video_capture = cv2.VideoCapture(source_pathname)
+            if not self.video_capture.isOpened():
+                raise ValueError('Could not open video file %s.' % source_pathname)
+            if fps is None and self.video_capture.get(cv2.CAP_PROP_FPS) > 0:
+                fps = self.video_capture.get(cv2.CAP_PROP_FPS)
+
+        if fps is None:
+            fps = DEFAULT_REPLAY_FPS
+        self.frame_period_ns = framecapture.NANOSECONDS_PER_SECOND / fps
+        self.start_time_ns = framecapture.monotonic_ns()
+        self.frame_index = -1
+
+        self.logger.info('Replaying %s at %.2f frames/sec.', source_pathname, fps)
+
+    def read(self):
+        """Returns a (success, image) tuple for the next frame, like cv2.VideoCapture.read.
+        success is False once the footage is exhausted.
+        """
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def grab(self):
+        """Advances to the next frame without decoding it, like cv2.VideoCapture.grab.
+        Returns False once the footage is exhausted.
+        """
+        if self.image_pathnames is not None:
+            if self.frame_index + 1 >= len(self.image_pathnames):
+                return False
+        elif not self.video_capture.grab():
+            return False
+        self.frame_index += 1
+        return True
+
+    def retrieve(self):
+        """Returns a (success, image) tuple for the frame grab() advanced to, like
+        cv2.VideoCapture.retrieve.
+        """
+        if self.image_pathnames is not None:
+            image_pathname = self.image_pathnames[self.frame_index]
+            if self.encoded and \
+                    os.path.splitext(image_pathname)[1].lower() in JPEG_EXTENSIONS:
+                # Returned as is, like an MJPEG camera would send it.
+                return True, numpy.fromfile(image_pathname, numpy.uint8)
+            image = cv2.imread(image_pathname)
+            return_value = image is not None
+        else:
+            return_value, image = self.video_capture.retrieve()
+
+        if return_value and self.encoded:
+            return_value, image = cv2.imencode('.jpg', image)
+        return return_value, image
+
+    def get_frame_time(self):
+        """Returns the simulated capture time, in monotonic nanoseconds, of the most
+        recently read frame.
+        """
+        return self.start_time_ns + int(round(
+            self.frame_period_ns * max(self.frame_index, 0)))
+
+    def release(self):
+        """Closes the video file, if any."""
+        if self.video_capture is not None:
+            self.video_capture.release()
+
+
+class LocalMailSink():
+    """Creates e-mail messages that are written to a local directory instead of being
+    queued with gpgmailer.
+    """
+
+    def __init__(self, output_directory):
+        """output_directory: The directory message bodies and attachments are written to.
+        It is created if it does not exist.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.output_directory = output_directory
+        os.makedirs(self.output_directory, exist_ok=True)
+        self.email_count = 0
+        self.attachment_count = 0
+
+    def create_message(self):
+        """Returns a new message with the same interface as gpgmailmessage.GpgMailMessage."""
+        return LocalMailMessage(self)
+
+
+class LocalMailMessage():
+    """An e-mail message with the GpgMailMessage interface that is saved to disk by a
+    LocalMailSink.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.subject = None
+        self.body = None
+        self.attachments = []
+
+    def set_subject(self, subject):
+        """Sets the subject of the message."""
+        self.subject = subject
+
+    def set_body(self, body):
+        """Sets the plain text body of the message."""
+        self.body = body
+
+    def add_attachment(self, filename, data):
+        """Adds an attachment to the message.
+
+        filename: The name of the attached file.
+        data: The attachment contents as bytes or a buffer such as an encoded image.
+        """
+        self.attachments.append((filename, data))
+
+    def queue_for_sending(self):
+        """Writes the message body and its attachments to the sink's output directory."""
+        self.sink.email_count += 1
+        prefix = os.path.join(
+            self.sink.output_directory, 'email-%06d' % self.sink.email_count)
+
+        with open('%s.txt' % prefix, 'w') as body_file:
+            body_file.write('Subject: %s\n\n%s\n' % (self.subject, self.body))
+        for filename, data in self.attachments:
+            with open('%s-%s' % (prefix, filename), 'wb') as attachment_file:
+                attachment_file.write(bytes(data))
+            self.sink.attachment_count += 1
+
+        self.sink.logger.debug('Wrote e-mail %s with %d attachments.', prefix,
+                               len(self.attachments))